@@ -0,0 +1,419 @@
+"""Asyncio counterpart of client.py for the API process.
+
+Same call signatures as client.py, but awaitable and backed by one pooled
+keep-alive httpx.AsyncClient, so in-flight generations don't hold threadpool
+slots. The sync client stays in use by the Celery workers.
+"""
+import json
+import time
+import asyncio
+import httpx
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator
+from config import settings
+from client import (
+    _generate_payload, _chat_payload, _chunk_text, _cache_key, _structured_request, _structured_key, _structured_prompt,
+    _structured_format, _parse_structured, _aborted, STRUCTURED_SYSTEM, STRUCTURED_TEMPERATURE,
+)
+import cache
+import semantic_cache
+import singleflight
+import validator
+import sessions
+import metrics
+import backends
+
+# === Connection Pool (one keep-alive pool per process) ===
+_client: httpx.AsyncClient = None
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            headers={"Content-Type": "application/json"},
+            timeout=httpx.Timeout(settings.TIMEOUT, connect=10),
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE,
+            ),
+        )
+    return _client
+
+async def aclose():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# === Helpers ===
+
+async def _ollama(endpoint: str, payload: dict, stream: bool = False, tried: set[str] = None) -> httpx.Response:
+    """POST to the best Ollama host (see backends.py), moving on to the next one on host errors.
+
+    Hosts in `tried` are skipped; hosts used are added to it.
+    """
+    model, error = payload.get("model"), None
+    metrics.tag(model=backends.model_label(model))
+    c = _get_client()
+    for b in backends.pool.attempts(model, tried):
+        req = c.build_request("POST", f"{b.host}/api/{endpoint}", json={**payload, "stream": stream})
+        try:
+            r = await c.send(req, stream=stream)
+        except httpx.TransportError as e:
+            backends.pool.release(b, model)
+            backends.pool.finish(b, None, model)
+            error = e
+            continue
+        except asyncio.CancelledError:  # Hedge loser or client gone: no verdict on the host
+            backends.pool.abandon(b, model)
+            raise
+        except BaseException:
+            backends.pool.release(b, model)
+            backends.pool.finish(b, None, model)
+            raise
+        if r.is_error:
+            if stream:
+                await r.aread()
+                await r.aclose()
+            backends.pool.release(b, model)
+            if backends.pool.finish(b, r.status_code, model):
+                error = httpx.HTTPStatusError(f"{r.status_code} from {b.host}", request=req, response=r)
+                continue
+            r.raise_for_status()
+        backends.pool.finish(b, r.status_code, model)
+        if stream:
+            backends.pool.hold(r, b, model)  # Released when the stream is closed
+        else:
+            backends.pool.release(b, model)
+        return r
+    raise error or backends.NoBackendAvailable("No healthy Ollama host")
+
+async def _openrouter(messages: list[dict], failed_model: str = None) -> str:
+    metrics.FALLBACKS.labels(backends.model_label(failed_model)).inc()
+    r = await _get_client().post(
+        "https://openrouter.ai/api/v1/chat/completions",
+        headers={"Authorization": f"Bearer {settings.OPENROUTER_KEY}"},
+        json={"model": settings.OPENROUTER_MODEL, "messages": messages},
+    )
+    r.raise_for_status()
+    return r.json()["choices"][0]["message"]["content"]
+
+async def _stream_response(r: httpx.Response, key: str, lines: AsyncIterator[str] = None) -> AsyncGenerator[str, None]:
+    try:
+        async for line in lines or r.aiter_lines():
+            if line:
+                data = json.loads(line)
+                if data.get("done"):
+                    metrics.observe_generation(data)
+                yield _chunk_text(data, key)
+    finally:
+        await r.aclose()  # Client gone -> Ollama stops generating
+        backends.done(r)
+
+async def _once(text: str) -> AsyncGenerator[str, None]:
+    yield text
+
+# === Hedged Requests ===
+# No first token within the model's TTFT percentile -> send the same request to
+# another host (or the fallback provider); the first to produce output wins and
+# the other connection is closed so Ollama stops generating for it.
+
+_ttft: dict[str, deque] = {}
+_hedges_inflight = 0
+
+def hedge_threshold(model: str) -> float:
+    samples = _ttft.get(model)
+    if not samples or len(samples) < settings.HEDGE_MIN_SAMPLES:
+        return settings.HEDGE_DEFAULT_S
+    ordered = sorted(samples)
+    return max(settings.HEDGE_MIN_S, ordered[int(settings.HEDGE_PERCENTILE * (len(ordered) - 1))])
+
+async def _prepend(first: str, lines: AsyncIterator[str]) -> AsyncGenerator[str, None]:
+    yield first
+    async for line in lines:
+        yield line
+
+async def _first_line(endpoint: str, payload: dict, tried: set[str]) -> tuple[httpx.Response, AsyncIterator[str]]:
+    """Start a streamed call and wait for its first line; lines come back with that line re-attached."""
+    start = time.monotonic()
+    r = await _ollama(endpoint, payload, stream=True, tried=tried)
+    try:
+        lines = r.aiter_lines()
+        first = ""
+        while not first:
+            first = await anext(lines)
+    except BaseException:  # Lost the race (cancelled) or failed: drop the connection
+        await r.aclose()
+        backends.done(r)
+        raise
+    _ttft_sample(payload["model"], time.monotonic() - start)
+    return r, _prepend(first, lines)
+
+def _ttft_sample(model: str, seconds: float):
+    _ttft.setdefault(model, deque(maxlen=settings.HEDGE_WINDOW)).append(seconds)
+
+async def _hedge_call(endpoint: str, payload: dict, tried: set[str], fallback: list[dict]):
+    global _hedges_inflight
+    _hedges_inflight += 1
+    try:
+        try:
+            return await _first_line(endpoint, payload, set(tried))
+        except (backends.NoBackendAvailable, httpx.HTTPError):
+            if not settings.OPENROUTER_KEY:
+                raise
+        return await _openrouter(fallback, payload["model"])
+    finally:
+        _hedges_inflight -= 1
+
+async def _discard(task: asyncio.Task):
+    if not task.done():
+        task.cancel()
+        return
+    if not task.cancelled() and task.exception() is None and isinstance(task.result(), tuple):
+        r, _ = task.result()  # Finished in the same instant as the winner
+        await r.aclose()
+        backends.done(r)
+
+async def _hedged(endpoint: str, payload: dict, fallback: list[dict]) -> AsyncGenerator[str, None]:
+    """Streamed chunks from whichever of the primary and the hedge produces output first."""
+    model, key, tried = payload["model"], "response" if endpoint == "generate" else "message", set()
+    primary = asyncio.create_task(_first_line(endpoint, payload, tried))
+    tasks, winner, started = {primary}, None, {primary: time.monotonic()}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_threshold(model))
+        if not done and _hedges_inflight < settings.HEDGE_MAX_INFLIGHT:
+            hedge = asyncio.create_task(_hedge_call(endpoint, payload, tried, fallback))
+            tasks.add(hedge)
+            started[hedge] = time.monotonic()
+        winner, pending = None, set(tasks)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((t for t in done if t.exception() is None), None)
+        if winner is None:
+            raise primary.exception()
+    finally:
+        now = time.monotonic()
+        for t in tasks:
+            if t is winner:
+                continue
+            # A loser without a first line (cancelled or failed) waited longer than the winner took:
+            # count that wait, or the percentile only ever sees the fast responses
+            answered = t.done() and not t.cancelled() and t.exception() is None
+            if winner is not None and not answered and now - started[t] > now - started[winner]:
+                _ttft_sample(model, now - started[t])
+            await _discard(t)
+    if len(tasks) > 1:
+        result = winner.result()
+        metrics.HEDGES.labels(backends.model_label(model), "primary" if winner is primary else "fallback" if isinstance(result, str) else "hedge").inc()
+    if isinstance(winner.result(), str):
+        return _once(winner.result())
+    r, lines = winner.result()
+    return _stream_response(r, key, lines)
+
+# === Semantic Cache ===
+
+async def _semantic_query(kind: str, payload: dict, cache_mode: str, temperature: float | None, task: str = "chat"):
+    """(scope, prompt vector) for the semantic cache, or None if it doesn't apply or embedding failed."""
+    if not semantic_cache.enabled(cache_mode, 1.0 if temperature is None else temperature):
+        return None
+    if (scope := semantic_cache.scope(kind, payload, task)) is None:
+        return None
+    try:
+        r = await _ollama("embed", {"model": settings.SEMANTIC_CACHE_EMBED_MODEL, "input": scope[1]})
+        vector = semantic_cache.normalize(r.json()["embeddings"][0])
+    except (httpx.HTTPError, backends.NoBackendAvailable, ValueError, KeyError, IndexError):
+        return None  # Cache is best-effort: generate as usual
+    finally:
+        metrics.tag(model=backends.model_label(payload["model"]))
+    return None if vector is None else (scope[0], vector)
+
+# === Core API ===
+
+async def infer(
+    prompt: str,
+    task: str = "chat",
+    model: str = None,
+    images: list[str] = None,
+    stream: bool = False,
+    temperature: float = 0.7,
+    system: str = None,
+    num_predict: int = None,
+    cache_mode: str = None,
+    format: str | dict = None,
+    hedge: bool = None,  # API only: hedge slow first tokens (None = HEDGE_ENABLED)
+) -> str | AsyncGenerator[str, None]:
+    args = (prompt, task, model, images, temperature, system, num_predict, format)
+    if images:  # Image encoding reads files - keep it off the event loop
+        payload = await asyncio.to_thread(_generate_payload, *args)
+    else:
+        payload = _generate_payload(*args)
+    key = _cache_key("generate", payload, stream, cache_mode, temperature)
+    if key and cache_mode != "refresh" and (hit := await cache.aget(key)) is not None:
+        return hit
+    hedge = settings.HEDGE_ENABLED if hedge is None else hedge
+    if stream:  # Identical concurrent streams attach to one generation
+        return singleflight.stream(singleflight.flight_key("generate:stream", payload, cache_mode),
+                                   lambda: _generate(payload, stream=True, hedge=hedge))
+
+    semantic = await _semantic_query("generate", payload, cache_mode, temperature, task)
+    if semantic and cache_mode != "refresh" and (hit := await asyncio.to_thread(semantic_cache.lookup, *semantic)) is not None:
+        return hit
+
+    async def run() -> str:
+        result = await _generate(payload, hedge=hedge)
+        if key:
+            await cache.aput(key, result)
+        if semantic:
+            await asyncio.to_thread(semantic_cache.store, *semantic, result)
+        return result
+    return await singleflight.arun(singleflight.flight_key("generate", payload, cache_mode), run)
+
+async def _generate(payload: dict, stream: bool = False, hedge: bool = False) -> str | AsyncGenerator[str, None]:
+    fallback = [{"role": "system", "content": payload.get("system", "")}, {"role": "user", "content": payload["prompt"]}]
+    try:
+        if hedge:
+            chunks = await _hedged("generate", payload, fallback)
+            return chunks if stream else "".join([c async for c in chunks])
+        r = await _ollama("generate", payload, stream)
+        if stream:
+            return _stream_response(r, "response")
+        data = r.json()
+        metrics.observe_generation(data)
+        return data.get("response", "")
+    except Exception as e:
+        if not settings.OPENROUTER_KEY:
+            raise e
+        text = await _openrouter(fallback, payload["model"])
+        return _once(text) if stream else text
+
+async def chat(messages: list[dict], model: str = None, stream: bool = False, system: str = None,
+               temperature: float = None, cache_mode: str = None) -> str | AsyncGenerator[str, None]:
+    payload = _chat_payload(messages, model, system, temperature)
+    key = _cache_key("chat", payload, stream, cache_mode, temperature)
+    if key and cache_mode != "refresh" and (hit := await cache.aget(key)) is not None:
+        return hit
+    if stream:
+        return singleflight.stream(singleflight.flight_key("chat:stream", payload, cache_mode),
+                                   lambda: _chat(payload, stream=True))
+
+    semantic = await _semantic_query("chat", payload, cache_mode, temperature)
+    if semantic and cache_mode != "refresh" and (hit := await asyncio.to_thread(semantic_cache.lookup, *semantic)) is not None:
+        return hit
+
+    async def run() -> str:
+        result = await _chat(payload)
+        if key:
+            await cache.aput(key, result)
+        if semantic:
+            await asyncio.to_thread(semantic_cache.store, *semantic, result)
+        return result
+    return await singleflight.arun(singleflight.flight_key("chat", payload, cache_mode), run)
+
+async def _chat(payload: dict, stream: bool = False) -> str | AsyncGenerator[str, None]:
+    try:
+        r = await _ollama("chat", payload, stream)
+        if stream:
+            return _stream_response(r, "message")
+        data = r.json()
+        metrics.observe_generation(data)
+        return data.get("message", {}).get("content", "")
+    except Exception as e:
+        if not settings.OPENROUTER_KEY:
+            raise e
+        text = await _openrouter(payload["messages"], payload["model"])
+        return _once(text) if stream else text
+
+async def session_turn(session: dict, message: str, stream: bool = False, temperature: float = 0.7,
+                       num_predict: int = None) -> str | AsyncGenerator[str, None]:
+    """One chat turn on a server-side session; the session is updated once the reply is complete."""
+    payload = sessions.payload(session, message, temperature, num_predict)
+    try:
+        r = await _ollama("generate", payload, stream)
+    except Exception as e:
+        if not settings.OPENROUTER_KEY:
+            raise e
+        reply = await _openrouter(sessions.fallback_messages(session, message), session["model"])
+        sessions.apply(session, message, reply, None)
+        return _once(reply) if stream else reply
+    if stream:
+        return _session_stream(session, message, r)
+    data = r.json()
+    metrics.observe_generation(data)
+    sessions.apply(session, message, data.get("response", ""), data.get("context"))
+    return data.get("response", "")
+
+async def _session_stream(session: dict, message: str, r: httpx.Response) -> AsyncGenerator[str, None]:
+    parts, context = [], None
+    try:
+        async for line in r.aiter_lines():
+            if line:
+                data = json.loads(line)
+                parts.append(data.get("response", ""))
+                yield parts[-1]
+                if data.get("done"):
+                    context = data.get("context")  # Final chunk carries the updated context
+                    metrics.observe_generation(data)
+    finally:
+        await r.aclose()
+        backends.done(r)
+    sessions.apply(session, message, "".join(parts), context)
+
+async def _tags(host: str) -> list[str] | None:
+    try:
+        r = await _get_client().get(f"{host}/api/tags", timeout=5)
+        return [m["name"] for m in r.json().get("models", [])]
+    except (httpx.HTTPError, ValueError):
+        return None  # Host offline, the pool status shows which
+
+async def health() -> dict:
+    result = {"ollama": "offline", "models": [], "ready": False}
+    hosts = [t for t in await asyncio.gather(*(_tags(h) for h in settings.OLLAMA_HOSTS)) if t is not None]
+    if hosts:
+        loaded = {m for models in hosts for m in models}
+        result.update(ollama="online", models=sorted(loaded), models_required=list(settings.MODELS.values()))
+        result["models_missing"] = [m for m in result["models_required"] if m not in loaded]
+        result["ready"] = len(result["models_missing"]) == 0
+    result["backends"] = backends.pool.status()
+    result["openrouter"] = "configured" if settings.OPENROUTER_KEY else "not_configured"
+    return result
+
+# === Structured Output ===
+
+async def structured(prompt: str, schema: dict, model: str = None, retries: int = 2, cache_mode: str = None,
+                     hedge: bool = None) -> dict:
+    request = _structured_request(prompt, schema, model, retries)
+    key = _structured_key(request, cache_mode)
+    if key and cache_mode != "refresh" and (hit := await cache.aget(key)) is not None:
+        return hit
+
+    async def run() -> dict:
+        result = await _structured(prompt, schema, model, retries, hedge)
+        if key and result["success"]:
+            await cache.aput(key, result)
+        return result
+    return await singleflight.arun(singleflight.flight_key("structured", request, cache_mode), run)
+
+async def _structured_attempt(full_prompt: str, schema: dict, model: str, hedge: bool = None) -> tuple[str, str | None]:
+    kwargs = dict(prompt=full_prompt, task="extract", model=model, system=STRUCTURED_SYSTEM,
+                  temperature=STRUCTURED_TEMPERATURE, cache_mode="bypass", format=_structured_format(schema), hedge=hedge)
+    if not settings.STRUCTURED_STREAM_VALIDATE:
+        return await infer(**kwargs), None
+    chunks = await infer(**kwargs, stream=True)
+    checker, parts = validator.StreamValidator(schema), []
+    async for chunk in chunks:
+        parts.append(chunk)
+        if reason := checker.feed(chunk):
+            await chunks.aclose()  # Abort the generation now instead of waiting for num_predict
+            return "".join(parts), reason
+    return "".join(parts), None
+
+async def _structured(prompt: str, schema: dict, model: str, retries: int, hedge: bool = None) -> dict:
+    full_prompt = _structured_prompt(prompt, schema)
+
+    for attempt in range(retries + 1):
+        response, reason = await _structured_attempt(full_prompt, schema, model, hedge)
+        last = attempt == retries
+        result = _aborted(response, reason, last) if reason else _parse_structured(response, schema, last)
+        if result is not None:
+            return result
+    return {"success": False, "error": "Max retries exceeded"}
@@ -0,0 +1,137 @@
+"""Admission control: refuse (or defer) work that can't finish in time.
+
+Predicted completion for a request on queue q with model m:
+  service = prefill(m) + tokens / decode_rate(m), tokens = num_predict or m's
+            average output (q's average task duration until m has samples)
+  async:    ceil(ahead / slots(q)) * avg_task(q) + service, ahead = pending
+            tasks of the same or a higher priority class (as /async/stats)
+  sync:     ceil(in_flight / (OLLAMA_NUM_PARALLEL * hosts)) * service + service,
+            in_flight = this process's requests outstanding for m on the backend pool
+
+A request whose prediction exceeds its limit - for tasks ADMISSION_MAX_S for
+the queue, or deadline_s when that is shorter; OLLAMA_TIMEOUT for sync calls -
+is refused with 503 and Retry-After, or queued as a task when a sync caller
+asks for on_overload="async". With no history yet everything is admitted.
+
+Per-model rates are moving averages of Ollama's eval stats (record(), called
+from metrics.observe_generation in every process), shared through one Redis
+hash (last writer wins). Depths, queue averages and rates are re-read at most
+every ADMISSION_REFRESH_S, so most admissions cost no Redis round trip.
+"""
+import json
+import math
+import time
+import asyncio
+import threading
+import redis
+from dataclasses import dataclass
+from config import settings, get_concurrency, get_logger
+from redis_pool import get_redis
+import queue_index
+
+log = get_logger("admission")
+
+RATES_KEY = "admission:rates"
+EMA_ALPHA = 0.2
+
+_local: dict[str, list[float]] = {}  # model -> [decode tokens/s, prefill s, output tokens]
+_lock = threading.Lock()
+_last_publish = 0.0
+_snapshot = {"at": 0.0, "depths": {}, "avg": {}, "rates": {}}
+
+@dataclass
+class Verdict:
+    admit: bool
+    predicted_s: float
+    limit_s: float
+
+    @property
+    def retry_after(self) -> int:
+        """Seconds until the prediction would fit, assuming the backlog drains at the current rate."""
+        return max(1, math.ceil(self.predicted_s - self.limit_s))
+
+# === Rates ===
+
+def record(data: dict):
+    """Fold one finished generation's eval stats into its model's averages."""
+    model, tokens, eval_ns = data.get("model"), data.get("eval_count"), data.get("eval_duration")
+    if not (model and tokens and eval_ns):
+        return
+    sample = (tokens / eval_ns * 1e9, data.get("prompt_eval_duration", 0) / 1e9, tokens)
+    with _lock:
+        prev = _local.get(model)
+        _local[model] = list(sample) if prev is None else [EMA_ALPHA * s + (1 - EMA_ALPHA) * p for s, p in zip(sample, prev)]
+    _maybe_publish()
+
+def _maybe_publish():
+    global _last_publish
+    if time.time() - _last_publish < settings.ADMISSION_REFRESH_S:
+        return
+    _last_publish = time.time()
+    with _lock:
+        mapping = {model: json.dumps(rates) for model, rates in _local.items()}
+    threading.Thread(target=_publish, args=(mapping,), name="admission-publish", daemon=True).start()
+
+def _publish(mapping: dict):
+    try:
+        get_redis().hset(RATES_KEY, mapping=mapping)
+    except redis.RedisError as e:
+        log.warning(f"Could not publish model rates: {e}")
+
+# === Prediction ===
+
+def _stale() -> bool:
+    return time.time() - _snapshot["at"] >= settings.ADMISSION_REFRESH_S
+
+def _refresh():
+    if not _stale():
+        return
+    _snapshot["at"] = time.time()  # Also on failure: don't retry a down Redis on every request
+    try:
+        r = get_redis()
+        depths = queue_index.priority_depths(r)
+        avg = queue_index.average_durations(r)
+        rates = {k.decode(): json.loads(v) for k, v in r.hgetall(RATES_KEY).items()}
+    except (redis.RedisError, ValueError) as e:
+        log.warning(f"Admission data unavailable, admitting on stale data: {e}")
+        return
+    _snapshot.update(depths=depths, avg=avg, rates=rates)
+
+def service_time(queue: str, model: str, num_predict: int = None) -> float:
+    with _lock:
+        rates = _local.get(model) or _snapshot["rates"].get(model)
+    if rates:
+        tps, prefill, avg_tokens = rates
+        return prefill + (num_predict or avg_tokens) / tps
+    return _snapshot["avg"].get(queue) or 0.0
+
+def check_task(queue: str, model: str, num_predict: int = None, priority: int = 0, deadline_s: float = None,
+               queued_before: int = 0) -> Verdict:
+    """Predict a queued task's completion; queued_before = tasks submitted ahead of it in the same batch."""
+    limit = settings.ADMISSION_MAX_S[queue]
+    if deadline_s:
+        limit = min(deadline_s, limit)  # A long deadline doesn't lift the queue's cap
+    if not settings.ADMISSION_ENABLED:
+        return Verdict(True, 0.0, limit)
+    _refresh()
+    service = service_time(queue, model or settings.MODELS.get(queue), num_predict)
+    ahead = queued_before + sum(n for cls, n in _snapshot["depths"].get(queue, {}).items()
+                                if settings.PRIORITY_CLASSES[cls] <= priority)
+    predicted = math.ceil(ahead / get_concurrency(queue)) * (_snapshot["avg"].get(queue) or service) + service
+    return Verdict(predicted <= limit, predicted, limit)
+
+def check_sync(queue: str, model: str, in_flight: int, hosts: int, num_predict: int = None) -> Verdict:
+    """Predict a direct (non-queued) call's completion against OLLAMA_TIMEOUT; in_flight counts calls for model."""
+    limit = float(settings.TIMEOUT)
+    if not settings.ADMISSION_ENABLED:
+        return Verdict(True, 0.0, limit)
+    _refresh()
+    service = service_time(queue, model or settings.MODELS.get(queue), num_predict)
+    predicted = math.ceil(in_flight / (settings.OLLAMA_NUM_PARALLEL * max(1, hosts))) * service + service
+    return Verdict(predicted <= limit, predicted, limit)
+
+async def acheck_sync(queue: str, model: str, in_flight: int, hosts: int, num_predict: int = None) -> Verdict:
+    """check_sync for the event loop: a due refresh (blocking Redis reads) runs in a thread."""
+    if settings.ADMISSION_ENABLED and _stale():
+        await asyncio.to_thread(_refresh)
+    return check_sync(queue, model, in_flight, hosts, num_predict)
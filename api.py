@@ -1,50 +1,58 @@
 import os
+import json
 import time
-import shutil
-from collections import defaultdict
-from fastapi import APIRouter, Depends, Request, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+import asyncio
+from fastapi import APIRouter, Depends, Request, Response, HTTPException, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 from typing import List, Dict, Any
-import client
-from config import settings
+import aclient
+import cache
+import semantic_cache
+import singleflight
+import ratelimit
+import queue_index
+import token_stream
+import sessions
+import result_store
+import events
+import uploads
+import admission
+import preload
+import mapreduce
+import backends
+import metrics
+from config import settings, get_model
+from celery import chord
 from celery.result import AsyncResult
 from celery_app import app as celery_app
 import redis
+from redis_pool import get_redis, get_async_redis
 import uuid
 
 os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
 
-# === Redis Connection Pool ===
-_redis_pool = None
-
-def get_redis() -> redis.Redis:
-    global _redis_pool
-    if _redis_pool is None:
-        _redis_pool = redis.ConnectionPool.from_url(settings.CELERY_BROKER_URL)
-    return redis.Redis(connection_pool=_redis_pool)
-
 # === Middleware ===
 
-_requests = defaultdict(list)
-
 async def auth(request: Request):
     if settings.API_KEY:
         if request.headers.get("Authorization", "").replace("Bearer ", "") != settings.API_KEY:
             raise HTTPException(401, "Invalid API key")
 
+def client_key(request: Request) -> str:
+    # Key by API key (not IP) - works correctly behind Cloudflare tunnel
+    # All tunnel traffic appears as same IP, so IP-based keys break
+    api_key = request.headers.get("Authorization", "").replace("Bearer ", "")
+    return api_key[:16] if api_key else request.client.host  # Fallback to IP if no key
+
 async def rate_limit(request: Request):
     if settings.RATE_LIMIT:
-        now = time.time()
-        # Rate limit by API key (not IP) - works correctly behind Cloudflare tunnel
-        # All tunnel traffic appears as same IP, so IP-based limiting breaks
-        api_key = request.headers.get("Authorization", "").replace("Bearer ", "")
-        key = api_key[:16] if api_key else request.client.host  # Fallback to IP if no key
-
-        _requests[key] = [t for t in _requests[key] if now - t < 60]
-        if len(_requests[key]) >= settings.RATE_LIMIT:
-            raise HTTPException(429, "Rate limit exceeded")
-        _requests[key].append(now)
+        decision = await ratelimit.check(client_key(request))
+        if decision is None:
+            return
+        if not decision.allowed:
+            raise HTTPException(429, "Rate limit exceeded", headers=decision.headers())
+        request.state.rate_limit = decision  # Headers added by the middleware in main.py, whatever response class
 
 # === Models ===
 
@@ -57,17 +65,61 @@ class InferRequest(BaseModel):
     stream: bool = False
     temperature: float = 0.7
     system: str = None
+    num_predict: int = None  # Cap on output tokens (/generate, /vision)
+    cache_mode: str = None  # None | "bypass" | "refresh"
+    hedge: bool = None      # /generate: race a second backend on a slow first token (None = HEDGE_ENABLED)
+    on_overload: str = None  # "reject" (503) | "async" (queue it, 202) - default ADMISSION_SYNC_OVERLOAD
 
 class StructuredRequest(BaseModel):
     prompt: str
     schema_: Dict
     model: str = None
+    cache_mode: str = None
+    hedge: bool = None
+    on_overload: str = None
     class Config:
         fields = {"schema_": "schema"}
 
 class AsyncTaskRequest(BaseModel):
     task_type: str  # generate, chat, vision, structured, extract
     payload: Dict[str, Any]
+    cache_mode: str = None  # Forwarded to the task unless set in payload
+    priority: str = None    # interactive | normal | batch | background (default: per API key)
+    deadline_s: float = None  # Drop the task if it hasn't run this many seconds after submit
+    webhook: str = None       # POSTed {task_id, status, result|error} when the task finishes
+
+class MapReduceRequest(BaseModel):
+    text: str
+    mode: str = "extract"       # extract (needs schema) | summarize
+    schema_: Dict = None
+    instruction: str = None     # Prepended to every chunk
+    model: str = None
+    chunk_tokens: int = None    # Default MAPREDUCE_CHUNK_TOKENS
+    overlap_tokens: int = None  # Default MAPREDUCE_OVERLAP_TOKENS
+    cache_mode: str = None
+    priority: str = None
+    deadline_s: float = None
+    webhook: str = None         # Called once, with the merged result
+    class Config:
+        fields = {"schema_": "schema"}
+
+class BatchStatusRequest(BaseModel):
+    task_ids: List[str]
+    since: int = None  # Cursor from a previous call (completion sequence number)
+
+class SessionCreateRequest(BaseModel):
+    model: str = None
+    system: str = None
+
+class SessionTurnRequest(BaseModel):
+    message: str
+    stream: bool = False
+    temperature: float = 0.7
+    num_predict: int = None
+
+class PrepareRequest(BaseModel):
+    models: List[str] = None  # Default: every configured model
+    pull: bool = True         # Pull models a host doesn't have
 
 # === Router ===
 
@@ -80,88 +132,535 @@ TASKS = {
     "structured": ("task.structured", settings.QUEUE_JSON),
     "extract": ("task.extract", settings.QUEUE_JSON),
     "vision": ("task.vision", settings.QUEUE_VISION),
+    "session_chat": ("task.session_chat", settings.QUEUE_GENERAL),
 }
 
 # === Sync Endpoints ===
 
 @router.get("/health")
-def health():
-    return client.health()
+async def health():
+    return await aclient.health()
+
+def _overloaded(verdict: admission.Verdict) -> HTTPException:
+    return HTTPException(503, f"Overloaded: predicted completion {verdict.predicted_s:.0f}s exceeds "
+                              f"{verdict.limit_s:.0f}s", headers={"Retry-After": str(verdict.retry_after)})
+
+async def _admit(request: Request, task_type: str, payload: dict, cache_mode: str, on_overload: str) -> Response | None:
+    """None if a sync call can finish within OLLAMA_TIMEOUT; else 503, or 202 with the task it was queued as."""
+    payload = {k: v for k, v in payload.items() if v is not None}
+    queue = TASKS[task_type][1]
+    model = payload.get("model") or settings.MODELS.get(queue)
+    verdict = await admission.acheck_sync(queue, model, backends.pool.in_flight(model), len(backends.pool.backends),
+                                          payload.get("num_predict"))
+    if verdict.admit:
+        metrics.ADMISSION.labels(queue, "admitted").inc()
+        return None
+    if (on_overload or settings.ADMISSION_SYNC_OVERLOAD) != "async":
+        metrics.ADMISSION.labels(queue, "rejected").inc()
+        raise _overloaded(verdict)
+    metrics.ADMISSION.labels(queue, "downgraded").inc()
+    task = await asyncio.to_thread(
+        submit_async, AsyncTaskRequest(task_type=task_type, payload=payload, cache_mode=cache_mode), request)
+    return JSONResponse({**task, "downgraded": True}, status_code=202)
 
 @router.post("/generate")
-def generate(req: InferRequest):
-    r = client.infer(prompt=req.prompt, task=req.task, model=req.model, images=req.images,
-                     stream=req.stream, temperature=req.temperature, system=req.system)
+async def generate(req: InferRequest, request: Request):
+    payload = {"prompt": req.prompt, "model": req.model or get_model(req.task), "images": req.images,
+               "temperature": req.temperature, "system": req.system, "stream": req.stream,
+               "num_predict": req.num_predict}
+    task_type = "vision" if req.images else "generate"
+    if not req.images:
+        payload["task"] = req.task  # task.vision sets its own
+    if deferred := await _admit(request, task_type, payload, req.cache_mode, req.on_overload):
+        return deferred
+    r = await aclient.infer(prompt=req.prompt, task=req.task, model=req.model, images=req.images,
+                            stream=req.stream, temperature=req.temperature, system=req.system,
+                            num_predict=req.num_predict, cache_mode=req.cache_mode, hedge=req.hedge)
     return StreamingResponse(r, media_type="text/event-stream") if req.stream else {"response": r}
 
 @router.post("/chat")
-def chat(req: InferRequest):
-    r = client.chat(messages=req.messages, model=req.model, stream=req.stream, system=req.system)
+async def chat(req: InferRequest, request: Request):
+    # Only a temperature the client sent: unset keeps the model's default (not cacheable, see client._cache_key)
+    temperature = req.temperature if "temperature" in req.model_fields_set else None
+    payload = {"messages": req.messages, "model": req.model, "system": req.system, "stream": req.stream,
+               "temperature": temperature}
+    if deferred := await _admit(request, "chat", payload, req.cache_mode, req.on_overload):
+        return deferred
+    r = await aclient.chat(messages=req.messages, model=req.model, stream=req.stream, system=req.system,
+                           temperature=temperature, cache_mode=req.cache_mode)
     return StreamingResponse(r, media_type="text/event-stream") if req.stream else {"response": r}
 
 @router.post("/vision")
-def vision(req: InferRequest):
-    return {"response": client.infer(prompt=req.prompt, task="vision", images=req.images, temperature=req.temperature)}
+async def vision(req: InferRequest, request: Request):
+    payload = {"prompt": req.prompt, "images": req.images, "temperature": req.temperature, "num_predict": req.num_predict}
+    if deferred := await _admit(request, "vision", payload, req.cache_mode, req.on_overload):
+        return deferred
+    return {"response": await aclient.infer(prompt=req.prompt, task="vision", images=req.images,
+                                            temperature=req.temperature, num_predict=req.num_predict,
+                                            cache_mode=req.cache_mode)}
 
 @router.post("/structured")
-def structured(req: StructuredRequest):
-    return client.structured(prompt=req.prompt, schema=req.schema_, model=req.model)
+async def structured(req: StructuredRequest, request: Request):
+    payload = {"prompt": req.prompt, "schema": req.schema_, "model": req.model}
+    if deferred := await _admit(request, "structured", payload, req.cache_mode, req.on_overload):
+        return deferred
+    return await aclient.structured(prompt=req.prompt, schema=req.schema_, model=req.model, cache_mode=req.cache_mode,
+                                    hedge=req.hedge)
+
+# === Chat Sessions ===
+
+@router.post("/sessions")
+async def create_session(req: SessionCreateRequest):
+    """Start a server-side chat session; send only new turns to /sessions/{id}/chat."""
+    session = sessions.new(model=req.model, system=req.system)
+    await sessions.asave(session)
+    return {"session_id": session["id"], "model": session["model"]}
+
+@router.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    if not (session := await sessions.aload(session_id)):
+        raise HTTPException(404, "Session not found")
+    return sessions.public(session)
+
+@router.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not await sessions.adelete(session_id):
+        raise HTTPException(404, "Session not found")
+    return {"session_id": session_id, "status": "deleted"}
+
+async def _save_after(session: dict, chunks, turn_lock):
+    try:
+        async for chunk in chunks:
+            yield chunk
+        await sessions.asave(session)
+    finally:
+        await sessions.aunlock(turn_lock)
+
+@router.post("/sessions/{session_id}/chat")
+async def session_chat(session_id: str, req: SessionTurnRequest):
+    turn_lock = sessions.alock(session_id)  # One turn at a time per session (see sessions.py)
+    if not await turn_lock.acquire():
+        raise HTTPException(409, "Session busy with another turn")
+    try:
+        if not (session := await sessions.aload(session_id)):
+            raise HTTPException(404, "Session not found")
+        r = await aclient.session_turn(session, req.message, stream=req.stream, temperature=req.temperature,
+                                       num_predict=req.num_predict)
+    except BaseException:
+        await sessions.aunlock(turn_lock)
+        raise
+    if req.stream:  # Released when the stream ends
+        return StreamingResponse(_save_after(session, r, turn_lock), media_type="text/event-stream")
+    try:
+        await sessions.asave(session)
+    finally:
+        await sessions.aunlock(turn_lock)
+    return {"session_id": session_id, "response": r}
 
 @router.post("/upload")
 async def upload(file: UploadFile = File(...)):
-    if file.size > settings.MAX_UPLOAD_SIZE:
+    """Store a file by content hash (re-uploads return the same path); images get a downscaled variant."""
+    if file.size and file.size > settings.MAX_UPLOAD_SIZE:
         raise HTTPException(413, "File too large")
     ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in [".jpg", ".jpeg", ".png", ".gif", ".webp", ".pdf"]:
+    if ext not in uploads.EXTENSIONS:
         raise HTTPException(400, "Unsupported file type")
-    path = os.path.join(settings.UPLOAD_DIR, f"{uuid.uuid4().hex}{ext}")
-    with open(path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-    return {"path": path}
+    try:
+        path, sha = await asyncio.to_thread(uploads.save, file.file, ext)
+    except uploads.TooLarge:
+        raise HTTPException(413, "File too large")
+    return {"path": path, "sha256": sha}
 
 # === Async Queue Endpoints ===
 
-@router.post("/async/submit")
-def submit_async(req: AsyncTaskRequest):
-    """Submit task to queue. Tasks run independently per queue."""
+def _task_call(req: AsyncTaskRequest) -> tuple[str, str, dict]:
     if req.task_type not in TASKS:
         raise HTTPException(400, f"Unknown task: {req.task_type}. Available: {list(TASKS.keys())}")
     task_name, queue = TASKS[req.task_type]
-    task = celery_app.send_task(task_name, kwargs=req.payload, queue=queue)
+    kwargs = {"cache_mode": req.cache_mode, **req.payload} if req.cache_mode else req.payload
+    return task_name, queue, kwargs
+
+def _send_options(req: AsyncTaskRequest, request: Request) -> dict:
+    """Broker priority, expiry and headers for one submission."""
+    cls = req.priority or settings.PRIORITY_OVERRIDES.get(client_key(request), settings.PRIORITY_DEFAULT)
+    if cls not in settings.PRIORITY_CLASSES:
+        raise HTTPException(400, f"Unknown priority: {cls}. Available: {list(settings.PRIORITY_CLASSES)}")
+    now = time.time()
+    opts = {"priority": settings.PRIORITY_CLASSES[cls], "headers": {"enqueued_at": now}}  # Queue wait metric
+    if req.deadline_s is not None:
+        if req.deadline_s <= 0:
+            raise HTTPException(400, "deadline_s must be positive")
+        opts["expires"] = req.deadline_s  # Broker-side: never delivered after the deadline
+        opts["headers"]["deadline"] = now + req.deadline_s  # Worker-side check (prefetch, retries)
+    if req.webhook:
+        if not events.webhook_allowed(req.webhook):
+            raise HTTPException(400, "Webhook must be an http(s) URL on an allowed host")
+        opts["headers"]["webhook"] = req.webhook
+    return opts
+
+def _coalescable(task_name: str, kwargs: dict) -> bool:
+    # A session turn changes the session: the same message twice is two turns
+    return settings.SINGLEFLIGHT_ENABLED and kwargs.get("cache_mode") != "bypass" and task_name != "task.session_chat"
+
+def _claim_options(req: AsyncTaskRequest, opts: dict) -> dict:
+    """Send options a coalesced submission must share with the task it joins."""
+    return {"priority": opts["priority"], "deadline_s": req.deadline_s, "webhook": req.webhook}
+
+def _task_response(task_id: str, state: str, result: Any) -> dict:
+    resp = {"task_id": task_id, "status": state}
+    if state == "SUCCESS":
+        resp["result"] = result
+    elif state == "FAILURE":
+        resp["error"] = str(result)
+    return resp
+
+def _states(task_ids: list[str]) -> dict[str, str]:
+    """Current state of each task in one MGET (PENDING if no result is stored yet)."""
+    if not task_ids:
+        return {}
+    backend = celery_app.backend
+    raw = backend.mget([backend.get_key_for_task(t) for t in task_ids])
+    return {t: backend.decode_result(v)["status"] if v else "PENDING" for t, v in zip(task_ids, raw)}
+
+@router.post("/async/submit")
+def submit_async(req: AsyncTaskRequest, request: Request):
+    """Submit task to queue. Tasks run independently per queue, highest priority class first."""
+    task_name, queue, kwargs = _task_call(req)
+    opts = _send_options(req, request)
+    # Before coalescing: a claim for a task that is then refused would capture identical submissions
+    verdict = admission.check_task(queue, kwargs.get("model"), kwargs.get("num_predict"), opts["priority"], req.deadline_s)
+    if not verdict.admit:
+        metrics.ADMISSION.labels(queue, "rejected").inc()
+        raise _overloaded(verdict)
+    metrics.ADMISSION.labels(queue, "admitted").inc()
+    task_id, claim = uuid.uuid4().hex, None
+    if _coalescable(task_name, kwargs):
+        claim = (task_name, kwargs, _claim_options(req, opts), task_id)
+        existing = singleflight.claim_task(*claim)
+        if existing != task_id:  # Identical submission already queued/running
+            return {"task_id": existing, "queue": queue, "status": AsyncResult(existing, app=celery_app).state, "coalesced": True}
+    queue_index.add([(queue, task_id, opts["priority"])])  # Index first so a fast worker's prerun can't race it
+    try:
+        task = celery_app.send_task(task_name, kwargs=kwargs, queue=queue, task_id=task_id, **opts)
+    except Exception:  # Never sent: don't count it in positions/admission or point identical submissions at it
+        queue_index.remove(task_id, queue)
+        if claim:
+            singleflight.release_tasks([claim])
+        raise
     return {"task_id": task.id, "queue": queue, "status": "PENDING"}
 
+@router.post("/async/submit_batch")
+def submit_batch(reqs: List[AsyncTaskRequest], request: Request):
+    """Submit many tasks at once; one broker connection for the whole batch."""
+    if len(reqs) > settings.MAX_BATCH_SIZE:
+        raise HTTPException(413, f"Batch too large (max {settings.MAX_BATCH_SIZE})")
+    calls = [(*_task_call(req), uuid.uuid4().hex) for req in reqs]  # Validate everything before enqueueing
+    opts = [_send_options(req, request) for req in reqs]
+
+    # Admission per task; earlier tasks of the batch count as queued ahead of later ones
+    rejected, batch_depth = {}, {}
+    for i, (req, (_, queue, kwargs, _)) in enumerate(zip(reqs, calls)):
+        verdict = admission.check_task(queue, kwargs.get("model"), kwargs.get("num_predict"), opts[i]["priority"],
+                                       req.deadline_s, batch_depth.get(queue, 0))
+        if verdict.admit:
+            batch_depth[queue] = batch_depth.get(queue, 0) + 1
+            metrics.ADMISSION.labels(queue, "admitted").inc()
+        else:
+            rejected[i] = verdict
+            metrics.ADMISSION.labels(queue, "rejected").inc()
+
+    coalesce = [i for i, (task_name, _, kwargs, _) in enumerate(calls)
+                if _coalescable(task_name, kwargs) and i not in rejected]
+    owners = singleflight.claim_tasks([(calls[i][0], calls[i][2], _claim_options(reqs[i], opts[i]), calls[i][3])
+                                       for i in coalesce])
+    existing = {i: owner for i, owner in zip(coalesce, owners) if owner != calls[i][3]}
+    states = _states(list(existing.values()))
+
+    queue_index.add([(queue, task_id, opts[i]["priority"]) for i, (_, queue, _, task_id) in enumerate(calls)
+                     if i not in existing and i not in rejected])
+    tasks, sent = [], set()
+    try:
+        with celery_app.producer_or_acquire() as producer:
+            for i, (task_name, queue, kwargs, task_id) in enumerate(calls):
+                if i in rejected:
+                    tasks.append({"task_id": None, "queue": queue, "status": "REJECTED", "retry_after": rejected[i].retry_after})
+                    continue
+                if i in existing:
+                    tasks.append({"task_id": existing[i], "queue": queue, "status": states[existing[i]], "coalesced": True})
+                    continue
+                celery_app.send_task(task_name, kwargs=kwargs, queue=queue, task_id=task_id, producer=producer, **opts[i])
+                sent.add(i)
+                tasks.append({"task_id": task_id, "queue": queue, "status": "PENDING"})
+    except Exception:
+        # Unsent tasks: drop their index entries (positions, admission) and claims (identical submissions)
+        for i, (_, queue, _, task_id) in enumerate(calls):
+            if i not in existing and i not in rejected and i not in sent:
+                queue_index.remove(task_id, queue)
+        singleflight.release_tasks([(calls[i][0], calls[i][2], _claim_options(reqs[i], opts[i]), calls[i][3])
+                                    for i in coalesce if i not in existing and i not in sent])
+        raise
+    return {"tasks": tasks, "submitted": len(tasks) - len(existing) - len(rejected), "coalesced": len(existing),
+            "rejected": len(rejected)}
+
+@router.post("/async/mapreduce")
+def submit_mapreduce(req: MapReduceRequest, request: Request):
+    """Split a long document into overlapping chunks, process them in parallel, merge the results.
+
+    Returns the job id: a task id for /async/status, /async/wait and webhooks
+    (merged result) and for /async/mapreduce/{job_id} (per-chunk progress).
+    """
+    if req.mode not in mapreduce.MODES:
+        raise HTTPException(400, f"Unknown mode: {req.mode}. Available: {list(mapreduce.MODES)}")
+    if req.mode == "extract" and not req.schema_:
+        raise HTTPException(400, "mode=extract needs a schema")
+    chunks = mapreduce.split(req.text, req.chunk_tokens, req.overlap_tokens)
+    if not chunks:
+        raise HTTPException(400, "Empty text")
+    if len(chunks) > settings.MAX_BATCH_SIZE:
+        raise HTTPException(413, f"Too many chunks ({len(chunks)}, max {settings.MAX_BATCH_SIZE})")
+    queue, opts = mapreduce.MODES[req.mode], _send_options(req, request)
+    verdict = admission.check_task(queue, req.model, None, opts["priority"], req.deadline_s, len(chunks) - 1)
+    if not verdict.admit:
+        metrics.ADMISSION.labels(queue, "rejected").inc()
+        raise _overloaded(verdict)
+    metrics.ADMISSION.labels(queue, "admitted").inc()
+
+    job_id = uuid.uuid4().hex
+    extra = {"cache_mode": req.cache_mode} if req.cache_mode else {}
+    webhook = opts["headers"].pop("webhook", None)
+    map_ids = [uuid.uuid4().hex for _ in chunks]
+    # No broker expiry on chunks: a revoked header task fails the whole chord. Past the
+    # deadline, map_chunk skips its work and reports the chunk failed (DeadlineTask).
+    chunk_opts = {k: v for k, v in opts.items() if k != "expires"}
+    header = [celery_app.signature("task.map_chunk", kwargs={
+        "job_id": job_id, "index": i, "chunk": chunk, "mode": req.mode, "schema": req.schema_,
+        "instruction": req.instruction, "model": req.model, **extra,
+    }, queue=queue, task_id=map_ids[i], **chunk_opts) for i, chunk in enumerate(chunks)]
+    body_opts = {**opts, "headers": {**opts["headers"], **({"webhook": webhook} if webhook else {})}}
+    body = celery_app.signature("task.reduce_chunks", kwargs={
+        "job_id": job_id, "mode": req.mode, "schema": req.schema_, "model": req.model,
+        "chunk_tokens": req.chunk_tokens, **extra,
+    }, queue=queue, task_id=job_id, **body_opts)
+
+    mapreduce.start(job_id, len(chunks))
+    queue_index.add([(queue, task_id, opts["priority"]) for task_id in map_ids])
+    chord(header)(body)
+    return {"task_id": job_id, "job_id": job_id, "queue": queue, "chunks": len(chunks), "status": "PENDING"}
+
+@router.get("/async/mapreduce/{job_id}")
+def mapreduce_progress(job_id: str):
+    """Per-chunk progress of a map-reduce job (pending / done / failed) and the merge step."""
+    if (progress := mapreduce.progress(job_id)) is None:
+        raise HTTPException(404, "Unknown job")
+    return progress
+
+def _consume(task_ids: list[str], consume: bool | None):
+    """Expire-on-fetch for results just returned (query ?consume=, default RESULT_EXPIRE_ON_FETCH)."""
+    if (settings.RESULT_EXPIRE_ON_FETCH if consume is None else consume) and task_ids \
+            and isinstance(celery_app.backend, result_store.CompactRedisBackend):
+        result_store.consume(celery_app.backend, task_ids)
+
 @router.get("/async/status/{task_id}")
-def get_status(task_id: str):
+def get_status(task_id: str, consume: bool = None):
     """Get task status and result."""
     r = AsyncResult(task_id, app=celery_app)
-    resp = {"task_id": task_id, "status": r.state}
-    if r.successful():
-        resp["result"] = r.result
-    elif r.failed():
-        resp["error"] = str(r.result)
+    resp = _task_response(task_id, r.state, r.result)
+    if r.state in ("SUCCESS", "FAILURE", "REVOKED"):
+        _consume([task_id], consume)
     return resp
 
+@router.post("/async/status_batch")
+def get_status_batch(req: BatchStatusRequest, consume: bool = None):
+    """Finished tasks among task_ids (one MGET), optionally only those done after `since`.
+
+    Pass the returned cursor as `since` on the next call to get only new
+    completions. The cursor is a server-side completion number (events.py), so
+    a task that finishes after the cursor advanced is always reported later.
+    """
+    backend = celery_app.backend
+    raw = backend.mget([backend.get_key_for_task(t) for t in req.task_ids]) if req.task_ids else []
+    seqs = events.sequence(req.task_ids) if req.task_ids else []
+    done, pending, cursor = [], 0, req.since or 0
+    for task_id, value, seq in zip(req.task_ids, raw, seqs):
+        meta = backend.decode_result(value) if value else None
+        if not meta or meta["status"] not in ("SUCCESS", "FAILURE", "REVOKED"):
+            pending += 1
+            continue
+        if req.since is not None:
+            if seq is None:  # Result stored, completion not numbered yet: report it once it is
+                pending += 1
+                continue
+            if seq <= req.since:
+                continue
+        done.append(_task_response(task_id, meta["status"], meta.get("result")))
+        cursor = max(cursor, seq or 0)
+    _consume([t["task_id"] for t in done], consume)
+    return {"tasks": done, "pending": pending, "cursor": cursor}
+
+# === Completion Notifications (see events.py) ===
+
+@router.get("/async/wait/{task_id}")
+async def wait_task(task_id: str, timeout: float = 30, consume: bool = None):
+    """Long-poll: returns as soon as the task finishes, or its current status after `timeout` seconds."""
+    queue = asyncio.Queue()
+    events.dispatcher.watch([task_id], queue)  # Before the state check, so a completion in between isn't missed
+    try:
+        status = await asyncio.to_thread(get_status, task_id, consume)
+        if status["status"] in events.FINAL_STATES:
+            return status
+        try:
+            await asyncio.wait_for(queue.get(), timeout=min(max(timeout, 0), settings.WAIT_MAX_TIMEOUT))
+        except asyncio.TimeoutError:
+            pass
+        return await asyncio.to_thread(get_status, task_id, consume)
+    finally:
+        events.dispatcher.unwatch([task_id], queue)
+
+# WebSockets can't use the Request/Response dependencies of `router`
+ws_router = APIRouter(prefix="/api/v1")
+
+async def _ws_rate_limited(ws: WebSocket, key: str) -> bool:
+    """Take a rate-limit token for a WebSocket client (keyed like client_key)."""
+    if not settings.RATE_LIMIT:
+        return False
+    decision = await ratelimit.check(key[:16] if key else ws.client.host)
+    return decision is not None and not decision.allowed
+
+@ws_router.websocket("/async/ws")
+async def task_events(ws: WebSocket):
+    """Completion notifications for many tasks over one connection.
+
+    Client sends {"subscribe": [ids]} / {"unsubscribe": [ids]}; the server sends
+    one status message (as /async/status) per task when it finishes - at once
+    for tasks that already have. Auth: Authorization header, or {"api_key": ...}
+    in the first message (never the query string - it ends up in access logs).
+    Connecting and each subscribe take a token from the caller's rate limit.
+    """
+    await ws.accept()
+    key, first = ws.headers.get("Authorization", "").replace("Bearer ", ""), None
+    try:
+        if not key and settings.API_KEY:
+            first = await ws.receive_json()
+            key = str(first.get("api_key", "")) if isinstance(first, dict) else ""
+    except (WebSocketDisconnect, ValueError):
+        return
+    if settings.API_KEY and key != settings.API_KEY:
+        await ws.close(code=4401)
+        return
+    if await _ws_rate_limited(ws, key):
+        await ws.close(code=4429)
+        return
+    queue, watched = asyncio.Queue(), set()
+
+    async def handle(msg):
+        lists = [msg.get(k, []) for k in ("unsubscribe", "subscribe")] if isinstance(msg, dict) else [None]
+        if not all(isinstance(v, list) and all(isinstance(t, str) for t in v) for v in lists):
+            await ws.send_json({"error": 'Expected {"subscribe": [task ids]} or {"unsubscribe": [task ids]}'})
+            return
+        if ids := msg.get("unsubscribe", []):
+            events.dispatcher.unwatch(ids, queue)
+            watched.difference_update(ids)
+        if ids := [t for t in dict.fromkeys(msg.get("subscribe", [])) if t not in watched]:
+            if len(watched) + len(ids) > settings.WS_MAX_SUBSCRIPTIONS:
+                await ws.send_json({"error": f"Too many subscriptions (max {settings.WS_MAX_SUBSCRIPTIONS})"})
+                return
+            if await _ws_rate_limited(ws, key):
+                await ws.send_json({"error": "Rate limit exceeded"})
+                return
+            events.dispatcher.watch(ids, queue)
+            watched.update(ids)
+            done = await asyncio.to_thread(get_status_batch, BatchStatusRequest(task_ids=ids), False)
+            for status in done["tasks"]:
+                queue.put_nowait({"task_id": status["task_id"], "status": status["status"]})
+
+    async def receive():
+        if first is not None:
+            await handle(first)
+        while True:
+            await handle(await ws.receive_json())
+
+    receiver = asyncio.create_task(receive())
+    try:
+        while True:
+            getter = asyncio.create_task(queue.get())
+            await asyncio.wait({receiver, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver.done():
+                getter.cancel()
+                receiver.result()  # Disconnect / bad message ends the connection
+            event = getter.result()
+            if event["task_id"] not in watched:
+                continue  # Unsubscribed, or already delivered
+            watched.discard(event["task_id"])
+            events.dispatcher.unwatch([event["task_id"]], queue)
+            await ws.send_json(await asyncio.to_thread(get_status, event["task_id"]))
+    except (WebSocketDisconnect, ValueError):
+        pass
+    finally:
+        receiver.cancel()
+        events.dispatcher.unwatch(list(watched), queue)
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _follow_tokens(task_id: str):
+    """Replay the task's token stream from the start, then follow it live."""
+    r, stream_key, last_id = get_async_redis(), token_stream.key(task_id), "0-0"
+    while True:
+        batch = await r.xread({stream_key: last_id}, count=200, block=settings.TOKEN_STREAM_HEARTBEAT_S * 1000)
+        if not batch:
+            # Task not streaming (or finished before its stream appeared) -> fall back to the final state
+            result = AsyncResult(task_id, app=celery_app)
+            if await asyncio.to_thread(result.ready):
+                yield _sse("result", _task_response(task_id, result.state, result.result))
+                return
+            yield ": keepalive\n\n"
+            continue
+        for entry_id, fields in batch[0][1]:
+            last_id = entry_id
+            if b"t" in fields:
+                yield _sse("token", fields[b"t"].decode())
+            elif b"reset" in fields:
+                yield _sse("reset", {})
+            elif b"error" in fields:
+                yield _sse("error", fields[b"error"].decode())
+                return
+            elif b"done" in fields:
+                yield _sse("done", {})
+                return
+
+@router.get("/async/stream/{task_id}")
+async def stream_task(task_id: str):
+    """SSE token stream for a task submitted with payload "stream": true.
+
+    Events: token (text), reset (task retried - discard text), done, error,
+    result (task had no token stream; final status payload).
+    """
+    return StreamingResponse(_follow_tokens(task_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @router.get("/async/stats")
 def get_stats():
-    """Queue statistics."""
-    r = get_redis()
-    return {q: {"pending": r.llen(q)} for q in [settings.QUEUE_GENERAL, settings.QUEUE_JSON, settings.QUEUE_VISION]}
+    """Queue statistics (pending per queue and priority class)."""
+    return {q: {"pending": sum(by_class.values()), "by_priority": by_class}
+            for q, by_class in queue_index.priority_depths().items()}
+
+@router.get("/cache/stats")
+def cache_stats():
+    """Response cache hit/miss counters (this process), shared tier size and semantic index sizes."""
+    return {**cache.stats(), "semantic": semantic_cache.stats()}
 
 @router.delete("/async/{task_id}")
 def cancel_task(task_id: str):
     """Cancel a pending or running task."""
     celery_app.control.revoke(task_id, terminate=True)
+    queue_index.remove(task_id)
     return {"task_id": task_id, "status": "cancelled"}
 
 @router.get("/async/position/{task_id}")
 def get_position(task_id: str):
-    """Get task position in queue."""
-    r = get_redis()
-    for queue in [settings.QUEUE_GENERAL, settings.QUEUE_JSON, settings.QUEUE_VISION]:
-        tasks = r.lrange(queue, 0, -1)
-        for i, task_data in enumerate(tasks):
-            if task_id.encode() in task_data:
-                return {"task_id": task_id, "queue": queue, "position": i + 1, "total": len(tasks)}
+    """Get task position in queue and estimated wait."""
+    if pos := queue_index.position(task_id):
+        return {"task_id": task_id, **pos}
     return {"task_id": task_id, "position": None, "status": "not_in_queue"}
 
 @router.get("/health/async")
@@ -174,3 +673,43 @@ def health_async():
         broker_ok = False
     workers = celery_app.control.inspect().ping() or {}
     return {"broker": "ok" if broker_ok else "down", "workers": len(workers)}
+
+# === Model Preparation ===
+
+@router.post("/models/prepare")
+def prepare_models(req: PrepareRequest):
+    """Pull and load models on every Ollama host in the background; follow with /models/progress."""
+    if not preload.start(req.models, pull=req.pull):
+        raise HTTPException(409, "Model preparation already running")
+    return {"started": True, "models": req.models or list(dict.fromkeys(settings.MODELS.values()))}
+
+async def _follow_progress(request: Request):
+    r, sent = get_async_redis(), {}
+    while not await request.is_disconnected():
+        raw = await r.hgetall(preload.PROGRESS_KEY)
+        if not raw:  # Expired or cleared while followed
+            yield _sse("done", {})
+            return
+        changed = {k: v for k, v in raw.items() if sent.get(k) != v}
+        if changed:
+            sent.update(changed)
+            yield _sse("progress", preload.progress(changed))
+        states = [json.loads(v)["phase"] for v in raw.values()]
+        if all(p in preload.FINAL_PHASES for p in states):
+            yield _sse("done", preload.progress(raw))
+            return
+        await asyncio.sleep(1)
+
+@router.get("/models/progress")
+def model_progress(request: Request, stream: bool = False):
+    """Pull/load state per host and model: phase (pulling, waiting, loading, ready, failed) and bytes pulled.
+
+    With ?stream=true: SSE "progress" events with changed entries, then "done"
+    (404 if no preparation has been recorded).
+    """
+    if stream:
+        if not get_redis().exists(preload.PROGRESS_KEY):
+            raise HTTPException(404, "No model preparation recorded")
+        return StreamingResponse(_follow_progress(request), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return preload.progress()
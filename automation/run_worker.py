@@ -3,7 +3,10 @@
 
 Usage: python run_worker.py [queue] [--no-warmup]
   queue: general|json|vision|all (default: all)
-  --no-warmup: Skip model warmup
+  --no-warmup: Skip model warmup (and start one combined worker for "all")
+
+Warmup pulls missing models and loads them on every Ollama host in parallel
+(preload.py); each queue's worker starts as soon as its own model is ready.
 
 Examples:
   python run_worker.py general
@@ -11,6 +14,7 @@ Examples:
 """
 import sys
 import os
+import signal
 import subprocess
 
 # Change to inference_engine directory (parent of automation/)
@@ -27,34 +31,65 @@ extra_args = [a for a in extra_args if a != "--no-warmup"]
 
 queues = "general,json,vision" if queue == "all" else queue
 
-# Warmup models
-if not skip_warmup:
-    print(f"Warming up models for queue: {queue}")
-    try:
-        from client import warmup
-        from config import settings
-        queue_models = {
-            "general": [settings.MODELS["general"]],
-            "json": [settings.MODELS["json"]],
-            "vision": [settings.MODELS["vision"]],
-            "all": list(settings.MODELS.values()),
-        }
-        models = queue_models.get(queue, [])
-        result = warmup(models)
-        for model, status in result.get("models", {}).items():
-            print(f"  {model}: {status}")
-    except Exception as e:
-        print(f"Warmup failed (continuing): {e}")
-
-# Start worker
-cmd = [
-    sys.executable, "-m", "celery",
-    "-A", "celery_app",
-    "worker",
-    "-Q", queues,
-    "-c", "1",
-    "--loglevel", "info",
-] + extra_args
-
-print(f"Starting worker for: {queues}")
-subprocess.run(cmd)
+from config import settings, get_concurrency
+
+
+def worker_cmd(queues: str, name: str = None) -> list[str]:
+    # Parallel slots: per-queue setting (or their sum for a combined worker)
+    concurrency = sum(get_concurrency(q) for q in queues.split(","))
+    print(f"Starting worker for: {queues} ({settings.WORKER_POOL} x {concurrency})")
+    return [
+        sys.executable, "-m", "celery",
+        "-A", "celery_app",
+        "worker",
+        "-Q", queues,
+        "-P", settings.WORKER_POOL,
+        "-c", str(concurrency),
+        "--loglevel", "info",
+    ] + (["-n", name] if name else []) + extra_args
+
+
+if skip_warmup:
+    subprocess.run(worker_cmd(queues))
+    sys.exit()
+
+# Pull/load models in parallel; each queue's worker starts as soon as its model is ready
+# (one worker process per queue, so "all" doesn't wait for the slowest model)
+import threading
+from preload import prepare
+
+procs: dict[str, subprocess.Popen] = {}
+procs_lock = threading.RLock()  # Re-entered if SIGTERM lands while the main thread starts a worker
+stopping = False
+
+
+def start_queues(model: str = None):
+    with procs_lock:
+        if stopping:  # A model that finishes after SIGTERM must not start a worker
+            return
+        for q in queues.split(","):
+            if q not in procs and (model is None or settings.MODELS[q] == model):
+                procs[q] = subprocess.Popen(worker_cmd(q, f"{q}@%h" if queue == "all" else None))
+
+
+def forward(signum, frame):
+    global stopping
+    with procs_lock:
+        stopping = True
+        if not procs:  # Still preparing: nothing to drain, don't wait for pulls to finish
+            print("Stopped during model preparation")
+            os._exit(0)
+        for p in procs.values():
+            p.send_signal(signum)  # Warm shutdown of every worker
+
+
+signal.signal(signal.SIGTERM, forward)  # Ctrl-C already reaches the whole process group
+
+print(f"Preparing models for queue: {queue}")
+models = [settings.MODELS[q] for q in queues.split(",")]
+result = prepare(models, on_ready=start_queues)
+for model, status in result["models"].items():
+    print(f"  {model}: {status}")
+start_queues()  # Queues whose model failed everywhere start anyway (requests fall back / fail per task)
+for p in list(procs.values()):
+    p.wait()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Autoscaling worker supervisor: worker processes per queue follow the backlog.
+
+Usage: python supervisor.py [--no-warmup]
+
+Models are pulled/loaded in parallel in the background (preload.py); a
+queue gets workers as soon as its model is ready.
+
+Every SUPERVISOR_INTERVAL_S it reads each queue's pending depth and average
+task duration (the data behind /async/stats and queue positions) and sizes
+the queue's worker pool so the backlog drains within SUPERVISOR_TARGET_WAIT_S:
+
+  wanted = ceil(depth * avg_task_s / (SUPERVISOR_TARGET_WAIT_S * slots per worker))
+
+clamped to SUPERVISOR_MIN_WORKERS / SUPERVISOR_MAX_WORKERS for the queue and
+to the backend's parallel capacity: queues running the same model share
+OLLAMA_NUM_PARALLEL slots per Ollama host, so a quiet queue retires workers
+and frees room for a busy one on that model. Capacity is counted in slots: a
+new worker runs WORKER_CONCURRENCY for its queue, or only the slots still free
+for its model (a minimum worker always gets at least one). A queue can only
+reach SUPERVISOR_MAX_WORKERS full-size workers if
+
+  SUPERVISOR_MAX_WORKERS * WORKER_CONCURRENCY (summed over the queues
+  sharing a model) <= OLLAMA_NUM_PARALLEL * number of OLLAMA_HOSTS
+
+which the defaults satisfy for one host with distinct models per queue, and
+for the minimum workers when general and json share a model. It moves one worker per queue
+per step, at most every SUPERVISOR_UP_COOLDOWN_S up and
+SUPERVISOR_DOWN_COOLDOWN_S down. Crashed workers are replaced.
+
+Retiring a worker sends SIGTERM (Celery warm shutdown): it stops consuming,
+finishes and acks its running tasks, and its prefetched, unacked messages go
+back to the broker (acks_late). It is killed after SUPERVISOR_DRAIN_TIMEOUT_S;
+task_reject_on_worker_lost requeues anything still running. Draining workers
+keep counting against capacity until they exit. SIGTERM/SIGINT to the
+supervisor drains every worker and exits.
+"""
+import sys
+import os
+import math
+import time
+import signal
+import threading
+import subprocess
+
+# Change to inference_engine directory (parent of automation/)
+os.chdir(os.path.expanduser("~/inference_engine"))
+sys.path.insert(0, os.getcwd())
+
+import redis
+from config import settings, get_concurrency, get_logger
+import queue_index
+import preload
+from redis_pool import get_redis
+
+log = get_logger("supervisor")
+
+QUEUES = queue_index.QUEUES
+
+
+class Worker:
+    def __init__(self, queue: str, index: int, slots: int):
+        self.queue = queue
+        self.slots = slots
+        self.name = f"{queue}-{index}@%h"
+        self.proc = subprocess.Popen([
+            sys.executable, "-m", "celery",
+            "-A", "celery_app",
+            "worker",
+            "-Q", queue,
+            "-P", settings.WORKER_POOL,
+            "-c", str(self.slots),
+            "-n", self.name,
+            "--loglevel", "info",
+        ])
+        self.retired_at = None
+
+    def retire(self):
+        self.retired_at = time.time()
+        self.proc.send_signal(signal.SIGTERM)  # Warm shutdown: finish running tasks, return prefetched ones
+
+    def reap(self) -> bool:
+        """True once the process has exited (killing it if its drain took too long)."""
+        if self.proc.poll() is not None:
+            return True
+        if self.retired_at and time.time() - self.retired_at > settings.SUPERVISOR_DRAIN_TIMEOUT_S:
+            log.warning(f"{self.name} still draining after {settings.SUPERVISOR_DRAIN_TIMEOUT_S}s, killing")
+            self.proc.kill()
+        return False
+
+
+class Supervisor:
+    def __init__(self, ready: set[str] = None):
+        self.ready = set(QUEUES) if ready is None else ready  # Queues whose model is prepared
+        self.active: dict[str, list[Worker]] = {q: [] for q in QUEUES}
+        self.draining: list[Worker] = []
+        self.last_change = {q: 0.0 for q in QUEUES}
+        self.counter = 0
+        self.stopping = False
+
+    # === Sizing ===
+
+    def _capacity(self) -> dict[str, int]:
+        """Free backend slots per model (OLLAMA_NUM_PARALLEL per host, minus active and draining workers)."""
+        free = {settings.MODELS[q]: settings.OLLAMA_NUM_PARALLEL * len(settings.OLLAMA_HOSTS) for q in QUEUES}
+        for w in [w for ws in self.active.values() for w in ws] + self.draining:
+            free[settings.MODELS[w.queue]] -= w.slots
+        return free
+
+    def _wanted(self, queue: str, depth: int, avg: float | None) -> int:
+        bounds = settings.SUPERVISOR_MIN_WORKERS.get(queue, 1), settings.SUPERVISOR_MAX_WORKERS.get(queue, 1)
+        if depth and avg is None:
+            wanted = len(self.active[queue]) + 1  # Backlog but no history yet: grow until tasks finish
+        else:
+            wanted = math.ceil(depth * (avg or 0) / (settings.SUPERVISOR_TARGET_WAIT_S * get_concurrency(queue)))
+        return max(bounds[0], min(bounds[1], wanted))
+
+    def step(self):
+        queues = [q for q in QUEUES if q in self.ready]
+        for q in queues:
+            while len(self.active[q]) < settings.SUPERVISOR_MIN_WORKERS.get(q, 1):
+                self._spawn(q, self._capacity()[settings.MODELS[q]])
+        try:
+            r = get_redis()
+            depths, avgs = queue_index.depths(r), queue_index.average_durations(r)
+        except redis.RedisError as e:
+            log.warning(f"Queue stats unavailable, keeping current layout: {e}")
+            return
+        now = time.time()
+        # Scale down first so freed capacity is available to queues scaling up this round
+        plan = {q: self._wanted(q, depths[q], avgs[q]) - len(self.active[q]) for q in queues}
+        for q in sorted(queues, key=lambda q: plan[q]):
+            workers = self.active[q]
+            if plan[q] < 0 and now - self.last_change[q] >= settings.SUPERVISOR_DOWN_COOLDOWN_S:
+                w = workers.pop()
+                w.retire()
+                self.draining.append(w)
+                self.last_change[q] = now
+                log.info(f"{q}: retiring {w.name} (depth {depths[q]}, {len(workers)} left)")
+            elif plan[q] > 0 and now - self.last_change[q] >= settings.SUPERVISOR_UP_COOLDOWN_S:
+                free = self._capacity()[settings.MODELS[q]]
+                if free < 1:
+                    log.debug(f"{q}: backlog {depths[q]} but {settings.MODELS[q]} has no free backend slots")
+                    continue
+                self._spawn(q, free)
+                self.last_change[q] = now
+                log.info(f"{q}: started {workers[-1].name} with {workers[-1].slots} slots "
+                         f"(depth {depths[q]}, {len(workers)} running)")
+
+    def _spawn(self, queue: str, free: int):
+        """Start a worker for queue with its configured concurrency, capped at free backend slots (at least one)."""
+        slots = max(1, min(get_concurrency(queue), free))
+        self.counter += 1
+        self.active[queue].append(Worker(queue, self.counter, slots))
+
+    # === Process management ===
+
+    def reap(self):
+        self.draining = [w for w in self.draining if not w.reap()]
+        for q, workers in self.active.items():
+            for w in [w for w in workers if w.proc.poll() is not None]:
+                log.warning(f"{w.name} exited with {w.proc.returncode}, replacing it")
+                workers.remove(w)
+                self._spawn(q, self._capacity()[settings.MODELS[q]])
+
+    def model_ready(self, model: str):
+        self.ready.update(q for q in QUEUES if settings.MODELS[q] == model)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        while not self.stopping:
+            self.reap()
+            self.step()
+            time.sleep(settings.SUPERVISOR_INTERVAL_S)
+        self.shutdown()
+
+    def _stop(self, *_):
+        self.stopping = True
+
+    def shutdown(self):
+        log.info("Draining all workers")
+        for workers in self.active.values():
+            for w in workers:
+                w.retire()
+                self.draining.append(w)
+            workers.clear()
+        while self.draining:
+            self.draining = [w for w in self.draining if not w.reap()]
+            time.sleep(1)
+
+
+def prepare_models(supervisor: Supervisor):
+    try:
+        result = preload.prepare(list(settings.MODELS.values()), on_ready=supervisor.model_ready)
+        for model, status in result["models"].items():
+            log.info(f"{model}: {status}")
+    except Exception as e:
+        log.warning(f"Warmup failed (continuing): {e}")
+    supervisor.ready.update(QUEUES)  # Start the rest anyway: their tasks fall back or fail individually
+
+
+if __name__ == "__main__":
+    if "--no-warmup" in sys.argv[1:]:
+        Supervisor().run()
+    else:
+        supervisor = Supervisor(ready=set())
+        threading.Thread(target=prepare_models, args=(supervisor,), name="preload", daemon=True).start()
+        supervisor.run()
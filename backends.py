@@ -0,0 +1,220 @@
+"""Ollama backend pool: routing, health tracking and circuit breaking.
+
+Each call goes to the usable host with the lowest score: requests in flight
+there, plus BACKEND_LOAD_PENALTY if the model isn't loaded on it (a model load
+costs about that many queued requests). Hosts that don't have the model
+pulled are skipped while any host has it.
+
+Health:
+  - active: a probe thread reads /api/tags and /api/ps from every host each
+    BACKEND_PROBE_S; unreachable hosts are skipped until a probe succeeds;
+  - passive: transport errors and 502/503/504 feed a per-host breaker that
+    opens after BREAKER_FAILURES consecutive failures or an error rate of
+    BREAKER_ERROR_RATE over the last BREAKER_WINDOW calls. After
+    BREAKER_COOLDOWN_S one trial request is let through (half-open) and its
+    outcome closes or re-opens the breaker.
+
+Shared by client.py (worker threads) and aclient.py (event loop); state
+changes are short critical sections under one lock.
+"""
+import os
+import time
+import random
+import threading
+import weakref
+from collections import deque
+import requests
+from config import settings, get_logger
+import metrics
+
+log = get_logger("backends")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+HOST_ERRORS = (502, 503, 504)
+
+class NoBackendAvailable(Exception):
+    """Every Ollama host is unreachable, has an open breaker or was already tried."""
+
+class Backend:
+    def __init__(self, host: str):
+        self.host = host
+        self.outstanding = 0
+        self.by_model: dict[str, int] = {}  # Outstanding calls per model
+        self.reachable = True
+        self.installed: set[str] = set()
+        self.loaded: set[str] = set()
+        self.results = deque(maxlen=settings.BREAKER_WINDOW)
+        self.failures = 0  # Consecutive
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial = False
+
+    def usable(self, now: float) -> bool:
+        if not self.reachable:
+            return False
+        if self.state == OPEN:
+            return now - self.opened_at >= settings.BREAKER_COOLDOWN_S
+        if self.state == HALF_OPEN:
+            return not self.trial
+        return True
+
+    def score(self, model: str) -> float:
+        return self.outstanding + (0 if model in self.loaded else settings.BACKEND_LOAD_PENALTY)
+
+    def status(self) -> dict:
+        return {"host": self.host, "state": self.state, "reachable": self.reachable, "outstanding": self.outstanding,
+                "loaded": sorted(self.loaded), "error_rate": round(self.results.count(False) / len(self.results), 2)
+                if self.results else 0.0}
+
+class Pool:
+    def __init__(self, hosts: list[str]):
+        self.backends = [Backend(h) for h in hosts]
+        self._lock = threading.Lock()
+        self._prober_pid = None
+        self._probe_session = requests.Session()
+
+    # === Routing ===
+
+    def _acquire(self, model: str, exclude: set[str]) -> Backend | None:
+        now = time.time()
+        with self._lock:
+            usable = [b for b in self.backends if b.host not in exclude and b.usable(now)]
+            if not usable:
+                return None
+            having = [b for b in usable if model in b.installed]
+            b = min(having or usable, key=lambda b: (b.score(model), random.random()))
+            if b.state == OPEN:
+                b.state = HALF_OPEN  # Cooldown over: this request is the trial
+            if b.state == HALF_OPEN:
+                b.trial = True
+            b.outstanding += 1
+            b.by_model[model] = b.by_model.get(model, 0) + 1
+        metrics.BACKEND_OUTSTANDING.labels(b.host).inc()
+        return b
+
+    def attempts(self, model: str, tried: set[str] = None):
+        """Backends to try in order, each already acquired (release it); ends when no untried host is usable.
+
+        Hosts in `tried` are skipped and every host handed out is added to it.
+        """
+        self._ensure_prober()
+        tried = set() if tried is None else tried
+        while (b := self._acquire(model, tried)) is not None:
+            tried.add(b.host)
+            yield b
+
+    def release(self, b: Backend, model: str):
+        with self._lock:
+            b.outstanding -= 1
+            if (n := b.by_model.get(model, 0) - 1) > 0:
+                b.by_model[model] = n
+            else:
+                b.by_model.pop(model, None)
+        metrics.BACKEND_OUTSTANDING.labels(b.host).dec()
+
+    def abandon(self, b: Backend, model: str):
+        """Release a call that ended without an outcome (cancelled), freeing a half-open trial slot."""
+        with self._lock:
+            b.trial = False
+        self.release(b, model)
+
+    def hold(self, response, b: Backend, model: str):
+        """Keep b's slot until a streamed response is closed (or garbage-collected unread)."""
+        response.release_backend = weakref.finalize(response, self.release, b, model)
+
+    def in_flight(self, model: str) -> int:
+        """Calls outstanding for model across all hosts (this process)."""
+        with self._lock:
+            return sum(b.by_model.get(model, 0) for b in self.backends)
+
+    # === Health ===
+
+    def finish(self, b: Backend, status: int | None, model: str) -> bool:
+        """Record a call's outcome (status None = transport error); True if another host should be tried."""
+        if status is None or status in HOST_ERRORS:
+            self._record(b, False)
+            return True
+        if status == 404:  # Model not pulled on this host
+            with self._lock:
+                b.installed.discard(model)
+                b.trial = False
+            return True
+        if status >= 500:  # Request-specific error (bad input, OOM): try elsewhere, host isn't at fault
+            with self._lock:
+                b.trial = False
+            return True
+        self._record(b, True)
+        with self._lock:
+            b.installed.add(model)
+            b.loaded.add(model)  # Loaded there now, until the next probe says otherwise
+        return False
+
+    def _record(self, b: Backend, ok: bool):
+        with self._lock:
+            b.results.append(ok)
+            if ok:
+                b.failures = 0
+                if b.state != CLOSED:
+                    log.info(f"{b.host} recovered, breaker closed")
+                    b.results.clear()
+                b.state, b.trial = CLOSED, False
+                return
+            b.failures += 1
+            errors = b.results.count(False)
+            tripped = b.failures >= settings.BREAKER_FAILURES or (
+                len(b.results) * 2 >= b.results.maxlen and errors / len(b.results) >= settings.BREAKER_ERROR_RATE)
+            if b.state == HALF_OPEN or (b.state == CLOSED and tripped):
+                b.state, b.opened_at, b.trial = OPEN, time.time(), False
+                log.warning(f"{b.host} breaker open ({b.failures} consecutive failures, {errors}/{len(b.results)} recent)")
+                metrics.BREAKER_TRIPS.labels(b.host).inc()
+
+    def probe(self, b: Backend):
+        try:
+            tags = self._probe_session.get(f"{b.host}/api/tags", timeout=2)
+            ps = self._probe_session.get(f"{b.host}/api/ps", timeout=2)
+            installed = {m["name"] for m in tags.json().get("models", [])}
+            loaded = {m["name"] for m in ps.json().get("models", [])}
+        except (requests.RequestException, ValueError) as e:
+            if b.reachable:
+                log.warning(f"{b.host} unreachable: {e}")
+            b.reachable = False
+            return
+        with self._lock:
+            if not b.reachable:
+                log.info(f"{b.host} reachable again")
+            b.reachable, b.installed, b.loaded = True, installed, loaded
+
+    def _probe_loop(self):
+        while True:
+            for b in self.backends:
+                self.probe(b)
+            time.sleep(settings.BACKEND_PROBE_S)
+
+    def _ensure_prober(self):
+        # Per process: threads don't survive a prefork fork
+        if self._prober_pid == os.getpid():
+            return
+        with self._lock:
+            if self._prober_pid == os.getpid():
+                return
+            self._prober_pid = os.getpid()
+        threading.Thread(target=self._probe_loop, name="backend-prober", daemon=True).start()
+
+    def status(self) -> list[dict]:
+        with self._lock:
+            return [b.status() for b in self.backends]
+
+pool = Pool(settings.OLLAMA_HOSTS)
+
+def done(response):
+    """Release the backend slot held by a streamed response."""
+    if release := getattr(response, "release_backend", None):
+        release()
+
+def model_label(model: str | None) -> str:
+    """Metric label for a model: configured or installed on a host, else "other" (callers pick model names)."""
+    if not model:
+        return "unknown"
+    if model in settings.MODELS.values() or model == settings.SEMANTIC_CACHE_EMBED_MODEL:
+        return model
+    return model if any(model in b.installed for b in pool.backends) else "other"
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Stand-in Ollama server for benchmarks.
+
+Implements /api/generate, /api/chat, /api/tags, /api/ps (and /api/embed,
+/api/pull as no-ops) with configurable time-to-first-token, decode speed and
+failure injection. Responses carry the same timing fields Ollama returns
+(eval_count, eval_duration, load_duration, prompt_eval_duration).
+
+Usage: python bench/mock_ollama.py [--port 11435] [--ttft 0.3] [--tps 40]
+                                   [--tokens 200] [--fail-rate 0.0] [--load 0.0]
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Mock Ollama")
+cfg = argparse.Namespace(ttft=0.3, tps=40.0, tokens=200, fail_rate=0.0, load=0.0, models=[])
+_loaded: set[str] = set()
+
+WORD = "lorem "
+
+def _timings(model: str, n: int, load_s: float, started: float) -> dict:
+    total = time.time() - started
+    return {
+        "model": model, "done": True, "done_reason": "stop",
+        "total_duration": int(total * 1e9), "load_duration": int(load_s * 1e9),
+        "prompt_eval_count": 32, "prompt_eval_duration": int(cfg.ttft * 1e9),
+        "eval_count": n, "eval_duration": int(n / cfg.tps * 1e9),
+    }
+
+async def _respond(body: dict, key: str):
+    model = body.get("model", "mock")
+    started = time.time()
+    if random.random() < cfg.fail_rate:
+        return JSONResponse({"error": "injected failure"}, status_code=500)
+    load_s = 0.0 if model in _loaded else cfg.load  # Cold model pays the load once
+    _loaded.add(model)
+    n = min(int(body.get("options", {}).get("num_predict") or cfg.tokens), cfg.tokens)
+    fmt = body.get("format")
+    text = [json.dumps({"result": "ok"})] if fmt else [WORD] * n
+    n = len(text)
+
+    def chunk(t: str) -> dict:
+        return {"model": model, key: t if key == "response" else {"role": "assistant", "content": t}, "done": False}
+
+    if not body.get("stream", True):
+        await asyncio.sleep(load_s + cfg.ttft + n / cfg.tps)
+        final = chunk("".join(text))
+        final.update(_timings(model, n, load_s, started))
+        if key == "response":
+            final["context"] = list(range(len(body.get("context") or []) + 32 + n))
+        return JSONResponse(final)
+
+    async def stream():
+        await asyncio.sleep(load_s + cfg.ttft)
+        for t in text:
+            yield json.dumps(chunk(t)) + "\n"
+            await asyncio.sleep(1 / cfg.tps)
+        final = chunk("")
+        final.update(_timings(model, n, load_s, started))
+        yield json.dumps(final) + "\n"
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    return await _respond(await request.json(), "response")
+
+@app.post("/api/chat")
+async def chat(request: Request):
+    return await _respond(await request.json(), "message")
+
+@app.post("/api/embed")
+async def embed(request: Request):
+    body = await request.json()
+    inputs = body.get("input") if isinstance(body.get("input"), list) else [body.get("input", "")]
+    return {"model": body.get("model"), "embeddings": [[random.random() for _ in range(64)] for _ in inputs]}
+
+@app.post("/api/pull")
+async def pull(request: Request):
+    return {"status": "success"}
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [{"name": m} for m in cfg.models]}
+
+@app.get("/api/ps")
+async def ps():
+    return {"models": [{"name": m, "size_vram": 8 * 10**9} for m in sorted(_loaded)]}
+
+def main(argv=None):
+    import uvicorn
+    from config import settings
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=11435)
+    p.add_argument("--ttft", type=float, default=0.3, help="Seconds to first token")
+    p.add_argument("--tps", type=float, default=40.0, help="Decode tokens per second")
+    p.add_argument("--tokens", type=int, default=200, help="Tokens per response (capped by num_predict)")
+    p.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    p.add_argument("--load", type=float, default=0.0, help="Extra seconds on a model's first request")
+    args = p.parse_args(argv)
+    vars(cfg).update(vars(args), models=list(settings.MODELS.values()))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    import os, sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main()
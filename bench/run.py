@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""Load-test harness for the inference API.
+
+Starts the mock Ollama backend, the API (main.app) and optionally Celery
+workers against it, drives a weighted request mix at fixed concurrency and
+writes latency percentiles, TTFT, throughput and queue wait per path as JSON.
+Redis must already be running (CELERY_BROKER_URL). The local stack runs with
+rate limiting, caching, coalescing and admission control off; against a
+--target deployment, admission 503s are counted as "rejected", not errors.
+
+Scenarios:
+  sync        POST /generate                     latency
+  stream      POST /generate (stream)            TTFT + latency
+  structured  POST /structured                   latency
+  async       /async/submit -> position -> status  queue wait + end-to-end latency
+
+Usage:
+  python bench/run.py --requests 500 --concurrency 32 --mix sync=4,stream=3,structured=1,async=2
+  python bench/run.py --target http://localhost:5000 --no-mock   # existing deployment
+  python bench/run.py --compare bench_results/previous.json      # print deltas vs an earlier run
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import argparse
+import statistics
+import subprocess
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import settings
+
+SCHEMA = {"type": "object", "properties": {"result": {"type": "string"}}, "required": ["result"]}
+
+# === Scenarios: each returns {"latency": s, "ttft": s?, "queue_wait": s?} ===
+
+async def run_sync(c: httpx.AsyncClient, i: int, args) -> dict:
+    t0 = time.perf_counter()
+    r = await c.post("/api/v1/generate", json={"prompt": f"bench {i}", "num_predict": args.num_predict, "cache_mode": "bypass"})
+    r.raise_for_status()
+    return {"latency": time.perf_counter() - t0}
+
+async def run_stream(c: httpx.AsyncClient, i: int, args) -> dict:
+    t0, ttft = time.perf_counter(), None
+    async with c.stream("POST", "/api/v1/generate", json={"prompt": f"bench {i}", "stream": True,
+                                                          "num_predict": args.num_predict, "cache_mode": "bypass"}) as r:
+        r.raise_for_status()
+        async for chunk in r.aiter_text():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - t0
+    return {"latency": time.perf_counter() - t0, "ttft": ttft}
+
+async def run_structured(c: httpx.AsyncClient, i: int, args) -> dict:
+    t0 = time.perf_counter()
+    r = await c.post("/api/v1/structured", json={"prompt": f"bench {i}", "schema": SCHEMA, "cache_mode": "bypass"})
+    r.raise_for_status()
+    if not r.json().get("success"):
+        raise RuntimeError(r.json().get("error", "structured failed"))
+    return {"latency": time.perf_counter() - t0}
+
+async def run_async(c: httpx.AsyncClient, i: int, args) -> dict:
+    t0, queue_wait = time.perf_counter(), None
+    r = await c.post("/api/v1/async/submit", json={
+        "task_type": "generate", "cache_mode": "bypass",
+        "payload": {"prompt": f"bench {i}", "num_predict": args.num_predict},
+    })
+    r.raise_for_status()
+    task_id = r.json()["task_id"]
+    deadline = t0 + args.async_timeout
+    while time.perf_counter() < deadline:
+        if queue_wait is None:
+            pos = (await c.get(f"/api/v1/async/position/{task_id}")).json()
+            if pos.get("position") is None:
+                queue_wait = time.perf_counter() - t0
+        status = (await c.get(f"/api/v1/async/status/{task_id}")).json()
+        if status["status"] == "SUCCESS":
+            return {"latency": time.perf_counter() - t0, "queue_wait": queue_wait or time.perf_counter() - t0}
+        if status["status"] in ("FAILURE", "REVOKED"):
+            raise RuntimeError(status.get("error", status["status"]))
+        await asyncio.sleep(args.poll)
+    raise TimeoutError(f"task {task_id} not done after {args.async_timeout}s")
+
+SCENARIOS = {"sync": run_sync, "stream": run_stream, "structured": run_structured, "async": run_async}
+
+# === Driver ===
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "p50_ms": round(pick(0.50) * 1000, 1), "p95_ms": round(pick(0.95) * 1000, 1),
+        "p99_ms": round(pick(0.99) * 1000, 1), "mean_ms": round(statistics.fmean(values) * 1000, 1),
+        "max_ms": round(values[-1] * 1000, 1),
+    }
+
+async def drive(args, mix: dict[str, int]) -> dict:
+    names = [n for n, w in mix.items() for _ in range(w)]
+    samples = {n: [] for n in mix}
+    errors = {n: [] for n in mix}
+    rejected = {n: 0 for n in mix}  # 503 from admission control (--target deployments): load shed, not a failure
+    sem = asyncio.Semaphore(args.concurrency)
+    headers = {"Authorization": f"Bearer {args.api_key}"} if args.api_key else {}
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.target, headers=headers, timeout=args.async_timeout, limits=limits) as c:
+        async def one(i: int):
+            name = random.choice(names)
+            async with sem:
+                try:
+                    samples[name].append(await SCENARIOS[name](c, i, args))
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code == 503:
+                        rejected[name] += 1
+                    else:
+                        errors[name].append(f"{type(e).__name__}: {e}"[:200])
+                except Exception as e:
+                    errors[name].append(f"{type(e).__name__}: {e}"[:200])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - started
+
+    report = {}
+    for name in mix:
+        s = samples[name]
+        report[name] = {
+            "ok": len(s), "errors": len(errors[name]), "rejected": rejected[name], "error_samples": errors[name][:5],
+            "throughput_rps": round(len(s) / elapsed, 2),
+            "latency": percentiles([x["latency"] for x in s]),
+        }
+        for metric in ("ttft", "queue_wait"):
+            if values := [x[metric] for x in s if x.get(metric) is not None]:
+                report[name][metric] = percentiles(values)
+    return {"elapsed_s": round(elapsed, 2), "throughput_rps": round(sum(len(v) for v in samples.values()) / elapsed, 2),
+            "scenarios": report}
+
+# === Process management ===
+
+def spawn(cmd: list[str], env: dict, name: str) -> subprocess.Popen:
+    log = open(os.path.join(ROOT, "bench_results", f"{name}.log"), "w")
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+def wait_http(url: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+    raise RuntimeError(f"{url} did not come up")
+
+def start_stack(args) -> list[subprocess.Popen]:
+    procs = []
+    env = {**os.environ, "RATE_LIMIT": "0", "CACHE_ENABLED": "false", "SINGLEFLIGHT_ENABLED": "false",
+           "ADMISSION_ENABLED": "false"}
+    if not args.no_mock:
+        procs.append(spawn([sys.executable, "bench/mock_ollama.py", "--port", str(args.mock_port),
+                            "--ttft", str(args.ttft), "--tps", str(args.tps), "--tokens", str(args.tokens),
+                            "--fail-rate", str(args.fail_rate), "--load", str(args.load)], env, "mock_ollama"))
+        env["OLLAMA_HOST"] = f"http://127.0.0.1:{args.mock_port}"
+        env["OLLAMA_HOSTS"] = env["OLLAMA_HOST"]  # The backend pool reads this one: never load real hosts
+        wait_http(f"{env['OLLAMA_HOST']}/api/tags")
+    if args.target is None:
+        port = args.api_port
+        procs.append(spawn([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                            "--workers", str(args.api_workers), "--log-level", "warning"], env, "api"))
+        args.target = f"http://127.0.0.1:{port}"
+        wait_http(f"{args.target}/api/v1/health")
+    if args.workers:
+        procs.append(spawn([sys.executable, "-m", "celery", "-A", "celery_app", "worker", "-Q", "general,json,vision",
+                            "-P", args.pool, "-c", str(args.workers), "--loglevel", "warning"], env, "worker"))
+        time.sleep(3)  # Let the worker register with the broker
+    return procs
+
+def stop_stack(procs: list[subprocess.Popen]):
+    for p in procs:
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for p in procs:
+        try:
+            p.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            os.killpg(p.pid, signal.SIGKILL)
+
+# === Reporting ===
+
+def compare(current: dict, baseline: dict):
+    print(f"{'scenario':<12}{'metric':<12}{'baseline p95':>14}{'current p95':>14}{'delta':>10}")
+    for name, cur in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for metric in ("latency", "ttft", "queue_wait"):
+            b, c = base.get(metric, {}).get("p95_ms"), cur.get(metric, {}).get("p95_ms")
+            if b and c:
+                print(f"{name:<12}{metric:<12}{b:>14.1f}{c:>14.1f}{(c - b) / b * 100:>9.1f}%")
+    b, c = baseline.get("throughput_rps"), current.get("throughput_rps")
+    if b and c:
+        print(f"{'total':<12}{'rps':<12}{b:>14.2f}{c:>14.2f}{(c - b) / b * 100:>9.1f}%")
+
+def parse_mix(text: str) -> dict[str, int]:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name!r}; choose from {list(SCENARIOS)}")
+        mix[name] = int(weight or 1)
+    return mix
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Inference API load test")
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--mix", default="sync=4,stream=3,structured=1,async=2")
+    p.add_argument("--target", help="Existing API base URL (default: start main.app locally)")
+    p.add_argument("--api-key", default=os.getenv("API_KEY", ""))
+    p.add_argument("--api-port", type=int, default=5055)
+    p.add_argument("--api-workers", type=int, default=1)
+    p.add_argument("--workers", type=int, default=8, help="Celery worker slots to start (0 = none)")
+    p.add_argument("--pool", default=settings.WORKER_POOL, help="Celery pool for the worker (default: WORKER_POOL)")
+    p.add_argument("--no-mock", action="store_true", help="Use the OLLAMA_HOST from the environment")
+    p.add_argument("--mock-port", type=int, default=11435)
+    p.add_argument("--ttft", type=float, default=0.3)
+    p.add_argument("--tps", type=float, default=40.0)
+    p.add_argument("--tokens", type=int, default=100)
+    p.add_argument("--fail-rate", type=float, default=0.0)
+    p.add_argument("--load", type=float, default=0.0)
+    p.add_argument("--num-predict", type=int, default=100)
+    p.add_argument("--poll", type=float, default=0.1, help="Async status poll interval")
+    p.add_argument("--async-timeout", type=float, default=300)
+    p.add_argument("--out", help="Result file (default: bench_results/<timestamp>.json)")
+    p.add_argument("--compare", help="Earlier result file to diff against")
+    args = p.parse_args(argv)
+
+    os.makedirs(os.path.join(ROOT, "bench_results"), exist_ok=True)
+    mix = parse_mix(args.mix)
+    if "async" not in mix:
+        args.workers = 0
+    config = {k: v for k, v in vars(args).items() if k not in ("api_key", "out", "compare")}
+    procs = start_stack(args)
+    try:
+        result = asyncio.run(drive(args, mix))
+    finally:
+        stop_stack(procs)
+
+    result = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "config": config, **result}
+    out = args.out or os.path.join(ROOT, "bench_results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result["scenarios"], indent=2))
+    print(f"Results: {out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+if __name__ == "__main__":
+    main()
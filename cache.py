@@ -0,0 +1,187 @@
+"""Two-tier response cache for deterministic inference.
+
+Tier 1 is a bounded in-process LRU, tier 2 a shared Redis keyspace with TTL
+and a total-size cap (oldest entries evicted first). Only non-streamed calls
+at or below CACHE_MAX_TEMPERATURE are cached.
+
+Per-call mode: None (follow CACHE_ENABLED), "bypass" (no read, no write),
+"refresh" (skip read, overwrite with the fresh result).
+"""
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any
+import redis
+from config import settings, get_logger
+from redis_pool import get_redis, get_async_redis
+import metrics
+
+log = get_logger("cache")
+
+PREFIX = "llmcache:"
+INDEX_KEY = PREFIX + "_index"   # zset: entry key -> insert time
+SIZES_KEY = PREFIX + "_sizes"   # hash: entry key -> bytes
+BYTES_KEY = PREFIX + "_bytes"   # counter: total bytes
+
+# Store one entry and evict expired/oldest entries until under the byte cap (atomic)
+_STORE_LUA = """
+local function drop(k)
+    local sz = redis.call('HGET', KEYS[3], k)
+    if sz then redis.call('DECRBY', KEYS[4], sz) end
+    redis.call('HDEL', KEYS[3], k)
+    redis.call('ZREM', KEYS[2], k)
+    redis.call('DEL', k)
+end
+local now, ttl, cap = tonumber(ARGV[3]), tonumber(ARGV[2]), tonumber(ARGV[4])
+if redis.call('HEXISTS', KEYS[3], KEYS[1]) == 1 then drop(KEYS[1]) end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ttl)
+redis.call('ZADD', KEYS[2], now, KEYS[1])
+redis.call('HSET', KEYS[3], KEYS[1], string.len(ARGV[1]))
+redis.call('INCRBY', KEYS[4], string.len(ARGV[1]))
+for _, k in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - ttl)) do drop(k) end
+while tonumber(redis.call('GET', KEYS[4]) or 0) > cap do
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, 0)
+    if #oldest == 0 then break end
+    drop(oldest[1])
+end
+return 1
+"""
+
+# === Tier 1: in-process LRU ===
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+_lru = LRUCache(settings.CACHE_LRU_SIZE)
+_stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "stores": 0, "errors": 0}
+
+# === Keys ===
+
+def request_hash(kind: str, payload: dict) -> str:
+    """Canonical hash: model + system + prompt/messages + options + image hashes."""
+    parts = {k: v for k, v in payload.items() if k not in ("images", "keep_alive", "stream")}
+    if payload.get("images"):
+        parts["images"] = [hashlib.sha256(i.encode()).hexdigest() for i in payload["images"]]
+    if parts.get("messages"):
+        parts["messages"] = [
+            {**m, "images": [hashlib.sha256(i.encode()).hexdigest() for i in m["images"]]} if m.get("images") else m
+            for m in parts["messages"]
+        ]
+    raw = json.dumps({"kind": kind, **parts}, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def make_key(kind: str, payload: dict) -> str:
+    return PREFIX + request_hash(kind, payload)
+
+def enabled(mode: str = None, temperature: float = 0.0) -> bool:
+    if mode == "bypass":
+        return False
+    return (settings.CACHE_ENABLED or mode == "refresh") and temperature <= settings.CACHE_MAX_TEMPERATURE
+
+# === Lookup / Store ===
+
+def _hit_l1(key: str) -> Any:
+    value = _lru.get(key)
+    if value is not None:
+        _stats["l1_hits"] += 1
+        metrics.CACHE.labels("l1_hit").inc()
+    return value
+
+def _decode_l2(key: str, raw: bytes | None) -> Any:
+    if raw is None:
+        _stats["misses"] += 1
+        metrics.CACHE.labels("miss").inc()
+        return None
+    value = json.loads(raw)
+    _lru.put(key, value)
+    _stats["l2_hits"] += 1
+    metrics.CACHE.labels("l2_hit").inc()
+    return value
+
+def _encode(value: Any) -> str | None:
+    raw = json.dumps(value)
+    return raw if len(raw) <= settings.CACHE_MAX_ITEM_BYTES else None
+
+def _store_args(key: str, raw: str) -> tuple[list, list]:
+    return [key, INDEX_KEY, SIZES_KEY, BYTES_KEY], [raw, settings.CACHE_TTL, time.time(), settings.CACHE_REDIS_MAX_BYTES]
+
+def get(key: str) -> Any:
+    if (value := _hit_l1(key)) is not None:
+        return value
+    try:
+        return _decode_l2(key, get_redis(settings.CACHE_REDIS_URL).get(key))
+    except redis.RedisError as e:
+        _stats["errors"] += 1
+        log.warning(f"L2 get failed: {e}")
+        _stats["misses"] += 1
+        metrics.CACHE.labels("error").inc()
+        return None
+
+def put(key: str, value: Any):
+    _lru.put(key, value)
+    _stats["stores"] += 1
+    metrics.CACHE.labels("store").inc()
+    if (raw := _encode(value)) is None:
+        return  # Too large for the shared tier
+    try:
+        keys, args = _store_args(key, raw)
+        get_redis(settings.CACHE_REDIS_URL).eval(_STORE_LUA, len(keys), *keys, *args)
+    except redis.RedisError as e:
+        _stats["errors"] += 1
+        log.warning(f"L2 put failed: {e}")
+
+async def aget(key: str) -> Any:
+    if (value := _hit_l1(key)) is not None:
+        return value
+    try:
+        return _decode_l2(key, await get_async_redis(settings.CACHE_REDIS_URL).get(key))
+    except redis.RedisError as e:
+        _stats["errors"] += 1
+        log.warning(f"L2 get failed: {e}")
+        _stats["misses"] += 1
+        metrics.CACHE.labels("error").inc()
+        return None
+
+async def aput(key: str, value: Any):
+    _lru.put(key, value)
+    _stats["stores"] += 1
+    metrics.CACHE.labels("store").inc()
+    if (raw := _encode(value)) is None:
+        return
+    try:
+        keys, args = _store_args(key, raw)
+        await get_async_redis(settings.CACHE_REDIS_URL).eval(_STORE_LUA, len(keys), *keys, *args)
+    except redis.RedisError as e:
+        _stats["errors"] += 1
+        log.warning(f"L2 put failed: {e}")
+
+def stats() -> dict:
+    result = {**_stats, "l1_entries": len(_lru), "enabled": settings.CACHE_ENABLED}
+    try:
+        r = get_redis(settings.CACHE_REDIS_URL)
+        result.update(l2_entries=r.zcard(INDEX_KEY), l2_bytes=int(r.get(BYTES_KEY) or 0))
+    except redis.RedisError:
+        pass  # Shared tier unavailable, report local counters only
+    return result
@@ -3,21 +3,36 @@
 3 queues (general, json, vision) with dedicated workers.
 Each queue processes tasks independently - slow tasks don't block fast ones.
 """
+import json
 import time
-from celery import Celery
-from celery.signals import task_prerun, task_postrun, task_failure
+import threading
+from celery import Celery, Task
+from celery.signals import task_prerun, task_postrun, task_failure, task_revoked, worker_ready
 from kombu import Queue
 from config import settings, get_logger
 import client
+import queue_index
+import token_stream
+import residency
+import sessions
+import metrics
+import events
+import mapreduce
+import validator
 
 log = get_logger("worker")
 
 # === Celery App ===
 
+# Redis results go through result_store (compression + file offload); "<class>+<url>" selects a custom backend
+_backend = settings.CELERY_RESULT_BACKEND
+if _backend.startswith(("redis://", "rediss://")):
+    _backend = f"result_store:CompactRedisBackend+{_backend}"
+
 app = Celery(
     "inference_engine",
     broker=settings.CELERY_BROKER_URL,
-    backend=settings.CELERY_RESULT_BACKEND,
+    backend=_backend,
 )
 
 app.conf.update(
@@ -30,17 +45,22 @@ app.conf.update(
     task_routes={
         "task.generate": {"queue": settings.QUEUE_GENERAL},
         "task.chat": {"queue": settings.QUEUE_GENERAL},
+        "task.session_chat": {"queue": settings.QUEUE_GENERAL},
         "task.structured": {"queue": settings.QUEUE_JSON},
         "task.extract": {"queue": settings.QUEUE_JSON},
         "task.vision": {"queue": settings.QUEUE_VISION},
+        # task.map_chunk / task.reduce_chunks: queue set per job (mapreduce.MODES)
     },
-    # Worker config
+    # Worker config (run_worker.py sets -c per queue; prefetch = concurrency x multiplier)
+    worker_pool=settings.WORKER_POOL,
     worker_prefetch_multiplier=settings.CELERY_WORKER_PREFETCH_MULTIPLIER,
-    worker_max_tasks_per_child=100,  # Restart after 100 tasks (prevent memory leak)
+    worker_max_tasks_per_child=100,  # Restart after 100 tasks (prevent memory leak, prefork only)
+    # Priority: one broker list per step, polled lowest step first (see queue_index.broker_lists)
+    task_default_priority=settings.PRIORITY_CLASSES[settings.PRIORITY_DEFAULT],
     # Task reliability
     task_acks_late=settings.CELERY_TASK_ACKS_LATE,
     task_reject_on_worker_lost=True,  # Requeue if worker crashes
-    task_time_limit=600,              # Hard kill after 10 min
+    task_time_limit=600,              # Hard kill after 10 min (prefork only: threads have no per-task bound)
     task_soft_time_limit=540,         # Warn at 9 min
     # Result config
     result_expires=settings.CELERY_RESULT_EXPIRES,
@@ -49,24 +69,87 @@ app.conf.update(
     accept_content=["json"],
     # Broker reliability
     broker_connection_retry_on_startup=True,
-    broker_transport_options={"visibility_timeout": 3600},  # 1 hour before requeue
+    broker_transport_options={
+        "visibility_timeout": 3600,  # 1 hour before requeue
+        "priority_steps": queue_index.PRIORITY_STEPS,
+        "sep": queue_index.SEP,
+    },
 )
 
 
-# === Task Logging ===
+# === Residency-aware dispatch ===
+
+@worker_ready.connect
+def on_worker_ready(sender, **kwargs):
+    metrics.start_worker_exporter()
+    if settings.RESIDENCY_SCHEDULING:
+        residency.Scheduler(app, sender.hostname, [q.name for q in sender.task_consumer.queues]).start()
+
 
-_task_start = {}
+# === Task Logging & Metrics ===
+
+_task_start = {}  # task_id -> (start time, queue)
+_task_start_lock = threading.Lock()  # Signal handlers run on every pool thread
+
+def _queue_of(task_name: str) -> str | None:
+    return app.conf.task_routes.get(task_name, {}).get("queue")
+
+def _finish(task_id: str) -> tuple[float, str | None] | None:
+    with _task_start_lock:
+        entry = _task_start.pop(task_id, None)
+    if entry:
+        metrics.TASKS_IN_FLIGHT.labels(entry[1] or "unknown").dec()
+    return entry
 
 @task_prerun.connect
 def on_task_start(task_id, task, *args, **kwargs):
-    _task_start[task_id] = time.time()
+    now = time.time()
+    queue = _queue_of(task.name)
+    # Tasks killed mid-run never reach postrun; drop anything older than any time limit allows
+    with _task_start_lock:
+        stale = [t for t, (start, _) in _task_start.items() if now - start > 2 * app.conf.task_time_limit]
+    for t in stale:
+        _finish(t)
+    with _task_start_lock:
+        _task_start[task_id] = (now, queue)
+    metrics.TASKS_IN_FLIGHT.labels(queue or "unknown").inc()
+    if (enqueued := task.request.get("enqueued_at")) and not task.request.retries:
+        metrics.QUEUE_WAIT.labels(queue or "unknown").observe(max(0.0, now - float(enqueued)))
+    queue_index.remove(task_id, queue)
     log.info(f"{task_id[:8]} | START | {task.name}")
 
 @task_postrun.connect
 def on_task_end(task_id, task, retval, state, *args, **kwargs):
-    duration = (time.time() - _task_start.pop(task_id, time.time())) * 1000
+    start, queue = _finish(task_id) or (time.time(), None)
+    duration = (time.time() - start) * 1000
+    metrics.TASK_LATENCY.labels(task.name, state or "UNKNOWN").observe(duration / 1000)
+    if queue:
+        queue_index.record_duration(queue, duration / 1000)
+    if state in events.FINAL_STATES and task.name != "task.webhook":  # Not RETRY; deliveries notify nobody
+        _notify(task_id, state, retval, task.request.get("webhook"), task.request.delivery_info)
     log.info(f"{task_id[:8]} | {state} | {task.name} | {duration:.0f}ms")
 
+@task_revoked.connect
+def on_task_revoked(request, *args, **kwargs):
+    _finish(request.id)
+    queue_index.remove(request.id)
+    if request.name == "task.map_chunk" and "job_id" in (request.kwargs or {}):  # Cancelled
+        mapreduce.chunk_finished(request.kwargs["job_id"], request.kwargs["index"], False)
+    _notify(request.id, "REVOKED", None, request.request_dict.get("webhook"), request.delivery_info)
+
+def _notify(task_id: str, state: str, result, webhook: str | None, delivery_info: dict = None):
+    """Wake /async/wait and WebSocket waiters; queue a POST to the task's webhook if it has one."""
+    events.publish(task_id, state)
+    if webhook:
+        payload = {"task_id": task_id, "status": state}
+        if state == "SUCCESS":
+            payload["result"] = result
+        elif state == "FAILURE":
+            payload["error"] = str(result)
+        # On the finished task's queue: its workers consume it. JSON round trip: results may hold non-JSON types
+        queue = (delivery_info or {}).get("routing_key") or settings.QUEUE_GENERAL
+        deliver_webhook.apply_async((webhook, json.loads(json.dumps(payload, default=str))), queue=queue)
+
 @task_failure.connect
 def on_task_fail(task_id, exception, *args, **kwargs):
     log.error(f"{task_id[:8]} | FAILED | {type(exception).__name__}: {exception}")
@@ -74,25 +157,72 @@ def on_task_fail(task_id, exception, *args, **kwargs):
 
 # === Tasks ===
 
+class DeadlineTask(Task):
+    """Skips the work when the client's deadline passed while the task waited (checked every attempt).
+
+    The broker-side `expires` already drops tasks that are still queued at the
+    deadline; this covers prefetched tasks and retries waiting out a backoff.
+    """
+
+    def __call__(self, *args, **kwargs):
+        deadline = self.request.get("deadline")
+        if deadline and time.time() > float(deadline):
+            log.info(f"{self.request.id[:8]} | EXPIRED | {self.name}")
+            self.expired(*args, **kwargs)
+            return {"success": False, "error": "Deadline exceeded", "deadline_exceeded": True}
+        return super().__call__(*args, **kwargs)
+
+    def expired(self, *args, **kwargs):
+        """Called with the task's arguments when it is skipped for its deadline."""
+
 # Retry settings: exponential backoff, max 2 retries
-TASK_OPTS = dict(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=2)
+TASK_OPTS = dict(bind=True, base=DeadlineTask, autoretry_for=(Exception,), retry_backoff=True, max_retries=2)
+
+
+class MapChunkTask(DeadlineTask):
+    """A skipped chunk still counts in its job's progress (reduce_chunks counts it as failed).
+
+    Chunks are sent without `expires` (a revoked chord header fails the job),
+    so this deadline check is what drops them.
+    """
+
+    def expired(self, *args, **kwargs):
+        mapreduce.chunk_finished(kwargs["job_id"], kwargs["index"], False)
+
+
+def _streamed(task, chunks) -> str:
+    """Publish tokens to the task's stream as they arrive (payload "stream": true)."""
+    return token_stream.publish(task.request.id, chunks, retry=task.request.retries > 0,
+                                last_attempt=task.request.retries >= task.max_retries)
 
 
 # General queue tasks
 @app.task(name="task.generate", **TASK_OPTS)
 def generate(self, prompt: str, model: str = None, task: str = "synthesize",
-             temperature: float = 0.7, system: str = None, num_predict: int = None, **kwargs):
+             temperature: float = 0.7, system: str = None, num_predict: int = None, stream: bool = False, **kwargs):
     """Text generation task."""
-    return {"success": True, "response": client.infer(
-        prompt=prompt, task=task, model=model, temperature=temperature, system=system,
-        num_predict=num_predict, **kwargs)}
+    r = client.infer(prompt=prompt, task=task, model=model, temperature=temperature, system=system,
+                     num_predict=num_predict, stream=stream, **kwargs)
+    return {"success": True, "response": _streamed(self, r) if stream else r}
 
 
 @app.task(name="task.chat", **TASK_OPTS)
-def chat(self, messages: list, model: str = None, system: str = None, **kwargs):
+def chat(self, messages: list, model: str = None, system: str = None, stream: bool = False, **kwargs):
     """Chat completion task."""
-    return {"success": True, "response": client.chat(
-        messages=messages, model=model, system=system, **kwargs)}
+    r = client.chat(messages=messages, model=model, system=system, stream=stream, **kwargs)
+    return {"success": True, "response": _streamed(self, r) if stream else r}
+
+
+@app.task(name="task.session_chat", **TASK_OPTS)
+def session_chat(self, session_id: str, message: str, temperature: float = 0.7, num_predict: int = None, **kwargs):
+    """One turn on a server-side chat session (only the new message is sent)."""
+    with sessions.lock(session_id):  # LockError if another turn holds it too long -> retried
+        session = sessions.load(session_id)
+        if session is None:
+            return {"success": False, "error": "Session not found"}
+        response = client.session_turn(session, message, temperature=temperature, num_predict=num_predict)
+        sessions.save(session)
+    return {"success": True, "session_id": session_id, "response": response}
 
 
 # JSON queue tasks
@@ -112,7 +242,66 @@ def extract(self, prompt: str, model: str = None, temperature: float = 0.1, num_
 
 # Vision queue tasks (longer timeout for slow inference)
 @app.task(name="task.vision", **TASK_OPTS, time_limit=900, soft_time_limit=840)
-def vision(self, prompt: str, images: list, model: str = None, temperature: float = 0.7, **kwargs):
+def vision(self, prompt: str, images: list, model: str = None, temperature: float = 0.7, stream: bool = False, **kwargs):
     """Vision analysis task."""
-    return {"success": True, "response": client.infer(
-        prompt=prompt, task="vision", images=images, model=model, temperature=temperature, **kwargs)}
+    r = client.infer(prompt=prompt, task="vision", images=images, model=model, temperature=temperature,
+                     stream=stream, **kwargs)
+    return {"success": True, "response": _streamed(self, r) if stream else r}
+
+
+# Completion webhooks (queued by _notify, see events.py)
+@app.task(name="task.webhook", bind=True, acks_late=True, max_retries=settings.WEBHOOK_RETRIES, ignore_result=True)
+def deliver_webhook(self, url: str, payload: dict):
+    """POST a finished task's status to its webhook; retried with backoff on 5xx, 3xx and transport errors."""
+    if (error := events.deliver(url, json.dumps(payload).encode())) is None:
+        return
+    if self.request.retries < self.max_retries:
+        raise self.retry(countdown=2 ** self.request.retries)
+    log.warning(f"Webhook {url} failed after {self.max_retries + 1} attempts: {error}")
+
+
+# Map-reduce tasks (chord submitted by POST /async/mapreduce, see mapreduce.py)
+@app.task(name="task.map_chunk", **{**TASK_OPTS, "base": MapChunkTask})
+def map_chunk(self, job_id: str, index: int, chunk: str, mode: str, schema: dict = None, instruction: str = None,
+              model: str = None, **kwargs):
+    """One chunk of a map-reduce job; a chunk that fails its last attempt is reported, not raised."""
+    try:
+        prompt = f"{instruction}\n\n{chunk}" if instruction else chunk
+        if mode == "extract":
+            result = client.structured(prompt=prompt, schema=schema, model=model, **kwargs)
+        else:
+            result = {"success": True, "response": client.infer(prompt=prompt, task="synthesize", model=model,
+                                                                system=mapreduce.SUMMARY_SYSTEM, **kwargs)}
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise  # autoretry
+        result = {"success": False, "error": str(e)}
+    mapreduce.chunk_finished(job_id, index, result.get("success", False))
+    return result
+
+
+@app.task(name="task.reduce_chunks", **TASK_OPTS)
+def reduce_chunks(self, results: list, job_id: str, mode: str, schema: dict = None, model: str = None,
+                  chunk_tokens: int = None, **kwargs):
+    """Merge a map-reduce job's chunk results (schema-aware for extract, re-summarized for summarize)."""
+    failed = [i for i, r in enumerate(results) if not r.get("success")]
+    mapreduce.mark_reduced(job_id, "running")
+    if mode == "extract":
+        conflicts = []
+        data = mapreduce.merge([r.get("data") for r in results if r.get("success")], schema, conflicts=conflicts)
+        errors = validator.validate(data, schema) if data is not None else ["No chunk succeeded"]
+        out = {"success": not errors, "data": data, "conflicts": conflicts}
+        if errors:
+            out["errors"] = errors
+    else:
+        summaries = [r["response"] for r in results if r.get("success")]
+        while len(summaries) > 1:  # Combine in rounds while the summaries don't fit one chunk
+            groups = mapreduce.split("\n\n".join(summaries), chunk_tokens, overlap_tokens=0)  # The job's chunk size
+            if len(groups) >= len(summaries):  # Not shrinking (summaries as long as chunks): keep them as they are
+                break
+            summaries = [client.infer(prompt=mapreduce.COMBINE_PROMPT + g, task="synthesize", model=model,
+                                      system=mapreduce.SUMMARY_SYSTEM, **kwargs) for g in groups]
+        out = {"success": bool(summaries), "response": "\n\n".join(summaries) if summaries else None}
+    mapreduce.mark_reduced(job_id, "done")
+    return {**out, "chunks": len(results), "failed_chunks": failed}
+
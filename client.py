@@ -1,30 +1,67 @@
 import json
 import re
 import requests
-import base64
-from typing import Generator, Any
+from typing import Generator
 from config import get_model, get_system, settings
+import cache
+import semantic_cache
+import singleflight
+import validator
+import residency
+import sessions
+import metrics
+import backends
+import uploads
+import preload
 
 # === Connection Pool (reuse TCP connections for speed) ===
 _session = requests.Session()
 _session.headers.update({"Content-Type": "application/json"})
+# Threaded workers share this session - size the pool for their concurrency
+_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=max(settings.WORKER_CONCURRENCY.values()) * 2))
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max(settings.WORKER_CONCURRENCY.values()) * 2))
 
 # === Helpers ===
 
 def _encode_image(path: str) -> str:
-    with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode()
+    return uploads.encoded(path)  # Cached, downscaled variant (see uploads.py)
 
 def _ollama(endpoint: str, payload: dict, stream: bool = False) -> requests.Response:
-    return _session.post(
-        f"{settings.OLLAMA_HOST}/api/{endpoint}",
-        json={**payload, "stream": stream},
-        stream=stream,
-        timeout=settings.TIMEOUT
-    )
+    """POST to the best Ollama host (see backends.py), moving on to the next one on host errors."""
+    model, error = payload.get("model"), None
+    metrics.tag(model=backends.model_label(model))
+    for b in backends.pool.attempts(model):
+        try:
+            r = _session.post(f"{b.host}/api/{endpoint}", json={**payload, "stream": stream}, stream=stream,
+                              timeout=settings.TIMEOUT)
+        except requests.RequestException as e:
+            backends.pool.release(b, model)
+            backends.pool.finish(b, None, model)
+            error = e
+            continue
+        except BaseException:
+            backends.pool.abandon(b, model)
+            raise
+        if backends.pool.finish(b, r.status_code, model):
+            backends.pool.release(b, model)
+            r.close()
+            error = requests.HTTPError(f"{r.status_code} from {b.host}", response=r)
+            continue
+        if not r.ok:  # Request error (unknown model, bad payload): free the slot before raising
+            backends.pool.release(b, model)
+            if stream:
+                r.close()
+            r.raise_for_status()
+        if stream:
+            backends.pool.hold(r, b, model)  # Released when the stream is closed
+        else:
+            backends.pool.release(b, model)
+        return r
+    raise error or backends.NoBackendAvailable("No healthy Ollama host")
 
-def _openrouter(messages: list[dict]) -> str:
-    r = requests.post(
+def _openrouter(messages: list[dict], failed_model: str = None) -> str:
+    metrics.FALLBACKS.labels(backends.model_label(failed_model)).inc()
+    r = _session.post(
         "https://openrouter.ai/api/v1/chat/completions",
         headers={"Authorization": f"Bearer {settings.OPENROUTER_KEY}"},
         json={"model": settings.OPENROUTER_MODEL, "messages": messages},
@@ -33,25 +70,32 @@ def _openrouter(messages: list[dict]) -> str:
     r.raise_for_status()
     return r.json()["choices"][0]["message"]["content"]
 
-def _stream_response(r: requests.Response, key: str) -> Generator[str, None, None]:
-    r.raise_for_status()
-    for line in r.iter_lines():
-        if line:
-            data = json.loads(line)
-            yield data.get(key, "") if isinstance(data.get(key), str) else data.get(key, {}).get("content", "")
+def _chunk_text(data: dict, key: str) -> str:
+    return data.get(key, "") if isinstance(data.get(key), str) else data.get(key, {}).get("content", "")
 
-# === Core API ===
+def _stream_response(r: requests.Response, key: str) -> Generator[str, None, None]:
+    try:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if line:
+                data = json.loads(line)
+                if data.get("done"):
+                    metrics.observe_generation(data)  # Final chunk carries the eval stats
+                yield _chunk_text(data, key)
+    finally:
+        r.close()  # Consumer stopped early -> drop the connection so Ollama stops generating
+        backends.done(r)
 
-def infer(
+def _generate_payload(
     prompt: str,
     task: str = "chat",
     model: str = None,
     images: list[str] = None,
-    stream: bool = False,
     temperature: float = 0.7,
     system: str = None,
-    num_predict: int = None,  # Limit output tokens for speed
-) -> str | Generator[str, None, None]:
+    num_predict: int = None,
+    format: str | dict = None,
+) -> dict:
     model = model or get_model(task) or settings.MODELS["general"]
 
     # Build options with speed optimizations
@@ -64,52 +108,163 @@ def infer(
         "prompt": prompt,
         "options": options,
         "system": system or get_system(task),
-        "keep_alive": "10m",  # Keep model loaded for 10 min (faster subsequent calls)
+        "keep_alive": residency.keep_alive(model),  # Longer while the model has queued work
     }
     if images:
         payload["images"] = [_encode_image(p) if not p.startswith("data:") else p.split(",")[1] for p in images]
+    if format:
+        payload["format"] = format  # "json" or a JSON schema - Ollama constrains decoding to it
+    return payload
+
+def _chat_payload(messages: list[dict], model: str = None, system: str = None, temperature: float = None) -> dict:
+    model = model or get_model("chat") or settings.MODELS["general"]
+    msgs = [{"role": "system", "content": system}] + messages if system else messages
+    payload = {
+        "model": model,
+        "messages": msgs,
+        "keep_alive": residency.keep_alive(model),
+    }
+    if temperature is not None:
+        payload["options"] = {"temperature": temperature}
+    return payload
+
+def _cache_key(kind: str, payload: dict, stream: bool, cache_mode: str, temperature: float | None) -> str | None:
+    # Chat without explicit temperature runs at the model default - not deterministic
+    if stream or not cache.enabled(cache_mode, 1.0 if temperature is None else temperature):
+        return None
+    return cache.make_key(kind, payload)
+
+def _semantic_query(kind: str, payload: dict, cache_mode: str, temperature: float | None, task: str = "chat"):
+    """(scope, prompt vector) for the semantic cache, or None if it doesn't apply or embedding failed."""
+    if not semantic_cache.enabled(cache_mode, 1.0 if temperature is None else temperature):
+        return None
+    if (scope := semantic_cache.scope(kind, payload, task)) is None:
+        return None
+    try:
+        r = _ollama("embed", {"model": settings.SEMANTIC_CACHE_EMBED_MODEL, "input": scope[1]})
+        vector = semantic_cache.normalize(r.json()["embeddings"][0])
+    except (requests.RequestException, backends.NoBackendAvailable, ValueError, KeyError, IndexError):
+        return None  # Cache is best-effort: generate as usual
+    finally:
+        metrics.tag(model=backends.model_label(payload["model"]))
+    return None if vector is None else (scope[0], vector)
+
+# === Core API ===
+
+def infer(
+    prompt: str,
+    task: str = "chat",
+    model: str = None,
+    images: list[str] = None,
+    stream: bool = False,
+    temperature: float = 0.7,
+    system: str = None,
+    num_predict: int = None,  # Limit output tokens for speed
+    cache_mode: str = None,   # None | "bypass" | "refresh" (see cache.py)
+    format: str | dict = None,  # Constrained output: "json" or a JSON schema
+) -> str | Generator[str, None, None]:
+    payload = _generate_payload(prompt, task, model, images, temperature, system, num_predict, format)
+    key = _cache_key("generate", payload, stream, cache_mode, temperature)
+    if key and cache_mode != "refresh" and (hit := cache.get(key)) is not None:
+        return hit
+    if stream:
+        return _generate(payload, stream=True)
+    semantic = _semantic_query("generate", payload, cache_mode, temperature, task)
+    if semantic and cache_mode != "refresh" and (hit := semantic_cache.lookup(*semantic)) is not None:
+        return hit
+
+    def run() -> str:
+        result = _generate(payload)
+        if key:
+            cache.put(key, result)
+        if semantic:
+            semantic_cache.store(*semantic, result)
+        return result
+    return singleflight.run(singleflight.flight_key("generate", payload, cache_mode), run)
 
+def _generate(payload: dict, stream: bool = False) -> str | Generator[str, None, None]:
     try:
         r = _ollama("generate", payload, stream)
         if stream:
+            r.raise_for_status()
             return _stream_response(r, "response")
         r.raise_for_status()
-        return r.json().get("response", "")
+        data = r.json()
+        metrics.observe_generation(data)
+        return data.get("response", "")
     except Exception as e:
         if settings.OPENROUTER_KEY:
-            return _openrouter([{"role": "system", "content": payload.get("system", "")}, {"role": "user", "content": prompt}])
+            return _openrouter([{"role": "system", "content": payload.get("system", "")}, {"role": "user", "content": payload["prompt"]}],
+                               payload["model"])
         raise e
 
-def chat(messages: list[dict], model: str = None, stream: bool = False, system: str = None) -> str | Generator[str, None, None]:
-    model = model or get_model("chat") or settings.MODELS["general"]
-    msgs = [{"role": "system", "content": system}] + messages if system else messages
+def chat(messages: list[dict], model: str = None, stream: bool = False, system: str = None,
+         temperature: float = None, cache_mode: str = None) -> str | Generator[str, None, None]:
+    payload = _chat_payload(messages, model, system, temperature)
+    key = _cache_key("chat", payload, stream, cache_mode, temperature)
+    if key and cache_mode != "refresh" and (hit := cache.get(key)) is not None:
+        return hit
+    if stream:
+        return _chat(payload, stream=True)
+    semantic = _semantic_query("chat", payload, cache_mode, temperature)
+    if semantic and cache_mode != "refresh" and (hit := semantic_cache.lookup(*semantic)) is not None:
+        return hit
+
+    def run() -> str:
+        result = _chat(payload)
+        if key:
+            cache.put(key, result)
+        if semantic:
+            semantic_cache.store(*semantic, result)
+        return result
+    return singleflight.run(singleflight.flight_key("chat", payload, cache_mode), run)
 
+def _chat(payload: dict, stream: bool = False) -> str | Generator[str, None, None]:
     try:
-        payload = {
-            "model": model,
-            "messages": msgs,
-            "keep_alive": "10m",  # Keep model loaded for faster subsequent calls
-        }
         r = _ollama("chat", payload, stream)
         if stream:
+            r.raise_for_status()
             return _stream_response(r, "message")
         r.raise_for_status()
-        return r.json().get("message", {}).get("content", "")
+        data = r.json()
+        metrics.observe_generation(data)
+        return data.get("message", {}).get("content", "")
     except Exception as e:
         if settings.OPENROUTER_KEY:
-            return _openrouter(msgs)
+            return _openrouter(payload["messages"], payload["model"])
         raise e
 
+def session_turn(session: dict, message: str, temperature: float = 0.7, num_predict: int = None) -> str:
+    """One chat turn on a server-side session (see sessions.py); updates session in place."""
+    payload = sessions.payload(session, message, temperature, num_predict)
+    try:
+        r = _ollama("generate", payload)
+        r.raise_for_status()
+        data = r.json()
+        metrics.observe_generation(data)
+        reply, context = data.get("response", ""), data.get("context")
+    except Exception as e:
+        if not settings.OPENROUTER_KEY:
+            raise e
+        reply, context = _openrouter(sessions.fallback_messages(session, message), session["model"]), None
+    sessions.apply(session, message, reply, context)
+    return reply
+
 def health() -> dict:
     result = {"ollama": "offline", "models": [], "ready": False}
-    try:
-        r = requests.get(f"{settings.OLLAMA_HOST}/api/tags", timeout=5)
-        loaded = [m["name"] for m in r.json().get("models", [])]
-        result.update(ollama="online", models=loaded, models_required=list(settings.MODELS.values()))
+    loaded = set()
+    for host in settings.OLLAMA_HOSTS:
+        try:
+            r = _session.get(f"{host}/api/tags", timeout=5)
+            loaded.update(m["name"] for m in r.json().get("models", []))
+            result["ollama"] = "online"
+        except (requests.RequestException, ValueError):
+            pass  # Host offline, the pool status below shows which
+    if result["ollama"] == "online":
+        result.update(models=sorted(loaded), models_required=list(settings.MODELS.values()))
         result["models_missing"] = [m for m in result["models_required"] if m not in loaded]
         result["ready"] = len(result["models_missing"]) == 0
-    except requests.RequestException:
-        pass  # Ollama offline, keep defaults
+    result["backends"] = backends.pool.status()
     result["openrouter"] = "configured" if settings.OPENROUTER_KEY else "not_configured"
     return result
 
@@ -121,67 +276,100 @@ def _extract_json(text: str) -> str:
             return m.group(1).strip()
     return text.strip()
 
-def _validate(data: Any, schema: dict) -> list[str]:
-    errors = []
-    if schema.get("type") == "object" and "properties" in schema:
-        for key, prop in schema["properties"].items():
-            if key not in data:
-                if key in schema.get("required", []):
-                    errors.append(f"Missing: {key}")
-            elif prop.get("type") == "string" and not isinstance(data[key], str):
-                errors.append(f"{key} must be string")
-            elif prop.get("type") == "number" and not isinstance(data[key], (int, float)):
-                errors.append(f"{key} must be number")
-            elif prop.get("type") == "array" and not isinstance(data[key], list):
-                errors.append(f"{key} must be array")
-    return errors
-
-def structured(prompt: str, schema: dict, model: str = None, retries: int = 2) -> dict:
-    system = "Return ONLY valid JSON matching the schema. No markdown."
-    full_prompt = f"Extract from:\n{prompt}\n\nSchema: {json.dumps(schema)}"
+STRUCTURED_SYSTEM = "Return ONLY valid JSON matching the schema. No markdown."
+STRUCTURED_TEMPERATURE = 0.1
+
+def _structured_prompt(prompt: str, schema: dict) -> str:
+    return f"Extract from:\n{prompt}\n\nSchema: {json.dumps(schema)}"
+
+def _structured_format(schema: dict) -> dict | None:
+    return schema if settings.STRUCTURED_CONSTRAINED else None
+
+def _parse_structured(response: str, schema: dict, last: bool) -> dict | None:
+    """Parse one attempt; None means retry.
+
+    With constrained decoding the output is always schema-shaped JSON, so a parse
+    error means truncated output (num_predict) - a rerun would fail the same way.
+    Only schema violations the grammar can't enforce (bounds, patterns) retry.
+    """
+    try:
+        data = json.loads(_extract_json(response))
+        errors = validator.validate(data, schema)
+        if not errors:
+            return {"success": True, "data": data}
+        if last:
+            return {"success": False, "data": data, "errors": errors}
+    except json.JSONDecodeError as e:
+        if last or settings.STRUCTURED_CONSTRAINED:
+            return {"success": False, "raw": response, "error": str(e)}
+    return None
+
+def _structured_request(prompt: str, schema: dict, model: str, retries: int) -> dict:
+    return {"model": model or get_model("extract"), "prompt": prompt, "schema": schema, "retries": retries}
+
+def _structured_key(request: dict, cache_mode: str) -> str | None:
+    if not cache.enabled(cache_mode, STRUCTURED_TEMPERATURE):
+        return None
+    return cache.make_key("structured", request)
+
+def structured(prompt: str, schema: dict, model: str = None, retries: int = 2, cache_mode: str = None) -> dict:
+    request = _structured_request(prompt, schema, model, retries)
+    key = _structured_key(request, cache_mode)
+    if key and cache_mode != "refresh" and (hit := cache.get(key)) is not None:
+        return hit
+
+    def run() -> dict:
+        result = _structured(prompt, schema, model, retries)
+        if key and result["success"]:
+            cache.put(key, result)
+        return result
+    return singleflight.run(singleflight.flight_key("structured", request, cache_mode), run)
+
+def _aborted(response: str, reason: str, last: bool) -> dict | None:
+    return {"success": False, "raw": response, "error": f"Aborted: {reason}"} if last else None
+
+def _structured_attempt(full_prompt: str, schema: dict, model: str) -> tuple[str, str | None]:
+    """One generation; streamed through a StreamValidator that stops it once unrecoverable.
+
+    Returns (text so far, abort reason or None).
+    """
+    kwargs = dict(prompt=full_prompt, task="extract", model=model, system=STRUCTURED_SYSTEM,
+                  temperature=STRUCTURED_TEMPERATURE, cache_mode="bypass", format=_structured_format(schema))
+    if not settings.STRUCTURED_STREAM_VALIDATE:
+        return infer(**kwargs), None
+    chunks = infer(**kwargs, stream=True)
+    if isinstance(chunks, str):  # Fallback provider answered in one piece
+        return chunks, None
+    checker, parts = validator.StreamValidator(schema), []
+    for chunk in chunks:
+        parts.append(chunk)
+        if reason := checker.feed(chunk):
+            chunks.close()  # Abort the generation now instead of waiting for num_predict
+            return "".join(parts), reason
+    return "".join(parts), None
+
+def _structured(prompt: str, schema: dict, model: str, retries: int) -> dict:
+    full_prompt = _structured_prompt(prompt, schema)
 
     for attempt in range(retries + 1):
-        response = infer(prompt=full_prompt, task="extract", model=model, system=system, temperature=0.1)
-        try:
-            data = json.loads(_extract_json(response))
-            errors = _validate(data, schema)
-            if not errors:
-                return {"success": True, "data": data}
-            if attempt == retries:
-                return {"success": False, "data": data, "errors": errors}
-        except json.JSONDecodeError as e:
-            if attempt == retries:
-                return {"success": False, "raw": response, "error": str(e)}
+        # Whole result is cached/coalesced by the caller; don't also do it per raw attempt
+        response, reason = _structured_attempt(full_prompt, schema, model)
+        last = attempt == retries
+        result = _aborted(response, reason, last) if reason else _parse_structured(response, schema, last)
+        if result is not None:
+            return result
     return {"success": False, "error": "Max retries exceeded"}
 
 # === Model Warmup ===
 
 def warmup(models: list[str] = None) -> dict:
-    models = models or list(settings.MODELS.values())
-    results = {}
-
-    for model in models:
-        try:
-            r = requests.post(
-                f"{settings.OLLAMA_HOST}/api/generate",
-                json={"model": model, "prompt": "Hi", "stream": False},
-                timeout=600  # 10 min for cold start
-            )
-            r.raise_for_status()
-            results[model] = "ready"
-        except Exception as e:
-            results[model] = f"failed: {str(e)[:50]}"
-
-    return {"models": results, "all_ready": all(v == "ready" for v in results.values())}
+    """Load models on every host (in parallel, pulling any that are missing; see preload.py)."""
+    return preload.prepare(models)
 
 def pull(model: str) -> dict:
-    try:
-        r = requests.post(
-            f"{settings.OLLAMA_HOST}/api/pull",
-            json={"name": model},
-            timeout=1800  # 30 min for download
-        )
-        r.raise_for_status()
+    result = preload.prepare([model], load=False)["models"][model]
+    if result == "ready":
         return {"model": model, "status": "pulled"}
-    except Exception as e:
-        return {"model": model, "status": "failed", "error": str(e)}
+    if not result.startswith("failed"):  # Pulled on some hosts
+        return {"model": model, "status": "pulled", "detail": result}
+    return {"model": model, "status": "failed", "error": result}
@@ -15,11 +15,17 @@ logging.basicConfig(
 def get_logger(name: str) -> logging.Logger:
     return logging.getLogger(name)
 
+def _rate(value: str, name: str) -> int:
+    n = int(value)
+    if n < 0:
+        raise ValueError(f"{name} must not be negative: {value}")
+    return n
+
 
 class Settings:
-    # Celery Configuration (same Redis DB for simplicity)
+    # Celery Configuration (results on their own DB so they can't crowd out the broker)
     CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
-    CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
+    CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/1")  # Own DB, see result_store.py
 
     # Queue names
     QUEUE_GENERAL = "general"
@@ -38,12 +44,79 @@ class Settings:
 
     # Worker settings
     CELERY_TASK_ACKS_LATE = True
-    CELERY_WORKER_PREFETCH_MULTIPLIER = 1  # One task at a time
+    CELERY_WORKER_PREFETCH_MULTIPLIER = 1  # Reserve one task per execution slot
+    # Concurrent execution: WORKER_CONCURRENCY slots per worker keep several requests in
+    # flight. Per-worker slots stay below OLLAMA_NUM_PARALLEL so the supervisor can add
+    # workers: max workers x concurrency (summed over queues sharing a model) should fit
+    # in OLLAMA_NUM_PARALLEL x hosts.
+    # Pool: prefork enforces task_time_limit, worker_max_tasks_per_child and
+    # reject-on-worker-lost. "threads" (opt-in) is lighter, but has none of these: a hung
+    # generation holds its slot and a crashed worker's tasks wait out the visibility timeout
+    WORKER_POOL = os.getenv("WORKER_POOL", "prefork")
+    WORKER_CONCURRENCY = {
+        "general": int(os.getenv("WORKER_CONCURRENCY_GENERAL", "2")),
+        "json": int(os.getenv("WORKER_CONCURRENCY_JSON", "2")),
+        "vision": int(os.getenv("WORKER_CONCURRENCY_VISION", "1")),
+    }
+    # Autoscaling supervisor (automation/supervisor.py): workers per queue, e.g. "general=1,json=1,vision=1"
+    SUPERVISOR_MIN_WORKERS = {
+        k.strip(): int(v) for k, v in
+        (item.rsplit("=", 1) for item in os.getenv("SUPERVISOR_MIN_WORKERS", "general=1,json=1,vision=1").split(",") if "=" in item)
+    }
+    SUPERVISOR_MAX_WORKERS = {
+        k.strip(): int(v) for k, v in
+        (item.rsplit("=", 1) for item in os.getenv("SUPERVISOR_MAX_WORKERS", "general=2,json=2,vision=2").split(",") if "=" in item)
+    }
+    SUPERVISOR_TARGET_WAIT_S = float(os.getenv("SUPERVISOR_TARGET_WAIT_S", "60"))     # Backlog drain time to aim for
+    SUPERVISOR_INTERVAL_S = float(os.getenv("SUPERVISOR_INTERVAL_S", "10"))
+    SUPERVISOR_UP_COOLDOWN_S = float(os.getenv("SUPERVISOR_UP_COOLDOWN_S", "30"))     # Per queue, between changes
+    SUPERVISOR_DOWN_COOLDOWN_S = float(os.getenv("SUPERVISOR_DOWN_COOLDOWN_S", "300"))
+    SUPERVISOR_DRAIN_TIMEOUT_S = float(os.getenv("SUPERVISOR_DRAIN_TIMEOUT_S", "660"))  # Above task_time_limit
     CELERY_RESULT_EXPIRES = 60 * 60 * 48   # 48 hours
+    # Result storage (result_store.py)
+    RESULT_COMPRESS_MIN_BYTES = int(os.getenv("RESULT_COMPRESS_MIN_BYTES", "1024"))
+    RESULT_COMPRESS_LEVEL = int(os.getenv("RESULT_COMPRESS_LEVEL", "6"))
+    RESULT_OFFLOAD_MIN_BYTES = int(os.getenv("RESULT_OFFLOAD_MIN_BYTES", str(256 * 1024)))  # Compressed size
+    RESULT_STORE_DIR = os.getenv("RESULT_STORE_DIR", "./data/results")
+    RESULT_SWEEP_S = int(os.getenv("RESULT_SWEEP_S", "3600"))                  # Expired file sweep interval
+    RESULT_EXPIRE_ON_FETCH = os.getenv("RESULT_EXPIRE_ON_FETCH", "false").lower() in ("1", "true", "yes")
+    RESULT_FETCHED_TTL = int(os.getenv("RESULT_FETCHED_TTL", "60"))            # Grace after the first fetch (0 = delete)
+    MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))  # Tasks per /async/submit_batch
+    # Map-reduce over long documents (mapreduce.py)
+    MAPREDUCE_CHUNK_TOKENS = int(os.getenv("MAPREDUCE_CHUNK_TOKENS", "3000"))   # Keep well below num_ctx
+    MAPREDUCE_OVERLAP_TOKENS = int(os.getenv("MAPREDUCE_OVERLAP_TOKENS", "200"))
+    # Admission control (admission.py): refuse work predicted to finish after its deadline / the queue cap
+    ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+    ADMISSION_MAX_S = {                                                          # Longest predicted completion per queue
+        "general": float(os.getenv("ADMISSION_MAX_S_GENERAL", "900")),
+        "json": float(os.getenv("ADMISSION_MAX_S_JSON", "900")),
+        "vision": float(os.getenv("ADMISSION_MAX_S_VISION", "1800")),
+    }
+    ADMISSION_SYNC_OVERLOAD = os.getenv("ADMISSION_SYNC_OVERLOAD", "reject")    # Sync calls over time: reject | async
+    ADMISSION_REFRESH_S = float(os.getenv("ADMISSION_REFRESH_S", "2"))          # Depth / rate snapshot age
 
     # Ollama
     OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+    OLLAMA_HOSTS = [h.strip().rstrip("/") for h in os.getenv("OLLAMA_HOSTS", OLLAMA_HOST).split(",") if h.strip()]
     TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "300"))
+    OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))  # Parallel requests per model per host (as set on Ollama)
+    # Backend pool (see backends.py)
+    BACKEND_PROBE_S = float(os.getenv("BACKEND_PROBE_S", "10"))          # Active health/model probe interval
+    BACKEND_LOAD_PENALTY = float(os.getenv("BACKEND_LOAD_PENALTY", "4"))  # Cost of a model load, in queued requests
+    BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))            # Consecutive failures that open a breaker
+    BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))    # ...or this error rate over the window
+    BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))               # Recent calls per host considered
+    BREAKER_COOLDOWN_S = float(os.getenv("BREAKER_COOLDOWN_S", "30"))     # Open time before a trial request
+    # Hedged requests (API process, opt-in): second request if no first token within the TTFT percentile
+    HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+    HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+    HEDGE_MIN_S = float(os.getenv("HEDGE_MIN_S", "0.5"))          # Never hedge sooner than this
+    HEDGE_DEFAULT_S = float(os.getenv("HEDGE_DEFAULT_S", "5"))     # Threshold until enough samples
+    HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+    HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))           # Recent TTFTs kept per model
+    HEDGE_MAX_INFLIGHT = int(os.getenv("HEDGE_MAX_INFLIGHT", "4"))  # Cap on extra load from hedges
+    HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "200"))  # Async client pool (API process)
+    HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "50"))
 
     # OpenRouter fallback
     OPENROUTER_KEY = os.getenv("OPENROUTER_API_KEY", "")
@@ -51,7 +124,23 @@ class Settings:
 
     # Auth & Rate limiting
     API_KEY = os.getenv("API_KEY", "")
-    RATE_LIMIT = int(os.getenv("RATE_LIMIT", "300"))  # 300 requests per minute
+    RATE_LIMIT = _rate(os.getenv("RATE_LIMIT", "300"), "RATE_LIMIT")  # 300 requests per minute (0 = off)
+    RATE_LIMIT_BURST = _rate(os.getenv("RATE_LIMIT_BURST", "0"), "RATE_LIMIT_BURST")  # Bucket size (0 = RATE_LIMIT)
+    # Per-key limits: "<first 16 chars of key>=<per minute>[/<burst>]", comma-separated; 0 per minute blocks the key
+    RATE_LIMIT_OVERRIDES = {
+        k.strip(): (_rate(v.split("/")[0], "RATE_LIMIT_OVERRIDES"), _rate(v.split("/")[1], "RATE_LIMIT_OVERRIDES")
+                    if "/" in v else 0) for k, v in
+        (item.rsplit("=", 1) for item in os.getenv("RATE_LIMIT_OVERRIDES", "").split(",") if "=" in item)
+    }
+
+    # Priority scheduling: class -> Redis broker priority step (lower is dispatched first)
+    PRIORITY_CLASSES = {"interactive": 0, "normal": 3, "batch": 6, "background": 9}
+    PRIORITY_DEFAULT = os.getenv("PRIORITY_DEFAULT", "normal")
+    # Per-key default class: "<first 16 chars of key>=<class>", comma-separated
+    PRIORITY_OVERRIDES = {
+        k.strip(): v.strip() for k, v in
+        (item.rsplit("=", 1) for item in os.getenv("PRIORITY_OVERRIDES", "").split(",") if "=" in item)
+    }
 
     # Models - defaults, but client can override via request
     MODELS = {
@@ -60,11 +149,85 @@ class Settings:
         "vision": os.getenv("VISION_MODEL", "qwen2.5vl:7b"),
     }
     TASK_MODEL = {"synthesize": "general", "extract": "json", "vision": "vision"}
+    # Per-model override of WORKER_CONCURRENCY, e.g. MODEL_CONCURRENCY="qwen2.5:32b=2,qwen2.5vl:7b=1"
+    MODEL_CONCURRENCY = {
+        k.strip(): int(v) for k, v in
+        (item.rsplit("=", 1) for item in os.getenv("MODEL_CONCURRENCY", "").split(",") if "=" in item)
+    }
 
     # Speed optimizations
     DEFAULT_NUM_PREDICT = int(os.getenv("DEFAULT_NUM_PREDICT", "2048"))  # Limit output tokens
     KEEP_ALIVE = os.getenv("KEEP_ALIVE", "10m")  # Keep model loaded between requests
 
+    # Residency-aware scheduling: serve queues whose model is loaded first (see residency.py)
+    RESIDENCY_SCHEDULING = os.getenv("RESIDENCY_SCHEDULING", "true").lower() in ("1", "true", "yes")
+    GPU_VRAM_GB = float(os.getenv("GPU_VRAM_GB", "24"))                  # Budget per Ollama host (0 = no limit)
+    MODEL_VRAM_GB = {                                                     # e.g. "qwen2.5:32b=22,qwen2.5vl:7b=8"
+        k.strip(): float(v) for k, v in
+        (item.rsplit("=", 1) for item in os.getenv("MODEL_VRAM_GB", "").split(",") if "=" in item)
+    }
+    RESIDENCY_DEFAULT_VRAM_GB = float(os.getenv("RESIDENCY_DEFAULT_VRAM_GB", "10"))
+    RESIDENCY_REFRESH_S = float(os.getenv("RESIDENCY_REFRESH_S", "5"))
+    RESIDENCY_MAX_WAIT_S = int(os.getenv("RESIDENCY_MAX_WAIT_S", "120"))  # Longest a queue waits for a swap
+    RESIDENCY_DWELL_S = int(os.getenv("RESIDENCY_DWELL_S", "300"))        # Turn length once swapped in
+    RESIDENCY_KEEP_ALIVE_BUSY = os.getenv("RESIDENCY_KEEP_ALIVE_BUSY", "30m")  # Model's queue has backlog
+    RESIDENCY_KEEP_ALIVE_YIELD = os.getenv("RESIDENCY_KEEP_ALIVE_YIELD", "1m")  # Idle while others wait
+
+    # Structured output: pass the schema as Ollama's `format` (grammar-constrained decoding)
+    STRUCTURED_CONSTRAINED = os.getenv("STRUCTURED_CONSTRAINED", "true").lower() in ("1", "true", "yes")
+    # Stream structured generations through an incremental validator and abort bad ones early
+    STRUCTURED_STREAM_VALIDATE = os.getenv("STRUCTURED_STREAM_VALIDATE", "true").lower() in ("1", "true", "yes")
+
+    # Response cache (opt-in; only deterministic, non-streamed calls)
+    CACHE_ENABLED = os.getenv("CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+    CACHE_MAX_TEMPERATURE = float(os.getenv("CACHE_MAX_TEMPERATURE", "0.3"))
+    CACHE_LRU_SIZE = int(os.getenv("CACHE_LRU_SIZE", "1024"))                  # Tier 1 entries per process
+    CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", CELERY_BROKER_URL)          # Tier 2 (shared)
+    CACHE_TTL = int(os.getenv("CACHE_TTL", str(60 * 60 * 24)))                 # 24 hours
+    CACHE_REDIS_MAX_BYTES = int(os.getenv("CACHE_REDIS_MAX_BYTES", str(256 * 1024 * 1024)))  # 256MB
+    CACHE_MAX_ITEM_BYTES = int(os.getenv("CACHE_MAX_ITEM_BYTES", str(1024 * 1024)))          # 1MB
+
+    # Semantic cache (opt-in, needs numpy): near-duplicate prompts reuse an answer, matched by embedding
+    SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+    SEMANTIC_CACHE_EMBED_MODEL = os.getenv("SEMANTIC_CACHE_EMBED_MODEL", "nomic-embed-text")
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))        # Cosine similarity
+    SEMANTIC_CACHE_MAX_TEMPERATURE = float(os.getenv("SEMANTIC_CACHE_MAX_TEMPERATURE", "0.3"))   # Above: sampled output
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))     # Per model + system prompt
+    SEMANTIC_CACHE_MAX_BYTES = int(os.getenv("SEMANTIC_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))  # All indexes
+    SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", "./data/semantic_cache")
+    SEMANTIC_CACHE_SAVE_S = int(os.getenv("SEMANTIC_CACHE_SAVE_S", "300"))                 # Persist interval
+
+    # Single-flight: identical in-flight requests share one generation
+    SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() in ("1", "true", "yes")
+    SINGLEFLIGHT_RESULT_TTL = int(os.getenv("SINGLEFLIGHT_RESULT_TTL", "30"))  # Seconds waiters can pick up a result
+    SINGLEFLIGHT_TASK_TTL = int(os.getenv("SINGLEFLIGHT_TASK_TTL", "30"))      # Identical /async/submit reuse window
+    SINGLEFLIGHT_POLL = float(os.getenv("SINGLEFLIGHT_POLL", "1.0"))           # Lease liveness check interval
+
+    # Token streaming for queued tasks (payload "stream": true)
+    TOKEN_STREAM_TTL = int(os.getenv("TOKEN_STREAM_TTL", "3600"))          # Keep replayable for 1 hour
+    TOKEN_STREAM_MAXLEN = int(os.getenv("TOKEN_STREAM_MAXLEN", "5000"))    # Entries retained per task
+    TOKEN_STREAM_FLUSH_CHARS = int(os.getenv("TOKEN_STREAM_FLUSH_CHARS", "64"))
+    TOKEN_STREAM_FLUSH_S = float(os.getenv("TOKEN_STREAM_FLUSH_S", "0.05"))
+    TOKEN_STREAM_HEARTBEAT_S = int(os.getenv("TOKEN_STREAM_HEARTBEAT_S", "15"))  # SSE keepalive / state check
+
+    # Completion notifications (events.py)
+    WAIT_MAX_TIMEOUT = float(os.getenv("WAIT_MAX_TIMEOUT", "60"))          # /async/wait long-poll cap
+    WS_MAX_SUBSCRIPTIONS = int(os.getenv("WS_MAX_SUBSCRIPTIONS", "10000"))  # Task ids per WebSocket
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")                       # HMAC-SHA256 signing key (X-Signature)
+    # Trusted webhook hosts; empty = any host with only public addresses (see events.py)
+    WEBHOOK_ALLOWED_HOSTS = [h.strip() for h in os.getenv("WEBHOOK_ALLOWED_HOSTS", "").split(",") if h.strip()]
+    WEBHOOK_TIMEOUT = int(os.getenv("WEBHOOK_TIMEOUT", "10"))
+    WEBHOOK_RETRIES = int(os.getenv("WEBHOOK_RETRIES", "3"))
+
+    # Server-side chat sessions
+    SESSION_TTL = int(os.getenv("SESSION_TTL", str(60 * 60 * 24)))                  # Idle expiry
+    SESSION_MAX_CONTEXT_TOKENS = int(os.getenv("SESSION_MAX_CONTEXT_TOKENS", "6144"))  # Keep below num_ctx
+    SESSION_HISTORY_TOKENS = int(os.getenv("SESSION_HISTORY_TOKENS", "2048"))        # Window when rebuilding
+
+    # Prometheus metrics (API: GET /metrics, workers: HTTP exporter on METRICS_WORKER_PORT)
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+    METRICS_WORKER_PORT = int(os.getenv("METRICS_WORKER_PORT", "9808"))  # 0 = no worker exporter
+
     # Prompts
     SYSTEM = {
         "chat": "You are a helpful assistant.",
@@ -79,11 +242,20 @@ class Settings:
     # File uploads
     UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./data/uploads")
     MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(10 * 1024 * 1024)))  # 10MB
+    # Images sent to vision models (downscaling needs Pillow)
+    VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1024"))          # Longer side, pixels
+    VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "90"))
+    VISION_CACHE_SIZE = int(os.getenv("VISION_CACHE_SIZE", "64"))        # Encoded images kept in memory per process
 
 settings = Settings()
 
 def get_model(task: str) -> str:
     return settings.MODELS.get(settings.TASK_MODEL.get(task))
 
+def get_concurrency(queue: str) -> int:
+    """Parallel slots a worker should run for a queue (model override wins)."""
+    model = settings.MODELS.get(queue)
+    return settings.MODEL_CONCURRENCY.get(model, settings.WORKER_CONCURRENCY.get(queue, 1))
+
 def get_system(task: str) -> str:
     return settings.SYSTEM.get(task, settings.SYSTEM["chat"])
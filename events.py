@@ -0,0 +1,132 @@
+"""Task completion events.
+
+Workers publish {"task_id", "status"} on one Redis pub/sub channel when a
+task reaches a final state (postrun, revoke), after giving the completion a
+number from one Redis counter (sequence()); /async/status_batch uses those
+numbers as its cursor, so tasks finishing out of order aren't skipped. Each API process keeps a single
+subscription and hands events to local waiters (long-poll /async/wait and
+WebSocket subscribers), so thousands of waiting clients cost one Redis
+connection instead of thousands of status polls. Waiters register before
+checking the current state; the subscription itself starts in the
+background, so the first waiters in a process can miss an event published
+before it is up - they still see the task on their timeout re-check.
+
+Tasks submitted with a webhook get a POST of their final status, sent by
+task.webhook (celery_app.py) on the finished task's queue: a broker message
+with acks_late, retried with backoff, so a worker child exiting
+(worker_max_tasks_per_child) or crashing doesn't lose it. Bodies are
+HMAC-signed when WEBHOOK_SECRET is set. Redirects are not followed - a 3xx
+counts as a failed delivery, so an allowed host can't bounce the POST
+elsewhere. Webhook hosts listed in WEBHOOK_ALLOWED_HOSTS are trusted; with no list, any host that resolves only to public addresses is
+accepted - loopback, private, link-local (cloud metadata) and reserved ones
+are refused, at submit and again before each delivery.
+"""
+import hmac
+import json
+import socket
+import ipaddress
+import asyncio
+import hashlib
+from urllib.parse import urlparse
+import redis
+import requests
+from config import settings, get_logger
+from redis_pool import get_redis, get_async_redis
+
+log = get_logger("events")
+
+CHANNEL = "task-events"
+SEQ_KEY = "task-events:seq"
+SEQ_PREFIX = "task-events:seq:"
+FINAL_STATES = ("SUCCESS", "FAILURE", "REVOKED")
+
+# Number a completion: next counter value, stored with the task for the cursor
+_SEQ_LUA = "local n = redis.call('INCR', KEYS[1]) redis.call('SET', KEYS[2], n, 'EX', ARGV[1]) return n"
+
+# === Worker side ===
+
+def publish(task_id: str, status: str):
+    try:
+        r = get_redis()
+        r.eval(_SEQ_LUA, 2, SEQ_KEY, SEQ_PREFIX + task_id, settings.CELERY_RESULT_EXPIRES)
+        r.publish(CHANNEL, json.dumps({"task_id": task_id, "status": status}))
+    except redis.RedisError as e:
+        log.warning(f"Completion event for {task_id[:8]} not published: {e}")  # Waiters fall back on timeout
+
+def sequence(task_ids: list[str]) -> list[int | None]:
+    """Completion numbers of task_ids (None: not finished, or not numbered yet)."""
+    return [int(v) if v else None for v in get_redis().mget([SEQ_PREFIX + t for t in task_ids])]
+
+_webhook_session = requests.Session()
+
+def _public(host: str) -> bool:
+    """True if every address host resolves to is globally routable."""
+    try:
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(infos) and all(ipaddress.ip_address(info[4][0].split("%")[0]).is_global for info in infos)
+
+def webhook_allowed(url: str) -> bool:
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False
+    if settings.WEBHOOK_ALLOWED_HOSTS:
+        return parsed.hostname in settings.WEBHOOK_ALLOWED_HOSTS
+    return _public(parsed.hostname)
+
+def deliver(url: str, body: bytes) -> str | None:
+    """POST body to url once; the error if it should be retried, None when done (or refused)."""
+    if not webhook_allowed(url):  # Re-resolved: the name may point elsewhere since submit
+        log.warning(f"Webhook {url} refused: not a public or allowed host")
+        return None
+    headers = {"Content-Type": "application/json"}
+    if settings.WEBHOOK_SECRET:
+        headers["X-Signature"] = "sha256=" + hmac.new(settings.WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    try:
+        r = _webhook_session.post(url, data=body, headers=headers, timeout=settings.WEBHOOK_TIMEOUT,
+                                  allow_redirects=False)
+    except requests.RequestException as e:
+        return str(e)
+    if r.status_code < 300 or 400 <= r.status_code < 500:
+        return None
+    return f"HTTP {r.status_code}"
+
+# === API side ===
+
+class Dispatcher:
+    """One pub/sub subscription per process, fanned out to local waiter queues."""
+
+    def __init__(self):
+        self.waiters: dict[str, set[asyncio.Queue]] = {}
+        self.task: asyncio.Task = None
+
+    def watch(self, task_ids: list[str], queue: asyncio.Queue):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        for task_id in task_ids:
+            self.waiters.setdefault(task_id, set()).add(queue)
+
+    def unwatch(self, task_ids: list[str], queue: asyncio.Queue):
+        for task_id in task_ids:
+            if (queues := self.waiters.get(task_id)) is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self.waiters[task_id]
+
+    async def _run(self):
+        while True:
+            pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(CHANNEL)
+                async for message in pubsub.listen():
+                    event = json.loads(message["data"])
+                    for queue in list(self.waiters.get(event["task_id"], ())):
+                        queue.put_nowait(event)
+            except (redis.RedisError, ValueError) as e:
+                log.warning(f"Completion events interrupted, resubscribing: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+dispatcher = Dispatcher()
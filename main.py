@@ -1,8 +1,10 @@
 import time
 import uuid
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from api import router
+from api import router, ws_router
+import aclient
+import metrics
 from config import settings, get_logger
 
 log = get_logger("api")
@@ -14,14 +16,30 @@ app = FastAPI(title="Inference Engine", version="1.0.0")
 async def log_requests(request: Request, call_next):
     """Log all requests with timing and request ID."""
     request_id = request.headers.get("X-Request-ID", uuid.uuid4().hex[:8])
+    tags = metrics.open_tags()
     start = time.time()
-    response = await call_next(request)
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.REQUESTS_IN_FLIGHT.dec()
     duration = (time.time() - start) * 1000
+    metrics.REQUEST_LATENCY.labels(metrics.route_of(request), request.method, response.status_code,
+                                   tags.get("model", "")).observe(duration / 1000)
     log.info(f"{request_id} | {request.method} {request.url.path} | {response.status_code} | {duration:.0f}ms")
     response.headers["X-Request-ID"] = request_id
     return response
 
 
+@app.middleware("http")
+async def rate_limit_headers(request: Request, call_next):
+    """X-RateLimit-* on every response, including routes that build their own (SSE, 202/503, batch)."""
+    response = await call_next(request)
+    if decision := getattr(request.state, "rate_limit", None):
+        response.headers.update(decision.headers())
+    return response
+
+
 # CORS: credentials only allowed with explicit origins (not wildcard)
 allow_credentials = "*" not in settings.CORS_ORIGINS
 app.add_middleware(
@@ -32,7 +50,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if settings.METRICS_ENABLED:
+    @app.get("/metrics", include_in_schema=False)
+    async def prometheus_metrics():
+        body, content_type = metrics.render()
+        return Response(body, media_type=content_type)
+
+@app.on_event("shutdown")
+async def close_clients():
+    await aclient.aclose()
+
+
 app.include_router(router)
+app.include_router(ws_router)
 log.info("Inference Engine started")
 
 if __name__ == "__main__":
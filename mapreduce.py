@@ -0,0 +1,137 @@
+"""Map-reduce over long documents.
+
+split() cuts the input into chunks of about MAPREDUCE_CHUNK_TOKENS (estimated
+as in sessions.py) that overlap by MAPREDUCE_OVERLAP_TOKENS, cutting at
+paragraph, line, sentence or word boundaries where possible. POST
+/async/mapreduce submits a Celery chord: one task.map_chunk per chunk on the
+mode's queue (extract -> json, summarize -> general), so chunks prefill in
+parallel across workers, then task.reduce_chunks:
+  - extract: merge() combines the per-chunk objects along the schema - object
+    properties merged recursively, arrays concatenated without duplicates
+    (chunk overlap extracts the same items twice), conflicting scalars
+    resolved by majority vote (earliest chunk breaks ties) and reported;
+  - summarize: the partial summaries are summarized again, in rounds while
+    they don't fit one chunk.
+
+Chunks that fail after their retries, or reach the job's deadline, are
+recorded and left out, so one bad chunk doesn't lose the job. Per-chunk progress lives in a Redis hash
+(GET /async/mapreduce/{job_id}); the job id is the reduce task's id, so
+/async/status, /async/wait and webhooks report the merged result.
+"""
+import json
+from collections import Counter
+import redis
+from config import settings, get_logger
+from redis_pool import get_redis
+import validator
+
+log = get_logger("mapreduce")
+
+PREFIX = "mapreduce:"
+CHARS_PER_TOKEN = 4  # sessions.estimate_tokens
+MODES = {"extract": settings.QUEUE_JSON, "summarize": settings.QUEUE_GENERAL}
+SUMMARY_SYSTEM = "Summarize the text faithfully and concisely. Keep names, numbers, dates and conclusions."
+COMBINE_PROMPT = "These are summaries of consecutive parts of one document. Combine them into a single summary:\n\n"
+
+# === Split ===
+
+def split(text: str, chunk_tokens: int = None, overlap_tokens: int = None) -> list[str]:
+    size = (chunk_tokens or settings.MAPREDUCE_CHUNK_TOKENS) * CHARS_PER_TOKEN
+    overlap = min((settings.MAPREDUCE_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens) * CHARS_PER_TOKEN,
+                  size // 2)
+    chunks, start = [], 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            floor = start + size * 4 // 5  # Cut within the last fifth of the window
+            for sep in ("\n\n", "\n", ". ", " "):
+                if (cut := text.rfind(sep, floor, end)) != -1:
+                    end = cut + len(sep)
+                    break
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        nxt = max(end - overlap, start + 1)
+        space = text.find(" ", nxt, end)  # Start the overlap on a word
+        start = space + 1 if space != -1 else nxt
+    return [c for c in chunks if c]
+
+# === Merge ===
+
+def _fingerprint(value) -> str:
+    """Identity for deduplication: whitespace and case don't make two items different."""
+    if isinstance(value, str):
+        return json.dumps(" ".join(value.split()).casefold())
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{json.dumps(k)}:{_fingerprint(v)}" for k, v in sorted(value.items())) + "}"
+    if isinstance(value, list):
+        return "[" + ",".join(_fingerprint(v) for v in value) + "]"
+    return json.dumps(value)
+
+def merge(values: list, schema: dict = None, root: dict = None, path: str = "", conflicts: list = None):
+    """Merge per-chunk values of one schema node (see module docstring); conflicts are appended to `conflicts`."""
+    root = root or schema or {}
+    schema = validator.resolve(schema or {}, root)
+    conflicts = [] if conflicts is None else conflicts
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    if all(isinstance(v, dict) for v in values):
+        props, extra = schema.get("properties", {}), schema.get("additionalProperties")
+        keys = list(dict.fromkeys(k for v in values for k in v))
+        return {k: merge([v[k] for v in values if k in v], props.get(k, extra if isinstance(extra, dict) else {}),
+                         root, f"{path}.{k}" if path else k, conflicts) for k in keys}
+    if all(isinstance(v, list) for v in values):
+        merged, seen = [], set()
+        for item in (i for v in values for i in v):
+            if (fp := _fingerprint(item)) not in seen:
+                seen.add(fp)
+                merged.append(item)
+        return merged
+    present = [v for v in values if v != ""] or values
+    counts = Counter(_fingerprint(v) for v in present)
+    if len(counts) == 1:
+        return present[0]
+    best = max(counts.values())
+    chosen = next(v for v in present if counts[_fingerprint(v)] == best)  # Earliest chunk wins ties
+    distinct = {}
+    for v in present:
+        distinct.setdefault(_fingerprint(v), v)
+    conflicts.append({"path": path or "$", "chosen": chosen, "values": list(distinct.values())})
+    return chosen
+
+# === Progress ===
+
+def _key(job_id: str) -> str:
+    return PREFIX + job_id
+
+def start(job_id: str, total: int):
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hset(_key(job_id), "total", total)
+        pipe.expire(_key(job_id), settings.CELERY_RESULT_EXPIRES)
+        pipe.execute()
+    except redis.RedisError as e:
+        log.warning(f"Progress for {job_id[:8]} not started: {e}")  # The job runs; only progress is missing
+
+def chunk_finished(job_id: str, index: int, ok: bool):
+    """Record a chunk's outcome; one field per chunk, so a redelivered chunk isn't counted twice."""
+    try:
+        get_redis().hset(_key(job_id), f"c:{index}", "done" if ok else "failed")
+    except redis.RedisError as e:
+        log.warning(f"Progress for {job_id[:8]} chunk {index} not recorded: {e}")
+
+def mark_reduced(job_id: str, state: str):
+    try:
+        get_redis().hset(_key(job_id), "reduce", state)
+    except redis.RedisError as e:
+        log.warning(f"Progress for {job_id[:8]} not recorded: {e}")
+
+def progress(job_id: str) -> dict | None:
+    raw = {k.decode(): v.decode() for k, v in get_redis().hgetall(_key(job_id)).items()}
+    if "total" not in raw:
+        return None
+    total = int(raw["total"])
+    chunks = [raw.get(f"c:{i}", "pending") for i in range(total)]
+    return {"job_id": job_id, "total": total, "done": chunks.count("done"), "failed": chunks.count("failed"),
+            "chunks": chunks, "reduce": raw.get("reduce", "pending")}
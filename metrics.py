@@ -0,0 +1,112 @@
+"""Prometheus metrics for the API and the workers.
+
+The API exposes them at GET /metrics; workers start an HTTP exporter on
+METRICS_WORKER_PORT at worker_ready. With several processes per host set
+PROMETHEUS_MULTIPROC_DIR so values are aggregated across them.
+
+Route latency is labelled with the model the request ended up using: the
+middleware opens a per-request tag dict (contextvar) and the Ollama client
+fills in the model, so no route handler has to know about metrics. Model
+labels that come from a request go through backends.model_label(): names
+neither configured nor installed on a host become "other", so callers can't
+create series (and multiprocess files) at will.
+"""
+import os
+import contextvars
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, generate_latest, start_http_server, CONTENT_TYPE_LATEST,
+)
+from prometheus_client import multiprocess
+from config import settings, get_logger
+import admission
+
+log = get_logger("metrics")
+
+# Generation latencies span milliseconds (cache hits) to minutes (vision)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+
+# === API ===
+REQUEST_LATENCY = Histogram("inference_request_seconds", "API request latency", ["route", "method", "status", "model"],
+                            buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge("inference_requests_in_flight", "API requests being served (until headers for streams)",
+                           multiprocess_mode="livesum")
+
+# === Queue / worker ===
+QUEUE_WAIT = Histogram("inference_queue_wait_seconds", "Enqueue to task start", ["queue"], buckets=LATENCY_BUCKETS)
+TASK_LATENCY = Histogram("inference_task_seconds", "Task run time", ["task", "state"], buckets=LATENCY_BUCKETS)
+TASKS_IN_FLIGHT = Gauge("inference_tasks_in_flight", "Tasks executing on workers", ["queue"], multiprocess_mode="livesum")
+
+# === Backend ===
+TTFT = Histogram("inference_ttft_seconds", "Model load + prompt eval before the first token", ["model"], buckets=TTFT_BUCKETS)
+LOAD_TIME = Histogram("inference_model_load_seconds", "Model load time reported by Ollama", ["model"], buckets=TTFT_BUCKETS)
+TOKENS_PER_SECOND = Histogram("inference_tokens_per_second", "Decode speed (eval_count / eval_duration)", ["model"],
+                              buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400))
+TOKENS = Counter("inference_tokens_total", "Tokens processed", ["model", "kind"])
+FALLBACKS = Counter("inference_fallbacks_total", "Requests answered by OpenRouter after an Ollama failure", ["model"])
+BACKEND_OUTSTANDING = Gauge("inference_backend_outstanding", "Requests in flight per Ollama host", ["host"],
+                            multiprocess_mode="livesum")
+BREAKER_TRIPS = Counter("inference_breaker_trips_total", "Circuit breaker openings per Ollama host", ["host"])
+HEDGES = Counter("inference_hedges_total", "Hedged requests by winner (primary, hedge, fallback)", ["model", "winner"])
+CACHE = Counter("inference_cache_total", "Response cache lookups and stores", ["result"])
+ADMISSION = Counter("inference_admission_total", "Admission decisions (admitted, rejected, downgraded)", ["queue", "outcome"])
+
+# === Request tagging ===
+_tags: contextvars.ContextVar[dict | None] = contextvars.ContextVar("metrics_tags", default=None)
+
+def open_tags() -> dict:
+    """Start collecting labels for the current request (the dict is shared with child tasks)."""
+    tags = {}
+    _tags.set(tags)
+    return tags
+
+def tag(**labels):
+    if (tags := _tags.get()) is not None:
+        tags.update(labels)
+
+# === Recording helpers ===
+
+def observe_generation(data: dict, model: str = None):
+    """Record TTFT, load time and decode speed from an Ollama final response (done=true).
+
+    Also feeds the per-model rates admission control predicts service times from.
+    """
+    model = data.get("model") or model or "unknown"
+    admission.record({**data, "model": model})
+    if (load := data.get("load_duration")) is not None:
+        LOAD_TIME.labels(model).observe(load / 1e9)
+    if "prompt_eval_duration" in data or "load_duration" in data:
+        TTFT.labels(model).observe((data.get("load_duration", 0) + data.get("prompt_eval_duration", 0)) / 1e9)
+    if data.get("eval_count") and data.get("eval_duration"):
+        TOKENS_PER_SECOND.labels(model).observe(data["eval_count"] / data["eval_duration"] * 1e9)
+        TOKENS.labels(model, "completion").inc(data["eval_count"])
+    if data.get("prompt_eval_count"):
+        TOKENS.labels(model, "prompt").inc(data["prompt_eval_count"])
+
+def route_of(request) -> str:
+    """Route template (e.g. /api/v1/async/status/{task_id}) so labels don't explode per id."""
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+# === Exposition ===
+
+def render() -> tuple[bytes, str]:
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+def start_worker_exporter():
+    if not settings.METRICS_ENABLED or not settings.METRICS_WORKER_PORT:
+        return
+    try:
+        if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            start_http_server(settings.METRICS_WORKER_PORT, registry=registry)
+        else:
+            start_http_server(settings.METRICS_WORKER_PORT)
+        log.info(f"Worker metrics on :{settings.METRICS_WORKER_PORT}")
+    except OSError as e:  # Another worker on this host already serves the port
+        log.warning(f"Worker metrics exporter not started: {e}")
@@ -0,0 +1,187 @@
+"""Model preparation: parallel pulls and warmups with progress.
+
+prepare() works on every (host, model) pair at once:
+  - pull: skipped when the host already has the model, otherwise Ollama's
+    streamed /api/pull progress is followed; pulls are network/disk bound and
+    all run in parallel;
+  - load: a one-token generation (num_predict=1) loads the model without a
+    full answer. Loads on one host start together while they fit in
+    GPU_VRAM_GB (per-model VRAM as in residency.vram); one that doesn't fit
+    waits until the others finish, so concurrent loads never evict each other.
+
+A model is usable as soon as one host has loaded it (the backend pool routes
+there), so on_ready(model) fires then and a queue can start consuming without
+waiting for the other models or hosts.
+
+Progress per host and model is kept in the Redis hash PROGRESS_KEY, so
+GET /api/v1/models/progress can report it from any process.
+"""
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+import redis
+import requests
+from config import settings, get_logger
+from redis_pool import get_redis
+import residency
+
+log = get_logger("preload")
+
+PROGRESS_KEY = "preload:progress"
+PROGRESS_TTL = 60 * 60 * 24
+FINAL_PHASES = ("ready", "failed")
+
+_session = requests.Session()
+_running = threading.Lock()
+
+# === Progress ===
+
+def _report(host: str, model: str, phase: str, **detail):
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hset(PROGRESS_KEY, f"{host}|{model}", json.dumps({"phase": phase, **detail, "updated_at": time.time()}))
+        pipe.expire(PROGRESS_KEY, PROGRESS_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        log.debug(f"Progress not recorded: {e}")
+
+def progress(raw: dict = None) -> dict:
+    """{host: {model: state}} from the progress hash (or an HGETALL result already fetched)."""
+    out = {}
+    for field, value in (get_redis().hgetall(PROGRESS_KEY) if raw is None else raw).items():
+        host, model = field.decode().rsplit("|", 1)
+        out.setdefault(host, {})[model] = json.loads(value)
+    return out
+
+# === Steps ===
+
+class _VramBudget:
+    """Concurrent loads on one host while they fit; an oversized one waits until it would load alone."""
+
+    def __init__(self, gb: float):
+        self.free = gb or float("inf")
+        self.loading = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, need: float):
+        with self.cond:
+            self.cond.wait_for(lambda: need <= self.free or self.loading == 0)
+            self.free -= need  # Stays resident after loading
+            self.loading += 1
+
+    def release(self):
+        with self.cond:
+            self.loading -= 1
+            self.cond.notify_all()
+
+def _installed(host: str) -> set[str]:
+    r = _session.get(f"{host}/api/tags", timeout=10)
+    r.raise_for_status()
+    return {m["name"] for m in r.json().get("models", [])}
+
+def _pull(host: str, model: str):
+    last = 0.0
+    with _session.post(f"{host}/api/pull", json={"name": model, "stream": True}, stream=True, timeout=(10, 300)) as r:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if not line:
+                continue
+            data = json.loads(line)
+            if "error" in data:
+                raise RuntimeError(data["error"])
+            if time.time() - last >= 1:  # Ollama sends many lines per second
+                last = time.time()
+                _report(host, model, "pulling", status=data.get("status"), completed=data.get("completed"),
+                        total=data.get("total"))
+
+def _load(host: str, model: str):
+    r = _session.post(f"{host}/api/generate", timeout=600, json={  # 10 min for cold start
+        "model": model, "prompt": "Hi", "stream": False, "options": {"num_predict": 1},
+        "keep_alive": settings.KEEP_ALIVE,
+    })
+    r.raise_for_status()
+
+# === Orchestration ===
+
+def prepare(models: list[str] = None, pull: bool = True, load: bool = True,
+            on_ready: Callable[[str], None] = None) -> dict:
+    """Pull (if missing) and load models on every Ollama host in parallel; blocks until all are done.
+
+    Per model the result is "ready", "ready on <hosts>; failed on ..." or
+    "failed: ..." (no host); all_ready is true when every model is ready on
+    at least one host. With load=False "ready" means pulled. on_ready(model) is called once per
+    model, from a worker thread, when the first host has it ready.
+    """
+    models = list(dict.fromkeys(models or settings.MODELS.values()))
+    budgets = {h: _VramBudget(settings.GPU_VRAM_GB) for h in settings.OLLAMA_HOSTS}
+    errors: dict[str, list[str]] = {m: [] for m in models}
+    ready: dict[str, list[str]] = {m: [] for m in models}  # Hosts per model
+    announced: set[str] = set()
+    lock = threading.Lock()
+
+    def job(host: str, model: str, installed: set[str] | None):
+        try:
+            if pull and (installed is None or model not in installed):
+                _report(host, model, "pulling")
+                _pull(host, model)
+            if load:
+                _report(host, model, "waiting")  # For VRAM
+                budgets[host].acquire(residency.vram(model))
+                try:
+                    _report(host, model, "loading")
+                    _load(host, model)
+                finally:
+                    budgets[host].release()
+        except Exception as e:
+            _report(host, model, "failed", error=str(e)[:200])
+            log.warning(f"{model} on {host}: {e}")
+            with lock:
+                errors[model].append(f"{host}: {str(e)[:50]}")
+            return
+        _report(host, model, "ready")
+        with lock:
+            ready[model].append(host)
+            first = model not in announced
+            announced.add(model)
+        if first and on_ready:
+            on_ready(model)
+
+    def host_installed(host: str) -> set[str] | None:
+        try:
+            return _installed(host)
+        except (requests.RequestException, ValueError):
+            return None  # Try the pull anyway; it fails fast if the host is down
+
+    for host in settings.OLLAMA_HOSTS:
+        for model in models:
+            _report(host, model, "queued")  # Replaces the previous run's final state
+    installed = {h: host_installed(h) for h in settings.OLLAMA_HOSTS}
+    with ThreadPoolExecutor(max_workers=len(models) * len(settings.OLLAMA_HOSTS), thread_name_prefix="preload") as pool:
+        for host in settings.OLLAMA_HOSTS:
+            for model in models:
+                pool.submit(job, host, model, installed[host])
+    results = {m: _outcome(ready[m], errors[m]) for m in models}
+    return {"models": results, "all_ready": all(ready[m] for m in models)}
+
+def _outcome(ready: list[str], errors: list[str]) -> str:
+    """"ready" on every host, "ready on X; failed on Y: ..." when some failed, "failed: ..." when none is ready."""
+    if not errors:
+        return "ready"
+    if not ready:
+        return f"failed: {'; '.join(errors)}"
+    return f"ready on {', '.join(sorted(ready))}; failed on {'; '.join(errors)}"
+
+def start(models: list[str] = None, pull: bool = True) -> bool:
+    """Run prepare() in the background; False if a run from this process is still going."""
+    if not _running.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            prepare(models, pull=pull)
+        finally:
+            _running.release()
+    threading.Thread(target=run, name="preload", daemon=True).start()
+    return True
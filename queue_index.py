@@ -0,0 +1,108 @@
+"""Queue position index.
+
+Per-queue sorted set of pending task ids scored by priority, then a global
+submit sequence (the order the broker dispatches them), maintained at submit
+time (API) and removed at task start (worker prerun), so position lookups are
+ZRANK (O(log n)) instead of scanning the broker lists.
+Average task duration per queue (EMA, updated at postrun) drives wait estimates.
+
+The Redis broker keeps one list per priority step: <queue> for step 0 and
+<queue><SEP><step> for the others (kombu priority_steps, see celery_app).
+"""
+import redis
+from config import settings, get_concurrency, get_logger
+from redis_pool import get_redis
+
+log = get_logger("queue_index")
+
+PREFIX = "qidx:"
+SEQ_KEY = PREFIX + "seq"
+QUEUES = [settings.QUEUE_GENERAL, settings.QUEUE_JSON, settings.QUEUE_VISION]
+PRIORITY_STEPS = sorted(set(settings.PRIORITY_CLASSES.values()))
+PRIORITY_NAMES = {v: k for k, v in settings.PRIORITY_CLASSES.items()}
+SEP = ":"  # Broker sub-queue separator (broker_transport_options["sep"])
+PRIORITY_SCALE = 10 ** 12  # Score = priority * scale + sequence
+EMA_ALPHA = 0.2
+
+def _key(queue: str) -> str:
+    return PREFIX + queue
+
+def _avg_key(queue: str) -> str:
+    return PREFIX + "avg:" + queue
+
+def broker_lists(queue: str) -> dict[int, str]:
+    """Priority step -> broker list holding that step's messages."""
+    return {step: f"{queue}{SEP}{step}" if step else queue for step in PRIORITY_STEPS}
+
+def add(entries: list[tuple[str, str, int]]):
+    """Index (queue, task_id, priority) in dispatch order (two round trips for any batch size)."""
+    if not entries:
+        return
+    try:
+        r = get_redis()
+        last = r.incrby(SEQ_KEY, len(entries))
+        pipe = r.pipeline(transaction=False)
+        for i, (queue, task_id, priority) in enumerate(entries):
+            pipe.zadd(_key(queue), {task_id: priority * PRIORITY_SCALE + last - len(entries) + i + 1})
+        pipe.execute()
+    except redis.RedisError as e:
+        log.warning(f"Could not index tasks: {e}")
+
+def remove(task_id: str, queue: str = None):
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for q in [queue] if queue else QUEUES:
+            pipe.zrem(_key(q), task_id)
+        pipe.execute()
+    except redis.RedisError as e:
+        log.warning(f"Could not unindex {task_id[:8]}: {e}")
+
+def record_duration(queue: str, seconds: float):
+    """Fold one task duration into the queue's moving average."""
+    try:
+        r = get_redis()
+        prev = r.get(_avg_key(queue))
+        avg = seconds if prev is None else EMA_ALPHA * seconds + (1 - EMA_ALPHA) * float(prev)
+        r.set(_avg_key(queue), avg)
+    except redis.RedisError as e:
+        log.warning(f"Could not record duration: {e}")
+
+def average_durations(r: redis.Redis = None) -> dict[str, float | None]:
+    """Moving-average task duration per queue (None until a task has finished there)."""
+    avgs = (r or get_redis()).mget([_avg_key(q) for q in QUEUES])
+    return {q: None if avg is None else float(avg) for q, avg in zip(QUEUES, avgs)}
+
+def priority_depths(r: redis.Redis = None) -> dict[str, dict[str, int]]:
+    """Pending messages per queue and priority class (broker list lengths), one round trip."""
+    pipe = (r or get_redis()).pipeline(transaction=False)
+    for q in QUEUES:
+        for name in broker_lists(q).values():
+            pipe.llen(name)
+    counts = iter(pipe.execute())
+    return {q: {PRIORITY_NAMES[step]: next(counts) for step in PRIORITY_STEPS} for q in QUEUES}
+
+def depths(r: redis.Redis = None) -> dict[str, int]:
+    """Pending messages per queue (all priority lists), one round trip."""
+    return {q: sum(by_class.values()) for q, by_class in priority_depths(r).items()}
+
+def position(task_id: str) -> dict | None:
+    """Queue, 1-based position, depth and estimated wait for a pending task."""
+    r = get_redis()
+    pipe = r.pipeline(transaction=False)
+    for q in QUEUES:
+        pipe.zrank(_key(q), task_id)
+        pipe.zcard(_key(q))
+        pipe.get(_avg_key(q))
+        pipe.zscore(_key(q), task_id)
+    res = pipe.execute()
+    for i, q in enumerate(QUEUES):
+        rank, total, avg, score = res[i * 4:i * 4 + 4]
+        if rank is not None:
+            pos = rank + 1
+            resp = {"queue": q, "position": pos, "total": total,
+                    "priority": PRIORITY_NAMES.get(int(score // PRIORITY_SCALE))}
+            if avg is not None:
+                # Tasks ahead drain in parallel batches of the queue's concurrency
+                resp["estimated_wait_s"] = round(-(-pos // get_concurrency(q)) * float(avg), 1)
+            return resp
+    return None
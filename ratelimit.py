@@ -0,0 +1,79 @@
+"""Distributed token-bucket rate limiter backed by Redis.
+
+One small hash per client key, refilled lazily inside an atomic Lua script
+(O(1) per request, keys expire once the bucket would be full again), so the
+limit holds across uvicorn workers and API replicas.
+"""
+import math
+import redis
+from dataclasses import dataclass
+from config import settings, get_logger
+from redis_pool import get_async_redis
+
+log = get_logger("ratelimit")
+
+PREFIX = "ratelimit:"
+
+# KEYS[1]=bucket  ARGV: rate (tokens/s), burst -> {allowed, tokens, retry_after}
+_BUCKET_LUA = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+local retry = 0
+if allowed == 0 then retry = (1 - tokens) / rate end
+return {allowed, tostring(tokens), tostring(retry)}
+"""
+
+@dataclass
+class Decision:
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: int  # Seconds until one request is allowed again
+    reset: int        # Seconds until the bucket is full
+
+    def headers(self) -> dict:
+        h = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(self.reset),
+        }
+        if not self.allowed:
+            h["Retry-After"] = str(self.retry_after)
+        return h
+
+def limits_for(key: str) -> tuple[int, int]:
+    """(requests per minute, burst) for a client key; per-key overrides from config."""
+    limit, burst = settings.RATE_LIMIT_OVERRIDES.get(key, (settings.RATE_LIMIT, settings.RATE_LIMIT_BURST))
+    return limit, burst or limit
+
+async def check(key: str) -> Decision | None:
+    """Take one token for key. None if the limiter is unavailable (fail open)."""
+    limit, burst = limits_for(key)
+    if limit == 0:  # Blocked key: no bucket to refill
+        return Decision(allowed=False, limit=0, remaining=0, retry_after=60, reset=60)
+    rate = limit / 60
+    try:
+        allowed, tokens, retry = await get_async_redis().eval(_BUCKET_LUA, 1, PREFIX + key, rate, burst)
+    except redis.RedisError as e:
+        log.warning(f"Rate limiter unavailable, allowing request: {e}")
+        return None
+    tokens, retry = float(tokens), float(retry)
+    return Decision(
+        allowed=bool(allowed),
+        limit=limit,
+        remaining=int(tokens),
+        retry_after=math.ceil(retry),
+        reset=math.ceil((burst - tokens) / rate),
+    )
@@ -0,0 +1,19 @@
+"""Shared Redis connection pools (one pool per URL, per process)."""
+import redis
+import redis.asyncio as aioredis
+from config import settings
+
+_pools: dict[str, redis.ConnectionPool] = {}
+_async_pools: dict[str, aioredis.ConnectionPool] = {}
+
+def get_redis(url: str = None) -> redis.Redis:
+    url = url or settings.CELERY_BROKER_URL
+    if url not in _pools:
+        _pools[url] = redis.ConnectionPool.from_url(url)
+    return redis.Redis(connection_pool=_pools[url])
+
+def get_async_redis(url: str = None) -> aioredis.Redis:
+    url = url or settings.CELERY_BROKER_URL
+    if url not in _async_pools:
+        _async_pools[url] = aioredis.ConnectionPool.from_url(url)
+    return aioredis.Redis(connection_pool=_async_pools[url])
@@ -0,0 +1,187 @@
+"""Model residency tracking and residency-aware dispatch.
+
+Watches which models Ollama has loaded (/api/ps) and how deep each queue is,
+and from that decides:
+  - which queues workers should consume right now: queues whose model is
+    resident go first, other queues only if their model fits in the VRAM
+    budget (GPU_VRAM_GB per Ollama host) next to it, so interleaved work
+    doesn't evict and reload models;
+  - when a waiting queue gets its turn (after RESIDENCY_MAX_WAIT_S), it keeps
+    it for RESIDENCY_DWELL_S so its backlog runs as one same-model batch;
+  - keep_alive per request: long while the model's queue has backlog, short
+    when it is idle and another queue is waiting for VRAM.
+
+Every worker computes the same plan from shared state (Ollama + Redis) and
+only toggles its own queues, so it works for per-queue and combined workers.
+"""
+import time
+import threading
+import requests
+import redis
+from config import settings, get_logger
+from redis_pool import get_redis
+import queue_index
+
+log = get_logger("residency")
+
+TURN_KEY = "residency:turn"
+WAITING_PREFIX = "residency:waiting:"
+WAITING_TTL = 3 * settings.RESIDENCY_DWELL_S
+QUEUES = queue_index.QUEUES
+
+_snapshot = {"at": 0.0, "loaded": {}, "hosts": {}, "depths": {}, "turn": None, "waiting": {}}
+_lock = threading.Lock()
+
+# === State ===
+
+def loaded_per_host() -> dict[str, dict[str, float]]:
+    """{host: {model: VRAM in GB}} for the Ollama hosts that answered (raises if none does)."""
+    hosts, error = {}, None
+    for host in settings.OLLAMA_HOSTS:
+        try:
+            r = requests.get(f"{host}/api/ps", timeout=2)
+            r.raise_for_status()
+            hosts[host] = {m["name"]: m.get("size_vram", 0) / 1e9 for m in r.json().get("models", [])}
+        except requests.RequestException as e:
+            error = e
+    if not hosts:
+        raise error
+    return hosts
+
+def loaded_models(hosts: dict[str, dict[str, float]] = None) -> dict[str, float]:
+    """Models currently in memory on any Ollama host -> VRAM in GB (raises if no host answers)."""
+    loaded = {}
+    for models in (loaded_per_host() if hosts is None else hosts).values():
+        for name, gb in models.items():
+            loaded[name] = max(loaded.get(name, 0.0), gb)
+    return loaded
+
+def refresh() -> dict:
+    """Re-read loaded models, queue depths and turn state (blocking)."""
+    with _lock:
+        try:
+            hosts = loaded_per_host()
+            _snapshot["hosts"], _snapshot["loaded"] = hosts, loaded_models(hosts)
+        except (requests.RequestException, ValueError):
+            pass  # Keep last known residency
+        try:
+            r = get_redis()
+            _snapshot["depths"] = queue_index.depths(r)
+            pipe = r.pipeline(transaction=False)
+            pipe.get(TURN_KEY)
+            for q in QUEUES:
+                pipe.get(WAITING_PREFIX + q)
+            turn, *waiting = pipe.execute()
+            _snapshot["turn"] = turn.decode() if turn else None
+            _snapshot["waiting"] = {q: float(w) for q, w in zip(QUEUES, waiting) if w}
+        except redis.RedisError as e:
+            log.warning(f"Queue state unavailable: {e}")
+        _snapshot["at"] = time.time()
+        return _snapshot
+
+def snapshot() -> dict:
+    """Last known state; a stale one triggers a background refresh so request paths never block."""
+    if time.time() - _snapshot["at"] >= settings.RESIDENCY_REFRESH_S and not _lock.locked():
+        _snapshot["at"] = time.time()  # Only one refresher per interval
+        threading.Thread(target=refresh, daemon=True).start()
+    return _snapshot
+
+def vram(model: str, loaded: dict = None) -> float:
+    """Configured VRAM need for a model, else what Ollama reports, else the default."""
+    return settings.MODEL_VRAM_GB.get(model) or (loaded or {}).get(model) or settings.RESIDENCY_DEFAULT_VRAM_GB
+
+# === Decisions ===
+
+def plan(snap: dict, now: float = None) -> tuple[set[str], str | None]:
+    """Queues that should consume now, and the queue holding the turn (if any)."""
+    now = now or time.time()
+    depths, loaded = snap["depths"], snap["loaded"]
+    busy = [q for q in QUEUES if depths.get(q)]
+    resident = {q for q in QUEUES if settings.MODELS[q] in loaded}
+    if not busy or not settings.GPU_VRAM_GB:
+        return set(QUEUES), None
+
+    turn = snap["turn"] if snap["turn"] in busy else None
+    starving = [q for q in busy if q not in resident and now - snap["waiting"].get(q, now) >= settings.RESIDENCY_MAX_WAIT_S]
+    if turn:
+        lead = turn
+    elif starving:
+        lead = turn = max(starving, key=lambda q: depths[q])
+    else:
+        lead = max(busy, key=lambda q: (q in resident, depths[q]))
+
+    allowed = {lead} | (resident - set(busy))  # Idle resident queues cost nothing
+    hosts = snap.get("hosts") or {"": loaded}
+    budget = {h: settings.GPU_VRAM_GB for h in hosts}
+    placed: set[tuple[str, str]] = set()  # (host, model) already charged
+    for q in [lead] + sorted((q for q in busy if q != lead), key=lambda q: (q not in resident, -depths[q])):
+        model = settings.MODELS[q]
+        need = vram(model, loaded)
+        # The host that has the model, else the one with the most room
+        host = max(hosts, key=lambda h: (model in hosts[h], budget[h]))
+        if (host, model) in placed:
+            allowed.add(q)  # Another busy queue on the same model
+        elif q == lead or need <= budget[host]:
+            allowed.add(q)
+            budget[host] -= need
+            placed.add((host, model))
+    return allowed, turn
+
+def keep_alive(model: str) -> str:
+    """keep_alive for a request: hold the model while its queue has backlog, release early when others wait."""
+    if not settings.RESIDENCY_SCHEDULING:
+        return settings.KEEP_ALIVE
+    queue = next((q for q, m in settings.MODELS.items() if m == model), None)
+    if queue is None:
+        return settings.KEEP_ALIVE
+    snap = snapshot()
+    depths, loaded = snap["depths"], snap["loaded"]
+    if depths.get(queue):
+        return settings.RESIDENCY_KEEP_ALIVE_BUSY
+    waiting = [q for q in QUEUES if depths.get(q) and settings.MODELS[q] not in loaded]
+    return settings.RESIDENCY_KEEP_ALIVE_YIELD if waiting else settings.KEEP_ALIVE
+
+# === Worker-side scheduler ===
+
+class Scheduler(threading.Thread):
+    """Pauses/resumes this worker's queue consumers according to plan()."""
+
+    def __init__(self, app, hostname: str, queues: list[str]):
+        super().__init__(name="residency-scheduler", daemon=True)
+        self.app, self.hostname = app, hostname
+        self.queues = [q for q in queues if q in QUEUES]
+        self.active = set(self.queues)
+
+    def run(self):
+        log.info(f"Residency scheduling for {self.queues} on {self.hostname}")
+        while True:
+            try:
+                self.tick()
+            except Exception as e:  # Never let scheduling take the worker down
+                log.warning(f"Residency tick failed: {e}")
+            time.sleep(settings.RESIDENCY_REFRESH_S)
+
+    def tick(self):
+        snap = refresh()
+        allowed, turn = plan(snap)
+        r = get_redis()
+        if turn and turn != snap["turn"]:
+            r.set(TURN_KEY, turn, nx=True, ex=settings.RESIDENCY_DWELL_S)
+        for q in self.queues:
+            want = q in allowed
+            if want or not snap["depths"].get(q):
+                r.delete(WAITING_PREFIX + q)  # Served, or went idle: a later backlog starts a fresh wait
+            else:
+                # Start stays as first set; the TTL (renewed while waiting) drops it if no worker renews it
+                pipe = r.pipeline(transaction=False)
+                pipe.set(WAITING_PREFIX + q, time.time(), nx=True, ex=WAITING_TTL)
+                pipe.expire(WAITING_PREFIX + q, WAITING_TTL)
+                pipe.execute()
+            if want and q not in self.active:
+                self.app.control.add_consumer(q, destination=[self.hostname], reply=False)
+                self.active.add(q)
+                log.info(f"Resume {q} ({settings.MODELS[q]})")
+            elif not want and q in self.active:
+                self.app.control.cancel_consumer(q, destination=[self.hostname], reply=False)
+                self.active.discard(q)
+                log.info(f"Pause {q} ({settings.MODELS[q]} not resident)")
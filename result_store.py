@@ -0,0 +1,114 @@
+"""Compact task result storage.
+
+Celery result backend on its own Redis DB (CELERY_RESULT_BACKEND) that keeps
+Redis small without changing what callers see:
+  - encoded results above RESULT_COMPRESS_MIN_BYTES are zlib-compressed;
+  - results still above RESULT_OFFLOAD_MIN_BYTES after compression are written
+    to a content-addressed file under RESULT_STORE_DIR and only a reference
+    is kept in Redis;
+  - decode() reverses both, so AsyncResult, mget + decode_result and the
+    result pub/sub channel all return the original meta.
+
+Stored value markers (JSON never starts with a NUL byte):
+  \\x00z<zlib data> | \\x00f<sha256 hex of the file contents>
+
+Files live for CELERY_RESULT_EXPIRES (by mtime; rewriting identical content
+refreshes it) and are swept in the background. consume() shortens the TTL of
+fetched results for expire-on-fetch.
+"""
+import os
+import time
+import zlib
+import hashlib
+import threading
+from celery.backends.redis import RedisBackend
+from config import settings, get_logger
+
+log = get_logger("result_store")
+
+COMPRESSED = b"\x00z"
+OFFLOADED = b"\x00f"
+
+_last_sweep = 0.0
+
+def _path(digest: str) -> str:
+    return os.path.join(settings.RESULT_STORE_DIR, digest[:2], digest)
+
+def _write(blob: bytes) -> str:
+    digest = hashlib.sha256(blob).hexdigest()
+    path = _path(digest)
+    if os.path.exists(path):
+        os.utime(path)  # Same content stored again: keep it for the new result's lifetime
+        return digest
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+    os.replace(tmp, path)  # Atomic: readers never see a partial file
+    _maybe_sweep()
+    return digest
+
+def _read(digest: str) -> bytes:
+    with open(_path(digest), "rb") as f:
+        return f.read()
+
+def pack(payload: str | bytes) -> str | bytes:
+    raw = payload.encode() if isinstance(payload, str) else payload
+    if len(raw) < settings.RESULT_COMPRESS_MIN_BYTES:
+        return payload
+    blob = zlib.compress(raw, settings.RESULT_COMPRESS_LEVEL)
+    if len(blob) < settings.RESULT_OFFLOAD_MIN_BYTES:
+        return COMPRESSED + blob
+    return OFFLOADED + _write(blob).encode()
+
+def unpack(value: str | bytes | None) -> str | bytes | None:
+    if not isinstance(value, bytes) or not value.startswith(b"\x00"):
+        return value
+    if value.startswith(COMPRESSED):
+        return zlib.decompress(value[len(COMPRESSED):])
+    if value.startswith(OFFLOADED):
+        return zlib.decompress(_read(value[len(OFFLOADED):].decode()))
+    return value
+
+def _sweep():
+    cutoff = time.time() - settings.CELERY_RESULT_EXPIRES
+    removed = 0
+    for root, _, files in os.walk(settings.RESULT_STORE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass  # Removed concurrently
+    if removed:
+        log.info(f"Removed {removed} expired result files")
+
+def _maybe_sweep():
+    global _last_sweep
+    if time.time() - _last_sweep >= settings.RESULT_SWEEP_S:
+        _last_sweep = time.time()
+        threading.Thread(target=_sweep, name="result-sweep", daemon=True).start()
+
+class CompactRedisBackend(RedisBackend):
+    """RedisBackend that compresses / offloads encoded results (see module docstring)."""
+
+    def encode(self, data):
+        return pack(super().encode(data))
+
+    def decode(self, payload):
+        return super().decode(unpack(payload))
+
+def consume(backend, task_ids: list[str]):
+    """Expire fetched results after RESULT_FETCHED_TTL seconds (0 = now)."""
+    if not task_ids:
+        return
+    pipe = backend.client.pipeline(transaction=False)
+    for task_id in task_ids:
+        key = backend.get_key_for_task(task_id)
+        if settings.RESULT_FETCHED_TTL:
+            pipe.expire(key, settings.RESULT_FETCHED_TTL)
+        else:
+            pipe.delete(key)
+    pipe.execute()
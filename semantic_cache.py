@@ -0,0 +1,224 @@
+"""Semantic response cache: near-duplicate prompts reuse a cached answer.
+
+Only free-text answers are cached: chat and synthesize tasks without a
+format, at temperatures up to SEMANTIC_CACHE_MAX_TEMPERATURE. Extraction
+and JSON output depend on the exact input, so a near match would return
+another document's data.
+
+The prompt (for chat, the last user message) is embedded with
+SEMANTIC_CACHE_EMBED_MODEL (Ollama /api/embed, via the client) and looked up
+by cosine similarity in an in-memory index per scope. A scope is everything
+besides the prompt that shapes the answer and must match exactly: kind,
+model, system prompt, options and, for chat, the earlier messages - so
+answers never cross models, instructions or conversations. A match at or
+above SEMANTIC_CACHE_THRESHOLD returns the cached answer without a
+generation.
+
+Each index keeps unit vectors packed in one float32 matrix (search is one
+matrix-vector product) with answers and last-use times alongside. Entries are
+evicted least-recently-used per index (SEMANTIC_CACHE_MAX_ENTRIES) and across
+indexes (SEMANTIC_CACHE_MAX_BYTES). Indexes are saved to
+SEMANTIC_CACHE_DIR every SEMANTIC_CACHE_SAVE_S and at exit, and loaded on
+first use; each process keeps its own copy (last writer wins on disk).
+
+Optional: needs numpy, disabled without it.
+"""
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+from config import settings, get_logger
+import metrics
+
+try:
+    import numpy as np
+except ImportError:  # Optional dependency
+    np = None
+
+log = get_logger("semantic_cache")
+
+# === Index ===
+
+class Index:
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.vectors = np.empty((16, dim), dtype=np.float32)
+        self.last_used = np.empty(16, dtype=np.float64)
+        self.answers: list[str] = []
+        self.answer_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self) * (self.dim * 4 + 8) + self.answer_bytes
+
+    def search(self, vector) -> tuple[int, float]:
+        n = len(self)
+        if not n:
+            return -1, 0.0
+        sims = self.vectors[:n] @ vector
+        i = int(np.argmax(sims))
+        return i, float(sims[i])
+
+    def add(self, vector, answer: str):
+        n = len(self)
+        if n == len(self.vectors):  # Grow by doubling, rows stay contiguous
+            self.vectors = np.resize(self.vectors, (n * 2, self.dim))
+            self.last_used = np.resize(self.last_used, n * 2)
+        self.vectors[n] = vector
+        self.last_used[n] = time.time()
+        self.answers.append(answer)
+        self.answer_bytes += len(answer.encode())
+
+    def evict_oldest(self):
+        """Drop the least recently used entry (the last row moves into its slot)."""
+        n = len(self)
+        i = int(np.argmin(self.last_used[:n]))
+        self.answer_bytes -= len(self.answers[i].encode())
+        self.vectors[i] = self.vectors[n - 1]
+        self.last_used[i] = self.last_used[n - 1]
+        self.answers[i] = self.answers[n - 1]
+        self.answers.pop()
+
+    def oldest(self) -> float:
+        return float(self.last_used[:len(self)].min()) if len(self) else float("inf")
+
+# === Cache ===
+
+_indexes: dict[str, Index] = {}
+_dirty: set[str] = set()
+_load_tried: set[str] = set()
+_lock = threading.Lock()
+_saver_started = False
+
+TASKS = ("chat", "synthesize")  # Free-text tasks; see module docstring
+
+def enabled(mode: str = None, temperature: float = 0.0) -> bool:
+    return (np is not None and settings.SEMANTIC_CACHE_ENABLED and mode != "bypass"
+            and temperature <= settings.SEMANTIC_CACHE_MAX_TEMPERATURE)
+
+def scope(kind: str, payload: dict, task: str = "chat") -> tuple[str, str] | None:
+    """(scope id, text to embed) for a generate/chat payload; None if it can't be cached semantically."""
+    if task not in TASKS or payload.get("format") or payload.get("images"):
+        return None
+    if kind == "chat":
+        messages = payload["messages"]
+        last = next((i for i in range(len(messages) - 1, -1, -1) if messages[i]["role"] == "user"), None)
+        if last is None or messages[last].get("images"):
+            return None
+        text, earlier = messages[last]["content"], messages[:last] + messages[last + 1:]
+        shape = [kind, payload["model"], payload.get("system"), earlier, payload.get("options")]
+    else:
+        text = payload["prompt"]
+        shape = [kind, payload["model"], payload.get("system") or "", payload.get("options")]
+    return hashlib.sha256(json.dumps(shape, sort_keys=True).encode()).hexdigest()[:24], text
+
+def normalize(vector: list[float]):
+    v = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    return v / norm if norm else None
+
+def lookup(scope_id: str, vector) -> str | None:
+    with _lock:
+        index = _indexes.get(scope_id) or _load(scope_id)
+        if index is None or index.dim != len(vector):
+            metrics.CACHE.labels("semantic_miss").inc()
+            return None
+        i, score = index.search(vector)
+        if i < 0 or score < settings.SEMANTIC_CACHE_THRESHOLD:
+            metrics.CACHE.labels("semantic_miss").inc()
+            return None
+        index.last_used[i] = time.time()
+        metrics.CACHE.labels("semantic_hit").inc()
+        return index.answers[i]
+
+def store(scope_id: str, vector, answer: str):
+    if not isinstance(answer, str) or not answer:
+        return
+    with _lock:
+        index = _indexes.get(scope_id) or _load(scope_id)
+        if index is None or index.dim != len(vector):
+            index = _indexes[scope_id] = Index(len(vector))  # New scope, or the embedding model changed
+        index.add(vector, answer)
+        while len(index) > settings.SEMANTIC_CACHE_MAX_ENTRIES:
+            index.evict_oldest()
+        _enforce_memory()
+        _dirty.add(scope_id)
+    _start_saver()
+
+def _enforce_memory():
+    total = sum(ix.nbytes for ix in _indexes.values())
+    while total > settings.SEMANTIC_CACHE_MAX_BYTES:
+        victim = min(_indexes.values(), key=Index.oldest)
+        before = victim.nbytes
+        victim.evict_oldest()
+        total -= before - victim.nbytes
+
+def stats() -> dict:
+    with _lock:
+        return {"enabled": enabled(), "indexes": len(_indexes), "entries": sum(len(ix) for ix in _indexes.values()),
+                "bytes": sum(ix.nbytes for ix in _indexes.values())}
+
+# === Persistence ===
+
+def _path(scope_id: str) -> str:
+    return os.path.join(settings.SEMANTIC_CACHE_DIR, scope_id)
+
+def _load(scope_id: str) -> Index | None:
+    """Index saved for scope by an earlier run, read once per process (caller holds _lock)."""
+    if scope_id in _load_tried:
+        return None
+    _load_tried.add(scope_id)
+    base = _path(scope_id)
+    try:
+        with open(base + ".json") as f:
+            meta = json.load(f)
+        if meta["embed_model"] != settings.SEMANTIC_CACHE_EMBED_MODEL:
+            return None
+        with np.load(base + ".npz") as arrays:
+            vectors, last_used = arrays["vectors"], arrays["last_used"]
+    except (OSError, ValueError, KeyError):
+        return None
+    index = Index(vectors.shape[1])
+    for vector, used, answer in zip(vectors, last_used, meta["answers"]):
+        index.add(vector, answer)
+        index.last_used[len(index) - 1] = used
+    _indexes[scope_id] = index
+    _enforce_memory()
+    return index
+
+def save():
+    with _lock:
+        dirty = [(s, _indexes[s]) for s in _dirty if s in _indexes]
+        snapshots = [(s, ix.vectors[:len(ix)].copy(), ix.last_used[:len(ix)].copy(), list(ix.answers)) for s, ix in dirty]
+        _dirty.clear()
+    if not snapshots:
+        return
+    os.makedirs(settings.SEMANTIC_CACHE_DIR, exist_ok=True)
+    for scope_id, vectors, last_used, answers in snapshots:
+        base, tmp = _path(scope_id), f"{_path(scope_id)}.{os.getpid()}.tmp"
+        try:
+            with open(tmp + ".npz", "wb") as f:
+                np.savez(f, vectors=vectors, last_used=last_used)
+            with open(tmp + ".json", "w") as f:
+                json.dump({"embed_model": settings.SEMANTIC_CACHE_EMBED_MODEL, "answers": answers}, f)
+            os.replace(tmp + ".npz", base + ".npz")
+            os.replace(tmp + ".json", base + ".json")
+        except OSError as e:
+            log.warning(f"Could not save semantic index {scope_id}: {e}")
+
+def _save_loop():
+    while True:
+        time.sleep(settings.SEMANTIC_CACHE_SAVE_S)
+        save()
+
+def _start_saver():
+    global _saver_started
+    if not _saver_started:
+        _saver_started = True
+        threading.Thread(target=_save_loop, name="semantic-cache-saver", daemon=True).start()
+        atexit.register(save)
@@ -0,0 +1,116 @@
+"""Server-side chat sessions.
+
+A session keeps its conversation in Redis (TTL refreshed on every turn) plus
+the token context Ollama returns from /api/generate. Each turn sends only the
+new message together with that context, so the backend neither re-tokenizes
+nor re-prefills earlier turns and per-turn cost stays flat.
+
+When the context would exceed SESSION_MAX_CONTEXT_TOKENS it is dropped and
+the next turn is rebuilt from a token-budgeted window of recent messages
+(SESSION_HISTORY_TOKENS), which yields a fresh, smaller context.
+
+A turn is load -> generate -> save, so turns on one session run one at a time
+under a Redis lock (lock()/alock()): two concurrent turns would otherwise both
+start from the same history and the later save would drop the other's. The
+API doesn't wait for the lock (a second turn gets 409 right away); queued
+turns wait up to OLLAMA_TIMEOUT and are retried.
+"""
+import json
+import time
+import uuid
+from redis.exceptions import LockError
+from config import settings, get_model, get_system
+from redis_pool import get_redis, get_async_redis
+import residency
+
+PREFIX = "session:"
+LOCK_PREFIX = "session-lock:"
+
+def new(model: str = None, system: str = None) -> dict:
+    return {
+        "id": uuid.uuid4().hex,
+        "model": model or get_model("chat") or settings.MODELS["general"],
+        "system": system or get_system("chat"),
+        "messages": [],
+        "context": None,
+        "created": time.time(),
+    }
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def window(messages: list[dict], budget: int) -> list[dict]:
+    """Most recent messages that fit in a token budget (oldest dropped first)."""
+    picked, used = [], 0
+    for m in reversed(messages):
+        used += estimate_tokens(m["content"])
+        if used > budget:
+            break
+        picked.append(m)
+    return picked[::-1]
+
+def payload(session: dict, message: str, temperature: float = 0.7, num_predict: int = None) -> dict:
+    """/api/generate payload for the next turn."""
+    options = {"temperature": temperature}
+    if num_predict:
+        options["num_predict"] = num_predict
+    body = {"model": session["model"], "options": options, "keep_alive": residency.keep_alive(session["model"])}
+    context = session.get("context")
+    if context and len(context) + estimate_tokens(message) <= settings.SESSION_MAX_CONTEXT_TOKENS:
+        # Continue from the cached context: system prompt and history are already in it
+        body.update(prompt=message, context=context)
+        return body
+    history = window(session["messages"], settings.SESSION_HISTORY_TOKENS)
+    if history:
+        transcript = "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in history)
+        message = f"Conversation so far:\n{transcript}\n\nUser: {message}"
+    body.update(prompt=message, system=session["system"])
+    return body
+
+def apply(session: dict, message: str, reply: str, context: list[int] | None) -> dict:
+    session["messages"] += [{"role": "user", "content": message}, {"role": "assistant", "content": reply}]
+    # Keep only what a rebuild could ever use
+    session["messages"] = window(session["messages"], settings.SESSION_HISTORY_TOKENS * 4)
+    session["context"] = context
+    return session
+
+def fallback_messages(session: dict, message: str) -> list[dict]:
+    """Chat-style messages for providers without context support."""
+    history = window(session["messages"], settings.SESSION_HISTORY_TOKENS)
+    return [{"role": "system", "content": session["system"]}, *history, {"role": "user", "content": message}]
+
+def public(session: dict) -> dict:
+    return {k: v for k, v in session.items() if k != "context"} | {"context_tokens": len(session.get("context") or [])}
+
+# === Storage ===
+
+def lock(session_id: str):
+    """Lock for one turn; held at most OLLAMA_TIMEOUT x 2, waited for at most OLLAMA_TIMEOUT."""
+    return get_redis().lock(LOCK_PREFIX + session_id, timeout=settings.TIMEOUT * 2, blocking_timeout=settings.TIMEOUT)
+
+def alock(session_id: str):
+    """API-side lock: not waited for, so a concurrent turn gets its 409 at once."""
+    return get_async_redis().lock(LOCK_PREFIX + session_id, timeout=settings.TIMEOUT * 2, blocking=False)
+
+async def aunlock(turn_lock):
+    try:
+        await turn_lock.release()
+    except LockError:
+        pass  # Expired: the turn ran past its lock timeout
+
+def load(session_id: str) -> dict | None:
+    raw = get_redis().get(PREFIX + session_id)
+    return json.loads(raw) if raw else None
+
+def save(session: dict):
+    get_redis().set(PREFIX + session["id"], json.dumps(session), ex=settings.SESSION_TTL)
+
+async def aload(session_id: str) -> dict | None:
+    raw = await get_async_redis().get(PREFIX + session_id)
+    return json.loads(raw) if raw else None
+
+async def asave(session: dict):
+    await get_async_redis().set(PREFIX + session["id"], json.dumps(session), ex=settings.SESSION_TTL)
+
+async def adelete(session_id: str) -> bool:
+    return bool(await get_async_redis().delete(PREFIX + session_id))
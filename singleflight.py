@@ -0,0 +1,331 @@
+"""Single-flight coalescing of identical in-flight requests.
+
+Identical requests (same canonical hash as the response cache) share one
+generation: callers in the same process wait on the leader's call, callers in
+other processes (uvicorn workers, Celery workers) wait on a Redis lease and
+pick up the leader's published outcome - its result, or its error (raised
+as LeaderFailed) so a failing backend isn't retried once per waiter.
+Outcomes are stored per lease token, so a later flight never picks up an
+earlier one's result. The leader renews its lease while it runs (structured
+retries can outlast one OLLAMA_TIMEOUT); if the leader dies, its lease
+expires and a waiter takes over.
+
+Queue submissions are coalesced by a claim on the task id; the claim is
+released again if the task can't be sent, so nobody joins a task that
+doesn't exist.
+
+Streams are coalesced in-process only: late subscribers replay the chunks
+produced so far and then follow the live stream.
+"""
+import json
+import uuid
+import asyncio
+import threading
+from typing import Any, Callable, Awaitable, AsyncGenerator
+import redis
+from config import settings, get_logger
+from redis_pool import get_redis, get_async_redis
+import cache
+
+log = get_logger("singleflight")
+
+LEASE = "sf:lease:"
+RESULT = "sf:result:"
+CHANNEL = "sf:done:"
+TASK = "sf:task:"
+
+class LeaderFailed(Exception):
+    """The coalesced call failed in another process; carries its error."""
+
+# Delete the lease only if we still own it
+_RELEASE_LUA = "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end return 0"
+# Extend the lease only if we still own it
+_EXTEND_LUA = "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('EXPIRE', KEYS[1], ARGV[2]) end return 0"
+
+def flight_key(kind: str, payload: dict, cache_mode: str = None) -> str | None:
+    if not settings.SINGLEFLIGHT_ENABLED or cache_mode == "bypass":
+        return None
+    return cache.request_hash(kind, payload)
+
+# === Sync (Celery workers) ===
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+_calls: dict[str, _Call] = {}
+_calls_lock = threading.Lock()
+
+def run(key: str | None, fn: Callable[[], Any]) -> Any:
+    """Run fn once per key across threads and processes; everyone gets its result."""
+    if key is None:
+        return fn()
+    with _calls_lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+    if not leader:
+        call.event.wait()
+        if call.error:
+            raise call.error
+        return call.result
+    try:
+        call.result = _run_leased(key, fn)
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _calls_lock:
+            _calls.pop(key, None)
+        call.event.set()
+
+def _run_leased(key: str, fn: Callable[[], Any]) -> Any:
+    try:
+        r = get_redis()
+        token = uuid.uuid4().hex
+        while not r.set(LEASE + key, token, nx=True, ex=settings.TIMEOUT):
+            if (raw := _wait_result(r, key)) is not None:
+                return _outcome(raw)
+            # No flight left (leader gone without a result) -> try to take over
+    except redis.RedisError as e:
+        log.warning(f"Lease unavailable, running uncoalesced: {e}")
+        return fn()
+
+    stop = threading.Event()
+    threading.Thread(target=_renew, args=(r, key, token, stop), name="singleflight-lease", daemon=True).start()
+    try:
+        try:
+            result = fn()
+        except Exception as e:
+            _publish(r, key, token, {"error": f"{type(e).__name__}: {e}"})  # Waiters fail too instead of re-running
+            raise
+        _publish(r, key, token, {"result": result})
+        return result
+    finally:
+        stop.set()
+        try:
+            r.eval(_RELEASE_LUA, 1, LEASE + key, token)
+        except redis.RedisError:
+            pass  # Lease expires on its own
+
+def _renew(r: redis.Redis, key: str, token: str, stop: threading.Event):
+    """Keep the lease alive while the leader runs (until stop is set or the lease is lost)."""
+    while not stop.wait(settings.TIMEOUT / 3):
+        try:
+            if not r.eval(_EXTEND_LUA, 1, LEASE + key, token, settings.TIMEOUT):
+                return
+        except redis.RedisError:
+            pass  # Try again next period; the lease still has time left
+
+def _result_key(key: str, token: bytes | str) -> str:
+    """Results are per flight (lease token), so a new flight never sees an earlier one's result."""
+    return f"{RESULT}{key}:{token.decode() if isinstance(token, bytes) else token}"
+
+def _outcome(raw: bytes) -> Any:
+    data = json.loads(raw)
+    if "error" in data:
+        raise LeaderFailed(data["error"])
+    return data["result"]
+
+def _publish(r: redis.Redis, key: str, token: str, outcome: dict):
+    try:
+        r.set(_result_key(key, token), json.dumps(outcome), ex=settings.SINGLEFLIGHT_RESULT_TTL)
+        r.publish(CHANNEL + key, "1")
+    except (redis.RedisError, TypeError) as e:
+        log.warning(f"Could not publish result: {e}")
+
+def _wait_result(r: redis.Redis, key: str) -> bytes | None:
+    """Follow the current flight (and any that takes it over) to its outcome; None once no flight is left."""
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(CHANNEL + key)
+    try:
+        token = r.get(LEASE + key)
+        while token is not None:
+            if (raw := r.get(_result_key(key, token))) is not None:
+                return raw
+            pubsub.get_message(timeout=settings.SINGLEFLIGHT_POLL)
+            if (current := r.get(LEASE + key)) != token:  # Leader done (result published first) or replaced
+                if (raw := r.get(_result_key(key, token))) is not None:
+                    return raw
+                token = current
+        return None
+    finally:
+        pubsub.close()
+
+# === Async (API process) ===
+
+_inflight: dict[str, asyncio.Task] = {}
+
+async def arun(key: str | None, fn: Callable[[], Awaitable[Any]]) -> Any:
+    """Async run(); the shared call is a detached task so one caller disconnecting doesn't cancel it for the rest."""
+    if key is None:
+        return await fn()
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.create_task(_arun_leased(key, fn))
+        task.add_done_callback(lambda t: _inflight.pop(key, None) if _inflight.get(key) is t else None)
+    return await asyncio.shield(task)
+
+async def _arun_leased(key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    try:
+        r = get_async_redis()
+        token = uuid.uuid4().hex
+        while not await r.set(LEASE + key, token, nx=True, ex=settings.TIMEOUT):
+            if (raw := await _await_result(r, key)) is not None:
+                return _outcome(raw)
+    except redis.RedisError as e:
+        log.warning(f"Lease unavailable, running uncoalesced: {e}")
+        return await fn()
+
+    renewer = asyncio.create_task(_arenew(r, key, token))
+    try:
+        try:
+            result = await fn()
+        except Exception as e:
+            await _apublish(r, key, token, {"error": f"{type(e).__name__}: {e}"})
+            raise
+        await _apublish(r, key, token, {"result": result})
+        return result
+    finally:
+        renewer.cancel()
+        try:
+            await r.eval(_RELEASE_LUA, 1, LEASE + key, token)
+        except redis.RedisError:
+            pass
+
+async def _arenew(r, key: str, token: str):
+    while True:
+        await asyncio.sleep(settings.TIMEOUT / 3)
+        try:
+            if not await r.eval(_EXTEND_LUA, 1, LEASE + key, token, settings.TIMEOUT):
+                return
+        except redis.RedisError:
+            pass
+
+async def _apublish(r, key: str, token: str, outcome: dict):
+    try:
+        await r.set(_result_key(key, token), json.dumps(outcome), ex=settings.SINGLEFLIGHT_RESULT_TTL)
+        await r.publish(CHANNEL + key, "1")
+    except (redis.RedisError, TypeError) as e:
+        log.warning(f"Could not publish result: {e}")
+
+async def _await_result(r, key: str) -> bytes | None:
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(CHANNEL + key)
+    try:
+        token = await r.get(LEASE + key)
+        while token is not None:
+            if (raw := await r.get(_result_key(key, token))) is not None:
+                return raw
+            await pubsub.get_message(timeout=settings.SINGLEFLIGHT_POLL)
+            if (current := await r.get(LEASE + key)) != token:
+                if (raw := await r.get(_result_key(key, token))) is not None:
+                    return raw
+                token = current
+        return None
+    finally:
+        await pubsub.aclose()
+
+# === Shared streams (API process) ===
+
+class _Broadcast:
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: Exception = None
+        self.cond = asyncio.Condition()
+        self.subscribers = 0
+        self.task: asyncio.Task = None
+
+_streams: dict[str, _Broadcast] = {}
+
+async def _pump(key: str, b: _Broadcast, open_stream: Callable[[], Awaitable[AsyncGenerator[str, None]]]):
+    try:
+        async for chunk in await open_stream():
+            async with b.cond:
+                b.chunks.append(chunk)
+                b.cond.notify_all()
+    except Exception as e:
+        b.error = e
+    finally:
+        if _streams.get(key) is b:
+            _streams.pop(key)
+        async with b.cond:
+            b.done = True
+            b.cond.notify_all()
+
+async def stream(key: str | None, open_stream: Callable[[], Awaitable[AsyncGenerator[str, None]]]) -> AsyncGenerator[str, None]:
+    """Attach to the running stream for key, or start it. Replays produced chunks first."""
+    if key is None:
+        gen = await open_stream()
+        try:
+            async for chunk in gen:
+                yield chunk
+        finally:
+            await gen.aclose()  # Release the backend connection right away
+        return
+    b = _streams.get(key)
+    if b is None:
+        b = _streams[key] = _Broadcast()
+        b.task = asyncio.create_task(_pump(key, b, open_stream))
+    b.subscribers += 1
+    sent = 0
+    try:
+        while True:
+            async with b.cond:
+                await b.cond.wait_for(lambda: sent < len(b.chunks) or b.done)
+                pending, done = b.chunks[sent:], b.done
+            for chunk in pending:
+                yield chunk
+            sent += len(pending)
+            if done and sent >= len(b.chunks):
+                if b.error:
+                    raise b.error
+                return
+    finally:
+        b.subscribers -= 1
+        if b.subscribers == 0 and not b.done:
+            b.task.cancel()  # Last listener left -> stop the generation
+            if _streams.get(key) is b:
+                _streams.pop(key)
+
+# === Queue submissions ===
+
+def claim_task(kind: str, kwargs: dict, options: dict, task_id: str) -> str:
+    """Register task_id for this exact submission; returns the id already in flight if any.
+
+    options are the send options the caller relies on (priority, deadline,
+    webhook): a submission only joins a task that was sent with the same ones.
+    """
+    return claim_tasks([(kind, kwargs, options, task_id)])[0]
+
+def _task_key(kind: str, kwargs: dict, options: dict) -> str:
+    return TASK + cache.request_hash(kind, {**kwargs, "_options": options})
+
+def claim_tasks(items: list[tuple[str, dict, dict, str]]) -> list[str]:
+    """claim_task for many submissions in one pipelined round trip."""
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for kind, kwargs, options, task_id in items:
+            key = _task_key(kind, kwargs, options)
+            pipe.set(key, task_id, nx=True, ex=settings.SINGLEFLIGHT_TASK_TTL)
+            pipe.get(key)
+        owners = pipe.execute()[1::2]
+        return [o.decode() if o else item[-1] for o, item in zip(owners, items)]
+    except redis.RedisError as e:
+        log.warning(f"Task coalescing unavailable: {e}")
+        return [item[-1] for item in items]
+
+def release_tasks(items: list[tuple[str, dict, dict, str]]):
+    """Drop claims made by claim_tasks for tasks that were never sent (only those still pointing at them)."""
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for kind, kwargs, options, task_id in items:
+            pipe.eval(_RELEASE_LUA, 1, _task_key(kind, kwargs, options), task_id)
+        pipe.execute()
+    except redis.RedisError as e:
+        log.warning(f"Task claims not released (expire in {settings.SINGLEFLIGHT_TASK_TTL}s): {e}")
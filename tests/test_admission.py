@@ -0,0 +1,123 @@
+import asyncio
+import time
+import pytest
+
+redis = pytest.importorskip("redis")
+import admission
+from config import settings
+
+@pytest.fixture(autouse=True)
+def state(monkeypatch):
+    """Fresh rates and a current snapshot, so nothing is read from or published to Redis."""
+    monkeypatch.setattr(admission, "_local", {})
+    monkeypatch.setattr(admission, "_snapshot", {"at": time.time(), "depths": {}, "avg": {}, "rates": {}})
+    monkeypatch.setattr(admission, "get_concurrency", lambda queue: 2)
+    monkeypatch.setattr(settings, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(settings, "ADMISSION_REFRESH_S", float("inf"))
+    monkeypatch.setattr(settings, "ADMISSION_MAX_S", {"general": 60.0})
+    monkeypatch.setattr(settings, "TIMEOUT", 10)
+    monkeypatch.setattr(settings, "OLLAMA_NUM_PARALLEL", 4)
+    return admission._snapshot
+
+def record(model: str = "m", tokens: int = 100, decode_s: float = 2.0, prefill_s: float = 0.5):
+    admission.record({"model": model, "eval_count": tokens, "eval_duration": decode_s * 1e9,
+                      "prompt_eval_duration": prefill_s * 1e9})
+
+# === Rates ===
+
+def test_service_time_from_eval_stats():
+    record()  # 50 tokens/s, 0.5 s prefill, 100 tokens
+    assert admission.service_time("general", "m") == pytest.approx(2.5)
+    assert admission.service_time("general", "m", num_predict=50) == pytest.approx(1.5)
+
+def test_rates_are_moving_averages():
+    record(tokens=100, decode_s=2.0)
+    record(tokens=200, decode_s=2.0)
+    tps, _, tokens = admission._local["m"]
+    assert tps == pytest.approx(0.2 * 100 + 0.8 * 50)
+    assert tokens == pytest.approx(0.2 * 200 + 0.8 * 100)
+
+def test_incomplete_stats_are_ignored():
+    admission.record({"model": "m", "eval_count": 0, "eval_duration": 1})
+    admission.record({"eval_count": 10, "eval_duration": 1})
+    assert admission._local == {}
+
+def test_service_time_falls_back_to_shared_rates_then_queue_average(state):
+    state["avg"]["general"] = 7.0
+    assert admission.service_time("general", "m") == 7.0
+    state["rates"]["m"] = [10.0, 1.0, 20.0]
+    assert admission.service_time("general", "m") == pytest.approx(3.0)
+
+# === Tasks ===
+
+def test_no_history_admits():
+    v = admission.check_task("general", "m")
+    assert v.admit and v.predicted_s == 0.0
+
+def test_task_counts_only_same_or_higher_priority(state):
+    record()
+    state["avg"]["general"] = 10.0
+    state["depths"]["general"] = {"interactive": 2, "batch": 10}
+    assert admission.check_task("general", "m", priority=0).predicted_s == pytest.approx(1 * 10 + 2.5)
+    assert admission.check_task("general", "m", priority=6).predicted_s == pytest.approx(6 * 10 + 2.5)
+    assert admission.check_task("general", "m", priority=0, queued_before=3).predicted_s == pytest.approx(3 * 10 + 2.5)
+
+def test_task_refused_over_limit_with_retry_after(state):
+    record()
+    state["avg"]["general"] = 10.0
+    state["depths"]["general"] = {"batch": 12}
+    v = admission.check_task("general", "m", priority=6)
+    assert not v.admit and v.limit_s == 60.0 and v.predicted_s == pytest.approx(62.5)
+    assert v.retry_after == 3
+
+def test_deadline_only_lowers_the_limit():
+    assert admission.check_task("general", "m", deadline_s=30).limit_s == 30
+    assert admission.check_task("general", "m", deadline_s=600).limit_s == 60.0
+
+def test_disabled_admits_everything(state, monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_ENABLED", False)
+    state["avg"]["general"] = 1000.0
+    state["depths"]["general"] = {"interactive": 100}
+    assert admission.check_task("general", "m").admit
+    assert admission.check_sync("general", "m", in_flight=100, hosts=1).admit
+
+# === Sync calls ===
+
+@pytest.mark.parametrize("in_flight, hosts, predicted", [
+    (0, 1, 2.5),
+    (4, 1, 5.0),   # One full round of OLLAMA_NUM_PARALLEL ahead
+    (5, 1, 7.5),
+    (8, 2, 5.0),   # Two hosts double the parallel slots
+    (9, 2, 7.5),
+    (4, 0, 5.0),   # No healthy host counted: assume one
+])
+def test_sync_prediction(in_flight, hosts, predicted):
+    record()
+    v = admission.check_sync("general", "m", in_flight=in_flight, hosts=hosts)
+    assert v.predicted_s == pytest.approx(predicted)
+    assert v.admit == (predicted <= 10)
+
+def test_sync_refused_over_timeout():
+    record()
+    v = admission.check_sync("general", "m", in_flight=13, hosts=1)
+    assert not v.admit and v.limit_s == 10.0 and v.retry_after == 3
+
+def test_async_check_matches_sync():
+    record()
+    v = asyncio.run(admission.acheck_sync("general", "m", in_flight=5, hosts=1))
+    assert v == admission.check_sync("general", "m", in_flight=5, hosts=1)
+
+# === Refresh ===
+
+def test_refresh_failure_keeps_stale_data_and_backs_off(state, monkeypatch):
+    class Down:
+        def pipeline(self, *a, **kw):
+            raise redis.ConnectionError("down")
+        def hgetall(self, key):
+            raise redis.ConnectionError("down")
+    monkeypatch.setattr(settings, "ADMISSION_REFRESH_S", 2.0)
+    monkeypatch.setattr(admission, "get_redis", Down)
+    state.update(at=0.0, avg={"general": 5.0})
+    admission._refresh()
+    assert state["avg"] == {"general": 5.0}
+    assert not admission._stale()  # Not retried on the next request
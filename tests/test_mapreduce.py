@@ -0,0 +1,115 @@
+import pytest
+
+pytest.importorskip("redis")
+import mapreduce
+
+WORDS = " ".join(f"w{i}" for i in range(2000))  # ~10k chars, no line breaks
+
+# === Split ===
+
+def test_short_and_empty_text():
+    assert mapreduce.split("  one chunk  ", chunk_tokens=100) == ["one chunk"]
+    assert mapreduce.split("", chunk_tokens=100) == []
+
+def test_chunks_fit_and_cover_the_text():
+    chunks = mapreduce.split(WORDS, chunk_tokens=100, overlap_tokens=10)
+    assert len(chunks) > 1
+    assert all(len(c) <= 100 * mapreduce.CHARS_PER_TOKEN for c in chunks)
+    assert set(WORDS.split()) == {w for c in chunks for w in c.split()}  # Cut between words, none lost
+
+def test_consecutive_chunks_overlap():
+    chunks = mapreduce.split(WORDS, chunk_tokens=100, overlap_tokens=10)
+    for a, b in zip(chunks, chunks[1:]):
+        shared = set(a.split()[-5:]) & set(b.split()[:10])
+        assert shared, (a[-40:], b[:40])
+
+def test_no_overlap():
+    chunks = mapreduce.split(WORDS, chunk_tokens=100, overlap_tokens=0)
+    assert " ".join(chunks).split() == WORDS.split()
+
+def test_overlap_capped_at_half_a_chunk():
+    chunks = mapreduce.split(WORDS, chunk_tokens=50, overlap_tokens=1000)
+    assert len(chunks) < len(WORDS) / (50 * mapreduce.CHARS_PER_TOKEN // 2) + 2
+
+def test_prefers_paragraph_boundaries():
+    para = "x" * 350 + "."
+    text = "\n\n".join([para] * 4)
+    chunks = mapreduce.split(text, chunk_tokens=100, overlap_tokens=0)
+    assert chunks == [para] * 4
+
+def test_unbroken_text_is_hard_cut():
+    text = "x" * 1000
+    chunks = mapreduce.split(text, chunk_tokens=100, overlap_tokens=0)
+    assert chunks == ["x" * 400, "x" * 400, "x" * 200]
+
+# === Merge ===
+
+def test_objects_merge_recursively():
+    values = [{"a": 1, "n": {"x": 1}}, {"b": 2, "n": {"y": 2}}]
+    assert mapreduce.merge(values) == {"a": 1, "n": {"x": 1, "y": 2}, "b": 2}
+
+def test_arrays_concatenate_without_overlap_duplicates():
+    values = [["Alice", {"k": "A  b"}], ["alice ", {"k": "a b"}, "Bob"]]
+    assert mapreduce.merge(values) == ["Alice", {"k": "A  b"}, "Bob"]
+
+def test_scalar_conflict_majority_and_report():
+    conflicts = []
+    assert mapreduce.merge([{"year": 2020}, {"year": 2021}, {"year": 2021}], conflicts=conflicts) == {"year": 2021}
+    assert conflicts == [{"path": "year", "chosen": 2021, "values": [2020, 2021]}]
+
+def test_scalar_tie_goes_to_earliest_chunk():
+    conflicts = []
+    assert mapreduce.merge(["a", "b"], conflicts=conflicts) == "a"
+    assert conflicts[0]["path"] == "$"
+
+def test_same_value_differently_spaced_is_no_conflict():
+    conflicts = []
+    assert mapreduce.merge(["New  York", "new york"], conflicts=conflicts) == "New  York"
+    assert conflicts == []
+
+def test_missing_and_empty_values_dont_vote():
+    conflicts = []
+    assert mapreduce.merge([{"a": ""}, {"a": None}, {"a": "x"}, {}], conflicts=conflicts) == {"a": "x"}
+    assert conflicts == []
+    assert mapreduce.merge([None, None]) is None
+
+def test_nested_conflict_path_through_schema_ref():
+    schema = {"properties": {"person": {"$ref": "#/definitions/p"}}, "definitions": {"p": {"type": "object"}}}
+    conflicts = []
+    mapreduce.merge([{"person": {"name": "A"}}, {"person": {"name": "B"}}], schema, conflicts=conflicts)
+    assert [c["path"] for c in conflicts] == ["person.name"]
+
+# === Progress ===
+
+@pytest.fixture
+def r(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(mapreduce, "get_redis", lambda: client)
+    return client
+
+def test_progress(r):
+    mapreduce.start("job", 3)
+    mapreduce.chunk_finished("job", 0, True)
+    mapreduce.chunk_finished("job", 2, False)
+    assert mapreduce.progress("job") == {"job_id": "job", "total": 3, "done": 1, "failed": 1,
+                                         "chunks": ["done", "pending", "failed"], "reduce": "pending"}
+    mapreduce.mark_reduced("job", "done")
+    assert mapreduce.progress("job")["reduce"] == "done"
+    assert r.ttl(mapreduce.PREFIX + "job") > 0
+
+def test_redelivered_chunk_counts_once(r):
+    mapreduce.start("job", 2)
+    for _ in range(3):  # acks_late redelivery re-runs the chunk
+        mapreduce.chunk_finished("job", 0, True)
+    p = mapreduce.progress("job")
+    assert (p["done"], p["failed"]) == (1, 0)
+
+def test_retried_chunk_keeps_its_last_outcome(r):
+    mapreduce.start("job", 1)
+    mapreduce.chunk_finished("job", 0, False)
+    mapreduce.chunk_finished("job", 0, True)
+    assert mapreduce.progress("job")["chunks"] == ["done"]
+
+def test_unknown_job(r):
+    assert mapreduce.progress("nope") is None
@@ -0,0 +1,71 @@
+import asyncio
+import time
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+import redis
+import ratelimit
+from config import settings
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Point the limiter at an in-process Redis (with Lua) and set per-key limits: {key: (per minute, burst)}."""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(ratelimit, "get_async_redis", lambda: fakeredis.aioredis.FakeRedis(server=server))
+    monkeypatch.setattr(settings, "RATE_LIMIT_OVERRIDES", {})
+    return settings.RATE_LIMIT_OVERRIDES
+
+def take(key: str, n: int = 1) -> list:
+    async def run():
+        return [await ratelimit.check(key) for _ in range(n)]
+    return asyncio.run(run())
+
+def test_burst_then_refused(limits):
+    limits["k"] = (60, 3)  # 1 token/s
+    decisions = take("k", 4)
+    assert [d.allowed for d in decisions] == [True, True, True, False]
+    assert [d.remaining for d in decisions] == [2, 1, 0, 0]
+    refused = decisions[-1]
+    assert refused.limit == 60 and refused.retry_after == 1 and refused.reset == 3
+    assert refused.headers()["Retry-After"] == "1"
+    assert "Retry-After" not in decisions[0].headers()
+
+def test_bucket_refills(limits):
+    limits["k"] = (6000, 1)  # 100 tokens/s
+    assert [d.allowed for d in take("k", 2)] == [True, False]
+    time.sleep(0.05)
+    assert take("k")[0].allowed
+
+def test_keys_have_separate_buckets(limits):
+    limits["a"] = limits["b"] = (60, 1)
+    assert take("a", 2)[1].allowed is False
+    assert take("b")[0].allowed
+
+def test_bucket_expires_once_full_again(limits):
+    limits["k"] = (60, 5)
+    take("k")
+    async def ttl():
+        return await ratelimit.get_async_redis().ttl(ratelimit.PREFIX + "k")
+    assert 0 < asyncio.run(ttl()) <= 6  # ceil(burst / rate) + 1
+
+def test_zero_limit_blocks_without_redis(limits, monkeypatch):
+    limits["blocked"] = (0, 0)
+    monkeypatch.setattr(ratelimit, "get_async_redis", lambda: pytest.fail("a zero limit must not reach Redis"))
+    d = take("blocked")[0]
+    assert not d.allowed and d.limit == 0 and d.remaining == 0
+    assert d.headers()["Retry-After"] == "60"
+
+def test_burst_defaults_to_limit(limits, monkeypatch):
+    monkeypatch.setattr(settings, "RATE_LIMIT", 120)
+    monkeypatch.setattr(settings, "RATE_LIMIT_BURST", 0)
+    limits["k"] = (30, 0)
+    assert ratelimit.limits_for("other") == (120, 120)
+    assert ratelimit.limits_for("k") == (30, 30)
+
+def test_fails_open_when_redis_is_down(limits, monkeypatch):
+    class Down:
+        async def eval(self, *args):
+            raise redis.ConnectionError("down")
+    limits["k"] = (60, 1)
+    monkeypatch.setattr(ratelimit, "get_async_redis", Down)
+    assert take("k")[0] is None
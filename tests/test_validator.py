@@ -0,0 +1,142 @@
+import json
+import pytest
+import validator
+from validator import StreamValidator
+
+PERSON = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string", "minLength": 1},
+        "age": {"type": "integer", "minimum": 0},
+        "role": {"enum": ["admin", "user"]},
+        "tags": {"type": "array", "items": {"type": "string"}, "uniqueItems": True},
+    },
+    "required": ["name", "age"],
+    "additionalProperties": False,
+}
+
+TREE = {
+    "$ref": "#/definitions/node",
+    "definitions": {
+        "node": {
+            "type": "object",
+            "properties": {"value": {"type": "integer"}, "children": {"type": "array", "items": {"$ref": "#/definitions/node"}}},
+            "required": ["value"],
+        },
+    },
+}
+
+def stream(schema: dict, text: str, step: int = 1) -> StreamValidator:
+    v = StreamValidator(schema)
+    for i in range(0, len(text), step):
+        if v.feed(text[i:i + step]):
+            break
+    return v
+
+# === Compiled validation ===
+
+def test_valid_document():
+    assert validator.validate({"name": "Ada", "age": 36, "role": "admin", "tags": ["a", "b"]}, PERSON) == []
+
+@pytest.mark.parametrize("data, error", [
+    ({"age": 1}, "Missing: name"),
+    ({"name": "Ada", "age": "36"}, "age must be integer"),
+    ({"name": "Ada", "age": 1.5}, "age must be integer"),
+    ({"name": "Ada", "age": -1}, "age violates minimum 0"),
+    ({"name": "", "age": 1}, "name shorter than 1"),
+    ({"name": "Ada", "age": 1, "role": "root"}, "role must be one of ['admin', 'user']"),
+    ({"name": "Ada", "age": 1, "tags": ["a", "a"]}, "tags items must be unique"),
+    ({"name": "Ada", "age": 1, "tags": ["a", 2]}, "tags[1] must be string"),
+    ({"name": "Ada", "age": 1, "email": "x"}, "Unexpected key: email"),
+    ([], "value must be object"),
+])
+def test_violations(data, error):
+    assert error in validator.validate(data, PERSON)
+
+def test_wrong_type_skips_type_specific_checks():
+    assert validator.validate({"name": 5, "age": 1}, PERSON) == ["name must be string"]
+
+def test_integral_float_is_an_integer_and_bool_is_not():
+    assert validator.validate(3.0, {"type": "integer"}) == []
+    assert validator.validate(True, {"type": "integer"}) == ["value must be integer"]
+    assert validator.validate(True, {"type": "number"}) == ["value must be number"]
+
+def test_type_union():
+    schema = {"type": ["string", "null"]}
+    assert validator.validate(None, schema) == []
+    assert validator.validate(1, schema) == ["value must be string or null"]
+
+def test_recursive_ref():
+    assert validator.validate({"value": 1, "children": [{"value": 2, "children": [{"value": 3}]}]}, TREE) == []
+    assert validator.validate({"value": 1, "children": [{"children": []}]}, TREE) == ["Missing: children[0].value"]
+
+def test_defs_ref_and_escaped_pointer():
+    schema = {"properties": {"a": {"$ref": "#/$defs/x~1y"}}, "$defs": {"x/y": {"type": "string"}}}
+    assert validator.validate({"a": 1}, schema) == ["a must be string"]
+
+def test_one_of_needs_exactly_one_match():
+    schema = {"oneOf": [{"type": "integer"}, {"type": "number"}]}
+    assert validator.validate(1.5, schema) == []
+    assert validator.validate(1, schema) == ["value must match exactly one of oneOf"]
+    assert validator.validate(1, {"anyOf": schema["oneOf"]}) == []
+
+def test_additional_properties_schema():
+    schema = {"type": "object", "additionalProperties": {"type": "integer"}}
+    assert validator.validate({"a": 1, "b": "x"}, schema) == ["b must be integer"]
+
+def test_compiled_once_per_schema():
+    validator._compiled.cache_clear()
+    validator.validate({}, {"type": "object", "required": ["a"]})
+    validator.validate({}, {"required": ["a"], "type": "object"})  # Same schema, other key order
+    assert validator._compiled.cache_info().misses == 1
+
+# === Streaming validation ===
+
+@pytest.mark.parametrize("step", [1, 3, 1000])
+def test_stream_accepts_valid_document(step):
+    text = json.dumps({"name": "A \"quoted\" \\ name", "age": 36, "role": "user", "tags": ["x", "y"]}, indent=2)
+    v = stream(PERSON, text, step)
+    assert v.error is None and v.done
+
+def test_stream_tolerates_code_fence():
+    v = stream(PERSON, '```json\n{"name": "Ada", "age": 1}\n```')
+    assert v.error is None and v.done
+
+@pytest.mark.parametrize("text, error", [
+    ('Sure! {"name": "Ada"}', "Output does not start with JSON"),
+    ('{"name": 5', "name must be string"),
+    ('{"name": "Ada", "age": "3', "age must be integer"),
+    ('{"name": "Ada", "age": 1.5,', "age must be integer"),
+    ('{"name": "Ada", "email"', "Unexpected key: email"),
+    ('{"name": "Ada", "role": "root"', "role must be one of ['admin', 'user']"),
+    ('{"name": "Ada"}', "Missing: age"),
+    ('{"name": "Ada", "tags": [1', "tags[0] must be string"),
+    ('{"name" "Ada"', "Unexpected '\"' in object at root"),
+    ('{"name": "Ada", "age": 1-2,', "Invalid literal '1-2' at age"),
+    ('{"name": "Ada", "age": true', "age must be integer"),
+])
+def test_stream_fails_early(text, error):
+    assert stream(PERSON, text).error == error
+
+def test_stream_error_before_document_ends():
+    v = StreamValidator(PERSON)
+    assert v.feed('{"name": "Ada", "age": "') == "age must be integer"
+    assert v.feed('36"}') == "age must be integer"  # Sticky: later chunks are ignored
+
+def test_stream_partial_document_is_not_done():
+    v = stream(PERSON, '{"name": "Ada", "age": 3')
+    assert v.error is None and not v.done
+
+def test_stream_follows_refs():
+    assert stream(TREE, '{"value": 1, "children": [{"value": 2}, {"value": "3"').error == "children[1].value must be integer"
+    v = stream(TREE, '{"value": 1, "children": [{"value": 2, "children": []}]}')
+    assert v.error is None and v.done
+
+def test_stream_stops_at_end_of_document():
+    v = StreamValidator({"type": "array", "items": {"type": "number"}})
+    assert v.feed("[1, 2.5, -3e2] trailing prose") is None
+    assert v.done
+
+def test_stream_names_integer_in_unions():
+    schema = {"type": "array", "items": {"type": ["integer", "string"]}}
+    assert stream(schema, "[true").error == "[0] must be integer or string"
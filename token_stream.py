@@ -0,0 +1,79 @@
+"""Incremental token delivery for queued tasks via Redis Streams.
+
+Workers append generated text to tokens:<task_id> (batched, capped with MAXLEN
+and expired after TOKEN_STREAM_TTL); the API replays the stream from the start
+and then follows it live with blocking XREAD.
+
+Entry fields: t=<text> | reset=1 (task retried, discard text so far)
+              | done=1 | error=<message>
+"""
+import time
+import redis
+from config import settings, get_logger
+from redis_pool import get_redis
+
+log = get_logger("token_stream")
+
+PREFIX = "tokens:"
+
+def key(task_id: str) -> str:
+    return PREFIX + task_id
+
+class Publisher:
+    """Buffers chunks and flushes them to the task's stream every few ms/chars."""
+
+    def __init__(self, task_id: str, retry: bool = False):
+        self.key = key(task_id)
+        self.r = get_redis()
+        self.buffer: list[str] = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+        if retry:
+            self._add({"reset": "1"})
+
+    def _add(self, fields: dict):
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            pipe.xadd(self.key, fields, maxlen=settings.TOKEN_STREAM_MAXLEN, approximate=True)
+            pipe.expire(self.key, settings.TOKEN_STREAM_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            log.warning(f"Token publish failed for {self.key}: {e}")  # Final result still lands in the backend
+
+    def write(self, chunk: str):
+        if not chunk:
+            return
+        self.buffer.append(chunk)
+        self.size += len(chunk)
+        if self.size >= settings.TOKEN_STREAM_FLUSH_CHARS or time.monotonic() - self.last_flush >= settings.TOKEN_STREAM_FLUSH_S:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self._add({"t": "".join(self.buffer)})
+            self.buffer, self.size = [], 0
+        self.last_flush = time.monotonic()
+
+    def close(self, error: str = None):
+        self.flush()
+        self._add({"error": error} if error else {"done": "1"})
+
+def publish(task_id: str, chunks, retry: bool = False, last_attempt: bool = True) -> str:
+    """Drain a chunk iterator into the task's stream; returns the full text.
+
+    On failure the error is only published on the last attempt - otherwise the
+    retry's reset marker tells followers to start over.
+    """
+    pub = Publisher(task_id, retry=retry)
+    parts = []
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            pub.write(chunk)
+    except Exception as e:
+        pub.flush()
+        if last_attempt:
+            pub.close(error=str(e)[:500])
+        raise
+    pub.close()
+    return "".join(parts)
@@ -0,0 +1,130 @@
+"""Content-addressed upload store with a base64-ready image cache.
+
+Uploads are streamed to disk in chunks while hashed and stored as
+UPLOAD_DIR/<sha256><ext>, so the same file uploaded twice is kept once and
+gets the same path back.
+
+encoded(path) returns the base64 payload Ollama wants for an image. The
+first call per file writes a variant to UPLOAD_DIR/variants/: downscaled so
+its longer side is at most VISION_MAX_SIDE (the vision model's effective
+resolution; larger images only add prefill) and already base64-encoded.
+Later calls - other prompts, other workers, Celery retries - read that small
+file (or hit an in-process LRU) instead of re-reading and re-encoding the
+original. Downscaling needs Pillow (optional); without it the variant is the
+original, encoded once.
+"""
+import os
+import io
+import uuid
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from config import settings, get_logger
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional dependency
+    Image = None
+
+log = get_logger("uploads")
+
+CHUNK = 1024 * 1024
+EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".pdf")
+VARIANT_DIR = os.path.join(settings.UPLOAD_DIR, "variants")
+
+class TooLarge(Exception):
+    """Upload exceeded MAX_UPLOAD_SIZE, or is an image with more pixels than Pillow will decode."""
+
+# === Store ===
+
+def save(src, ext: str) -> tuple[str, str]:
+    """Stream a file object into the store; returns (path, sha256)."""
+    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+    tmp = os.path.join(settings.UPLOAD_DIR, f".{uuid.uuid4().hex}.tmp")
+    digest, size = hashlib.sha256(), 0
+    try:
+        with open(tmp, "wb") as f:
+            while chunk := src.read(CHUNK):
+                size += len(chunk)
+                if size > settings.MAX_UPLOAD_SIZE:
+                    raise TooLarge(f"Upload exceeds {settings.MAX_UPLOAD_SIZE} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+        sha = digest.hexdigest()
+        path = os.path.join(settings.UPLOAD_DIR, f"{sha}{ext}")
+        if os.path.exists(path):
+            os.remove(tmp)  # Already stored
+        else:
+            os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if ext != ".pdf":
+        try:
+            encoded(path)  # Build the variant now, off the worker's critical path
+        except TooLarge:
+            os.remove(path)  # Decompression bomb: don't keep it for vision tasks to trip over
+            raise
+    return path, sha
+
+# === Encoded variants ===
+
+_lru: OrderedDict[str, str] = OrderedDict()
+_lru_lock = threading.Lock()
+
+def _variant_key(path: str) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if len(stem) == 64 and os.path.dirname(os.path.abspath(path)) == os.path.abspath(settings.UPLOAD_DIR):
+        source = stem  # Content-addressed upload
+    else:
+        st = os.stat(path)  # Any other file: identify it without reading it
+        source = hashlib.sha256(f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+    return f"{source}-{settings.VISION_MAX_SIDE}"
+
+def _downscale(raw: bytes) -> bytes:
+    if Image is None:
+        return raw
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            if max(img.size) <= settings.VISION_MAX_SIDE and img.format in ("JPEG", "PNG"):
+                return raw
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((settings.VISION_MAX_SIDE, settings.VISION_MAX_SIDE), Image.LANCZOS)
+            out = io.BytesIO()
+            if img.mode in ("RGBA", "LA", "P"):
+                img.save(out, "PNG", optimize=True)
+            else:
+                img.convert("RGB").save(out, "JPEG", quality=settings.VISION_JPEG_QUALITY)
+            return out.getvalue()
+    except Image.DecompressionBombError as e:  # Not an OSError/ValueError: would surface as a 500
+        raise TooLarge(f"Image too large to decode: {e}")
+    except (OSError, ValueError) as e:  # Not an image Pillow can read: send it as is
+        log.debug(f"Not downscaling: {e}")
+        return raw
+
+def encoded(path: str) -> str:
+    """Base64 of the (downscaled) image at path, built once and cached."""
+    key = _variant_key(path)
+    with _lru_lock:
+        if key in _lru:
+            _lru.move_to_end(key)
+            return _lru[key]
+    variant = os.path.join(VARIANT_DIR, f"{key}.b64")
+    try:
+        with open(variant) as f:
+            data = f.read()
+    except FileNotFoundError:
+        with open(path, "rb") as f:
+            data = base64.b64encode(_downscale(f.read())).decode()
+        os.makedirs(VARIANT_DIR, exist_ok=True)
+        tmp = f"{variant}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, variant)
+    with _lru_lock:
+        _lru[key] = data
+        while len(_lru) > settings.VISION_CACHE_SIZE:
+            _lru.popitem(last=False)
+    return data
@@ -0,0 +1,357 @@
+"""Compiled JSON-Schema validation for structured output.
+
+A schema is compiled once into a tree of small check functions and cached by
+its canonical JSON, so validating each response is a straight walk with no
+schema interpretation. Covers the draft-7 subset used for extraction:
+type (incl. unions), enum, const, properties/required/additionalProperties,
+items/minItems/maxItems/uniqueItems, string length/pattern, numeric bounds,
+allOf/anyOf/oneOf and local $ref (#/definitions, #/$defs).
+"""
+import re
+import json
+from functools import lru_cache
+from typing import Any, Callable
+
+Check = Callable[[Any, str, list], None]  # (value, path, errors)
+
+_TYPES = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "boolean": lambda v: isinstance(v, bool),
+    "null": lambda v: v is None,
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "integer": lambda v: (isinstance(v, int) and not isinstance(v, bool)) or (isinstance(v, float) and v.is_integer()),
+}
+
+def type_matches(value: Any, type_: str | list) -> bool:
+    types = type_ if isinstance(type_, list) else [type_]
+    return any(_TYPES.get(t, lambda v: True)(value) for t in types)
+
+def resolve(schema: dict, root: dict) -> dict:
+    """Follow a local $ref; other schemas are returned as-is."""
+    seen = 0
+    while isinstance(schema, dict) and "$ref" in schema and seen < 32:
+        node = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            node = node.get(part.replace("~1", "/").replace("~0", "~"), {}) if part else node
+        schema, seen = node, seen + 1
+    return schema if isinstance(schema, dict) else {}
+
+def _join(path: str, key: Any) -> str:
+    return f"{path}[{key}]" if isinstance(key, int) else (f"{path}.{key}" if path else str(key))
+
+def _compile(schema: dict | bool, root: dict, refs: dict) -> Check:
+    if schema is True or schema == {}:
+        return lambda v, p, e: None
+    if schema is False:
+        return lambda v, p, e: e.append(f"{p or 'value'} not allowed")
+    if "$ref" in schema:
+        ref = schema["$ref"]
+        if ref not in refs:  # Recursive schemas: placeholder filled after compiling the target
+            slot = []
+            refs[ref] = lambda v, p, e: slot[0](v, p, e)
+            slot.append(_compile(resolve(schema, root), root, refs))
+        return refs[ref]
+
+    checks: list[Check] = []
+
+    if "type" in schema:
+        type_ = schema["type"]
+        label = " or ".join(type_) if isinstance(type_, list) else type_
+        def check_type(v, p, e):
+            if not type_matches(v, type_):
+                e.append(f"{p or 'value'} must be {label}")
+                return True
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+        checks.append(lambda v, p, e: None if v in allowed else e.append(f"{p or 'value'} must be one of {allowed}"))
+    if "const" in schema:
+        const = schema["const"]
+        checks.append(lambda v, p, e: None if v == const else e.append(f"{p or 'value'} must be {const!r}"))
+
+    # Objects
+    props = {k: _compile(s, root, refs) for k, s in schema.get("properties", {}).items()}
+    required = schema.get("required", [])
+    extra = schema.get("additionalProperties", True)
+    extra_check = None if extra is True else _compile(extra, root, refs) if isinstance(extra, dict) else False
+    if props or required or extra_check is not None:
+        def check_object(v, p, e):
+            if not isinstance(v, dict):
+                return
+            for k in required:
+                if k not in v:
+                    e.append(f"Missing: {_join(p, k)}")
+            for k, item in v.items():
+                if k in props:
+                    props[k](item, _join(p, k), e)
+                elif extra_check is False:
+                    e.append(f"Unexpected key: {_join(p, k)}")
+                elif extra_check is not None:
+                    extra_check(item, _join(p, k), e)
+        checks.append(check_object)
+
+    # Arrays
+    if "items" in schema or any(k in schema for k in ("minItems", "maxItems", "uniqueItems")):
+        item_check = _compile(schema.get("items", True), root, refs)
+        lo, hi, unique = schema.get("minItems"), schema.get("maxItems"), schema.get("uniqueItems")
+        def check_array(v, p, e):
+            if not isinstance(v, list):
+                return
+            if lo is not None and len(v) < lo:
+                e.append(f"{p or 'value'} needs at least {lo} items")
+            if hi is not None and len(v) > hi:
+                e.append(f"{p or 'value'} allows at most {hi} items")
+            if unique and len({json.dumps(i, sort_keys=True) for i in v}) != len(v):
+                e.append(f"{p or 'value'} items must be unique")
+            for i, item in enumerate(v):
+                item_check(item, _join(p, i), e)
+        checks.append(check_array)
+
+    # Strings
+    if any(k in schema for k in ("minLength", "maxLength", "pattern")):
+        lo, hi = schema.get("minLength"), schema.get("maxLength")
+        pattern = re.compile(schema["pattern"]) if "pattern" in schema else None
+        def check_string(v, p, e):
+            if not isinstance(v, str):
+                return
+            if lo is not None and len(v) < lo:
+                e.append(f"{p or 'value'} shorter than {lo}")
+            if hi is not None and len(v) > hi:
+                e.append(f"{p or 'value'} longer than {hi}")
+            if pattern and not pattern.search(v):
+                e.append(f"{p or 'value'} does not match {pattern.pattern}")
+        checks.append(check_string)
+
+    # Numbers
+    bounds = [(k, schema[k]) for k in ("minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum") if k in schema]
+    if bounds:
+        ops = {
+            "minimum": lambda v, b: v >= b, "maximum": lambda v, b: v <= b,
+            "exclusiveMinimum": lambda v, b: v > b, "exclusiveMaximum": lambda v, b: v < b,
+        }
+        def check_number(v, p, e):
+            if not _TYPES["number"](v):
+                return
+            for k, b in bounds:
+                if not ops[k](v, b):
+                    e.append(f"{p or 'value'} violates {k} {b}")
+        checks.append(check_number)
+
+    # Combinators
+    for s in schema.get("allOf", []):
+        checks.append(_compile(s, root, refs))
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            options = [_compile(s, root, refs) for s in schema[key]]
+            exact = key == "oneOf"
+            def check_options(v, p, e, options=options, exact=exact, key=key):
+                passed = sum(1 for opt in options if not _errors(opt, v, p))
+                if passed == 0 or (exact and passed > 1):
+                    e.append(f"{p or 'value'} must match {'exactly one' if exact else 'at least one'} of {key}")
+            checks.append(check_options)
+
+    def check(v, p, e):
+        for c in checks:
+            if c(v, p, e):  # Wrong type - skip the type-specific checks
+                return
+    return check
+
+def _errors(check: Check, value: Any, path: str = "") -> list[str]:
+    errors = []
+    check(value, path, errors)
+    return errors
+
+@lru_cache(maxsize=256)
+def _compiled(schema_json: str) -> Check:
+    schema = json.loads(schema_json)
+    return _compile(schema, schema, {})
+
+def compile(schema: dict) -> Check:
+    return _compiled(json.dumps(schema, sort_keys=True))
+
+def validate(data: Any, schema: dict) -> list[str]:
+    """All violations of schema in data (empty list = valid)."""
+    return _errors(compile(schema), data)
+
+# === Incremental (streaming) validation ===
+
+_VALUE_START = {"{": "object", "[": "array", '"': "string", "t": "boolean", "f": "boolean", "n": "null"}
+_LITERAL_CHARS = set("0123456789+-.eEtrufalsn")
+
+def _allowed_kinds(schema: dict, root: dict) -> set | None:
+    """JSON value kinds a schema can accept (None = anything)."""
+    schema = resolve(schema, root)
+    if "type" in schema:
+        types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        return {"number" if t == "integer" else t for t in types} | ({"integer"} if "integer" in types and "number" not in types else set())
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            kinds = set()
+            for option in schema[key]:
+                if (sub := _allowed_kinds(option, root)) is None:
+                    return None
+                kinds |= sub
+            return kinds
+    return None
+
+class StreamValidator:
+    """Checks a JSON document against a schema as it is generated.
+
+    feed() returns an error as soon as the partial output can no longer become
+    a valid document: prose before the JSON, a value of the wrong type, an
+    unknown key in a closed object, a missing required key when an object
+    closes, or broken syntax. Constraints that need the whole value (bounds,
+    patterns) are left to validate() on the finished document.
+    """
+
+    def __init__(self, schema: dict):
+        self.root = schema
+        self.stack: list[dict] = []
+        self.error: str = None
+        self.done = False
+        self.started = False
+        self.in_fence = False
+        self.mode = None  # None | "string" | "literal"
+        self.buf: list[str] = []
+        self.escape = False
+        self.is_key = False
+        self.literal_schema: dict = None
+        self.path = ""
+
+    def feed(self, text: str) -> str | None:
+        for ch in text:
+            if self.error or self.done:
+                break
+            self._char(ch)
+        return self.error
+
+    def _fail(self, msg: str):
+        self.error = msg
+
+    def _char(self, ch: str):
+        if self.mode == "string":
+            if self.escape:
+                self.escape = False
+            elif ch == "\\":
+                self.escape = True
+            elif ch == '"':
+                self.mode = None
+                text = "".join(self.buf)
+                self._on_key(text) if self.is_key else self._on_string(text)
+                return
+            self.buf.append(ch)
+            return
+        if self.mode == "literal":
+            if ch in _LITERAL_CHARS:
+                self.buf.append(ch)
+                return
+            self.mode = None
+            self._on_literal("".join(self.buf))
+            if self.error or self.done:
+                return
+        if ch.isspace():
+            if self.in_fence and ch == "\n":
+                self.in_fence = False
+            return
+        if not self.started:
+            if ch == "`" or self.in_fence:  # Tolerate a leading ```json fence
+                self.in_fence = True
+                return
+            if ch not in "{[":
+                return self._fail("Output does not start with JSON")
+            self.started = True
+            return self._start_value(ch, self.root, "")
+        self._structural(ch)
+
+    def _structural(self, ch: str):
+        frame = self.stack[-1]
+        state = frame["state"]
+        if frame["kind"] == "object":
+            if ch == '"' and state in ("key_or_end", "key"):
+                self.mode, self.buf, self.is_key = "string", [], True
+            elif ch == ":" and state == "colon":
+                frame["state"] = "value"
+            elif ch == "," and state == "comma_or_end":
+                frame["state"] = "key"
+            elif ch == "}" and state in ("key_or_end", "comma_or_end"):
+                missing = [k for k in frame["schema"].get("required", []) if k not in frame["keys"]]
+                if missing:
+                    return self._fail(f"Missing: {_join(frame['path'], missing[0])}")
+                self._end_value()
+            elif state == "value":
+                props = frame["schema"].get("properties", {})
+                extra = frame["schema"].get("additionalProperties", True)
+                sub = props.get(frame["key"], extra if isinstance(extra, dict) else {})
+                self._start_value(ch, sub, _join(frame["path"], frame["key"]))
+            else:
+                self._fail(f"Unexpected {ch!r} in object at {frame['path'] or 'root'}")
+        else:
+            if ch == "," and state == "comma_or_end":
+                frame["state"], frame["index"] = "value", frame["index"] + 1
+            elif ch == "]" and state in ("value_or_end", "comma_or_end"):
+                self._end_value()
+            elif state in ("value", "value_or_end"):
+                items = frame["schema"].get("items", {})
+                self._start_value(ch, items if isinstance(items, dict) else {}, _join(frame["path"], frame["index"]))
+            else:
+                self._fail(f"Unexpected {ch!r} in array at {frame['path'] or 'root'}")
+
+    def _start_value(self, ch: str, schema: dict, path: str):
+        kind = _VALUE_START.get(ch) or ("number" if ch in "-0123456789" else None)
+        if kind is None:
+            return self._fail(f"Unexpected {ch!r} at {path or 'root'}")
+        schema = resolve(schema, self.root)
+        allowed = _allowed_kinds(schema, self.root)
+        if allowed is not None and kind not in allowed:
+            names = {"integer" if k == "number" and "integer" in allowed else k for k in allowed - {"integer"}}
+            return self._fail(f"{path or 'value'} must be {' or '.join(sorted(names))}")
+        if self.stack:
+            self.stack[-1]["state"] = "pending"  # Value in progress
+        if kind == "object":
+            self.stack.append({"kind": "object", "schema": schema, "state": "key_or_end", "keys": set(), "key": None, "path": path})
+        elif kind == "array":
+            self.stack.append({"kind": "array", "schema": schema, "state": "value_or_end", "index": 0, "path": path})
+        elif kind == "string":
+            self.mode, self.buf, self.is_key = "string", [], False
+            self.literal_schema, self.path = schema, path
+        else:
+            self.mode, self.buf = "literal", [ch]
+            self.literal_schema, self.path = schema, path
+
+    def _end_value(self):
+        if self.stack and self.stack[-1]["state"] in ("key_or_end", "comma_or_end", "value_or_end"):
+            self.stack.pop()  # Container closed
+        if not self.stack:
+            self.done = True
+        else:
+            self.stack[-1]["state"] = "comma_or_end"
+
+    def _on_key(self, key: str):
+        frame = self.stack[-1]
+        schema = frame["schema"]
+        if schema.get("additionalProperties") is False and key not in schema.get("properties", {}):
+            return self._fail(f"Unexpected key: {_join(frame['path'], key)}")
+        frame["keys"].add(key)
+        frame["key"], frame["state"] = key, "colon"
+
+    def _on_string(self, text: str):
+        if "enum" in self.literal_schema:
+            try:
+                value = json.loads(f'"{text}"')
+            except json.JSONDecodeError:
+                return self._fail(f"Invalid string at {self.path or 'root'}")
+            if value not in self.literal_schema["enum"]:
+                return self._fail(f"{self.path or 'value'} must be one of {self.literal_schema['enum']}")
+        self._end_value()
+
+    def _on_literal(self, text: str):
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError:
+            return self._fail(f"Invalid literal {text!r} at {self.path or 'root'}")
+        if _allowed_kinds(self.literal_schema, self.root) == {"number", "integer"} and not _TYPES["integer"](value):
+            return self._fail(f"{self.path or 'value'} must be integer")
+        self._end_value()